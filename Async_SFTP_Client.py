@@ -0,0 +1,949 @@
+"""
+An asyncio SFTP v3 client. Async generators are used, so this needs Python 3.6 or newer.
+"""
+# Handle imports
+from Packet import packet, SFTP_error, FX_names, UINT32
+from Requests import path_request, handle_request, open_request, read_request, write_request, mkdir_request, \
+    setstat_request, rename_request, symlink_request, check_status, expect, is_eof
+from Attributes import attributes
+from Metadata_Cache import metadata_cache
+from Metrics import request_metrics
+from Tracing import request_trace
+from Remote_File import mode_pflags
+
+import asyncio
+import collections
+import io
+import logging
+import os
+import posixpath
+import socket
+import stat
+import threading
+import time
+
+# Define global vars
+logger = logging.getLogger("SFTP3.Async_SFTP_Client")
+
+# Define classes
+class AsyncSFTPClient():
+    """
+    An asyncio SFTP v3 client, with coroutine versions of the SFTP_client methods.
+
+    Every coroutine shares one sftp channel. Requests are written as soon as they are made, and a reader task
+    reads responses as they arrive, handing each one to the future waiting on its id. Any number of coroutines
+    can have requests in flight at once, up to max_requests, without a thread each.
+
+    Use AsyncSFTPClient.from_client() to open a channel on the SSH connection of an SFTP_client. Otherwise, pass a
+    connected sftp channel to the constructor and await start().
+    Use stop() to close the channel.
+    """
+
+    max_requests = 64 # The maximum number of requests in flight at once
+    read_chunk_size = 32768 # Bytes asked for per read
+    max_reads = 16 # The maximum number of reads in flight at once, per file
+    write_chunk_size = 32768 # Bytes sent per write
+    max_writes = 16 # The maximum number of writes in flight at once, per file
+    max_open_handles = None # The most handles the server lets a session hold open, if it reported a limit
+    recv_size = 65536 # Bytes read off the channel at a time
+
+    def __init__(self, channel, max_requests=None):
+        """
+        :param channel: An sftp channel, or anything else with send, recv, settimeout and fileno.
+        :param max_requests: The maximum number of requests in flight at once.
+        """
+        self.socket = channel
+        if not (max_requests is None):
+            self.max_requests = max_requests
+
+        self.loop = None
+        self.next_id = 0
+        self.pending = {} # Futures of outstanding requests, by id
+        self.recv_buffer = bytearray() # Bytes received but not yet decoded
+        self.version = None # The future of the SSH_FXP_VERSION response
+        self.reader = None # The task reading responses
+        self.readable = None # Set when the channel has data to read
+        self.writable = None # Set when the channel can take more data, if its fileno() reports writes
+        self.send_lock = None # Held while a request is being written, so requests aren't interleaved
+        self.slots = None # Free slots in the request window
+        self.cache = None # The metadata_cache, if enabled
+        self.metrics = None # The request_metrics, if enabled
+        self.sent = {} # (FXP_name, bytes, time sent) of outstanding requests by id, while metrics are enabled
+        self.hooks = [] # request_hooks to call around every request
+        self.traces = {} # request_traces of outstanding requests by id, while there are hooks
+
+    @classmethod
+    async def from_client(cls, client, window_size=None, max_packet_size=None, max_requests=None):
+        """
+        Open an sftp channel on the SSH connection of an SFTP_client, and start a session on it.
+
+        The settings default to the client's, including any it tuned to the server's limits.
+
+        :param client: A connected SFTP_client. Its own channel is left alone.
+        :return: A started AsyncSFTPClient.
+        """
+        settings = client.get_settings()
+        if window_size is None:
+            window_size = settings["window_size"]
+        if max_packet_size is None:
+            max_packet_size = settings["max_packet_size"]
+        if max_requests is None:
+            max_requests = settings["max_requests"]
+
+        def open_channel():
+            channel = client.ssh.get_transport().open_session(window_size=window_size,
+                                                              max_packet_size=max_packet_size,
+                                                              timeout=client.conn_timeout)
+            channel.invoke_subsystem("sftp")
+            return channel
+
+        channel = await asyncio.get_event_loop().run_in_executor(None, open_channel)
+
+        self = cls(channel, max_requests)
+        for name in ("read_chunk_size", "max_reads", "write_chunk_size", "max_writes", "max_open_handles"):
+            setattr(self, name, settings[name])
+        await self.start()
+
+        return self
+
+    async def start(self):
+        """
+        Start reading responses and initiate the SFTP session, agreeing on the protocol version with the server.
+        """
+        self.loop = asyncio.get_event_loop()
+        self.readable = asyncio.Event()
+        # paramiko channels only signal reads on their fileno(). Sockets, such as the stand-in server's, signal both.
+        if stat.S_ISSOCK(os.fstat(self.socket.fileno()).st_mode):
+            self.writable = asyncio.Event()
+        self.send_lock = asyncio.Lock()
+        self.slots = asyncio.Semaphore(self.max_requests)
+        self.version = self.loop.create_future()
+
+        self.socket.settimeout(0.0)
+        self.loop.add_reader(self.socket.fileno(), self.readable.set)
+        self.reader = self.loop.create_task(self.__read_responses())
+
+        """
+        uint32 version
+        <extension data>
+        """
+        c_packet = packet("SSH_FXP_INIT")
+        c_packet.add(3, 4)
+        await self.__send(c_packet.buffers())
+        r_packet = await self.version
+
+        # Check that servers agree on the SFTP protocol version.
+        if r_packet.get_items()[0] != 3:
+            raise Exception("SFTP cannot settle on the protocol version to use.")
+
+    async def stop(self):
+        """
+        Close the sftp channel. Outstanding requests fail.
+        """
+        if self.reader is None:
+            return
+
+        self.loop.remove_reader(self.socket.fileno())
+        self.reader.cancel()
+        self.reader = None
+        self.__fail_all(RuntimeError("sftp channel closed"))
+        self.socket.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.stop()
+
+    async def __read_responses(self):
+        """
+        Read responses off the channel for as long as it is open, resolving the future of each.
+        """
+        try:
+            while True:
+                await self.readable.wait()
+                self.readable.clear()
+
+                # Read everything the channel holds
+                while True:
+                    try:
+                        recv = self.socket.recv(self.recv_size)
+                    except (socket.timeout, BlockingIOError):
+                        break
+
+                    if recv == bytes():
+                        # This indicates an error or connection break
+                        raise RuntimeError("socket connection broken")
+
+                    self.recv_buffer += recv
+                    self.__dispatch()
+        except Exception as e:
+            self.__fail_all(e)
+
+    def __dispatch(self):
+        """
+        Decode every whole packet in recv_buffer, and hand each one to the future waiting on it.
+        """
+        while len(self.recv_buffer) >= 4:
+            length = 4 + int.from_bytes(self.recv_buffer[0:4], byteorder='big', signed=False)
+            if len(self.recv_buffer) < length:
+                return
+
+            msg = self.recv_buffer[0:length]
+            del self.recv_buffer[0:length]
+            received_at = time.monotonic()
+
+            trace = None
+            if self.traces and length >= 9:
+                trace = self.traces.pop(UINT32.unpack_from(msg, 5)[0], None)
+            if trace is None:
+                r_packet = packet(b=memoryview(msg))
+            else:
+                r_packet = self.__decode_traced(msg, trace)
+
+            if r_packet.get_FXP_type() == "SSH_FXP_VERSION":
+                future = self.version
+            else:
+                future = self.pending.pop(r_packet.get_id(), None)
+                if future is None:
+                    logger.warning("Dropped a %s response to unknown request %s", r_packet.get_FXP_type(),
+                                   r_packet.get_id())
+                    continue
+                # The request is off the wire only now, even if its future was cancelled earlier
+                self.slots.release()
+
+                sent = self.sent.pop(r_packet.get_id(), None)
+                if not (sent is None) and not (self.metrics is None):
+                    FXP_type, bytes_out, sent_at = sent
+                    self.metrics.record(FXP_type, r_packet, bytes_out, length, received_at - sent_at)
+
+            if not future.done():
+                future.set_result(r_packet)
+
+    def __fail_all(self, error):
+        """
+        Fail every outstanding request, such as when the channel has closed.
+        """
+        for future in list(self.pending.values()) + [self.version]:
+            if not (future is None) and not future.done():
+                future.set_exception(error)
+        for _ in self.pending:
+            self.slots.release()
+        self.pending = {}
+        self.sent = {}
+        self.traces = {}
+
+    def __decode_traced(self, msg, trace):
+        """
+        Decode a response, filling in its request's request_trace and calling the hooks around the decode.
+        """
+        trace.received_at = time.perf_counter()
+        trace.bytes_in = len(msg)
+        trace.receive_thread = threading.get_ident()
+
+        hooks = list(self.hooks)
+        for hook in hooks:
+            hook.on_response(trace)
+
+        r_packet = packet(b=memoryview(msg))
+        trace.decoded_at = time.perf_counter()
+        trace.response_type = r_packet.get_FXP_type()
+        for hook in hooks:
+            hook.post_decode(trace)
+
+        return r_packet
+
+    async def __send(self, buffers, trace=None):
+        """
+        Write buffers to the channel, back to back, waiting whenever the channel can't take more.
+
+        :param trace: The request_trace of the request, if there are hooks, to note when the send starts and ends.
+        """
+        async with self.send_lock:
+            if not (trace is None):
+                trace.send_start = time.perf_counter()
+            backoff = 0.001
+            for msg in buffers:
+                view = memoryview(msg)
+                while view:
+                    try:
+                        sent = self.socket.send(view)
+                    except (socket.timeout, BlockingIOError):
+                        await self.__wait_writable(backoff)
+                        backoff = min(backoff*2, 0.05)
+                        continue
+
+                    if sent == 0:
+                        # This indicates an error or connection break
+                        raise RuntimeError("socket connection broken")
+                    view = view[sent:]
+                    backoff = 0.001
+            if not (trace is None):
+                trace.send_end = time.perf_counter()
+
+    async def __wait_writable(self, backoff):
+        """
+        Wait until the channel can take more data.
+
+        :param backoff: How long to sleep instead, for channels whose fileno() only signals reads.
+        """
+        if self.writable is None:
+            await asyncio.sleep(backoff)
+            return
+
+        fileno = self.socket.fileno()
+        self.writable.clear()
+        self.loop.add_writer(fileno, self.writable.set)
+        try:
+            await self.writable.wait()
+        finally:
+            self.loop.remove_writer(fileno)
+
+    async def submit(self, c_packet):
+        """
+        Send a request without waiting on its response. This waits only for room in the request window.
+
+        :param c_packet: The request packet. It is given this client's next id.
+        :return: An asyncio future of the response packet.
+        """
+        if self.reader is None:
+            raise RuntimeError("sftp channel is not open")
+
+        await self.slots.acquire()
+
+        c_packet.set_id(self.next_id)
+        self.next_id = (self.next_id + 1) % 4294967296
+
+        # The slot is released once the response arrives, so a cancelled request holds it while still on the wire
+        future = self.loop.create_future()
+        self.pending[c_packet.get_id()] = future
+        try:
+            hooks = list(self.hooks)
+            trace = None
+            if hooks:
+                trace = request_trace(c_packet.get_FXP_type(), c_packet.get_id())
+                trace.send_thread = threading.get_ident()
+                trace.encode_start = time.perf_counter()
+
+            buffers = c_packet.buffers()
+
+            if hooks:
+                trace.encode_end = time.perf_counter()
+                trace.bytes_out = sum(len(buffer) for buffer in buffers)
+                self.traces[c_packet.get_id()] = trace
+                for hook in hooks:
+                    hook.pre_send(trace)
+            if not (self.metrics is None):
+                self.sent[c_packet.get_id()] = (c_packet.get_FXP_type(), sum(len(buffer) for buffer in buffers),
+                                                time.monotonic())
+
+            await self.__send(buffers, trace)
+
+            for hook in hooks:
+                hook.post_send(trace)
+        except BaseException:
+            if not (self.pending.pop(c_packet.get_id(), None) is None):
+                self.slots.release()
+            self.sent.pop(c_packet.get_id(), None)
+            self.traces.pop(c_packet.get_id(), None)
+            future.cancel()
+            raise
+
+        return future
+
+    async def __request(self, c_packet):
+        """
+        Send a request and wait on its response.
+        """
+        return await (await self.submit(c_packet))
+
+    def enable_cache(self, ttl=30, max_entries=100000):
+        """
+        Cache the results of stat, lstat, canonicalize and readlink, as SFTP_client.enable_cache() does.
+
+        :return: The metadata_cache.
+        """
+        self.cache = metadata_cache(ttl, max_entries)
+
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
+
+    def enable_metrics(self, metrics=None):
+        """
+        Record the count, errors, bytes and latency of every request, as SFTP_client.enable_metrics() does.
+
+        :return: The request_metrics.
+        """
+        self.metrics = request_metrics() if metrics is None else metrics
+
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+        self.sent = {}
+
+    def add_hooks(self, hooks):
+        """
+        Call a request_hooks around every request from now on, as SFTP_client.add_hooks() does.
+
+        :return: hooks.
+        """
+        self.hooks.append(hooks)
+
+        return hooks
+
+    def remove_hooks(self, hooks):
+        self.hooks.remove(hooks)
+
+    async def __cached(self, kind, FXP_type, dir, parse):
+        """
+        Answer from the cache if possible, else send a request whose only argument is dir, and cache what parse()
+        makes of its response. A SSH_FX_NO_SUCH_FILE error is cached as well.
+        """
+        if not (self.cache is None):
+            found, value = self.cache.get(kind, dir)
+            if found:
+                if isinstance(value, SFTP_error):
+                    raise SFTP_error(str(value), value.get_status())
+                return value
+
+        try:
+            value = parse(await self.__request(path_request(FXP_type, dir)))
+        except SFTP_error as e:
+            if not (self.cache is None) and e.get_status() == FX_names["SSH_FX_NO_SUCH_FILE"]:
+                self.cache.put(kind, dir, e)
+            raise
+
+        if not (self.cache is None):
+            self.cache.put(kind, dir, value)
+
+        return value
+
+    def __invalidate(self, dir, recursive=False):
+        if not (self.cache is None):
+            self.cache.invalidate(dir, recursive)
+
+    async def __check_all(self, requests, dirs, recursive=False):
+        """
+        Send a request per path at once, and check every response.
+        """
+        try:
+            responses = await asyncio.gather(*[self.__request(c_packet) for c_packet in requests])
+            for r_packet in responses:
+                check_status(r_packet)
+        finally:
+            for dir in dirs:
+                self.__invalidate(dir, recursive)
+
+    async def create_dir(self, dir, attr = None):
+        """
+        Create a directory.
+
+        :param dir: Where to create the directory. Path is relative to user's ~.
+        :param attr: Attributes for the directory. Normally, this can be left alone.
+        :return: None
+        """
+        await self.__check_all([mkdir_request(dir, attr)], [dir])
+
+    async def create_dirs(self, dirs, attr = None):
+        """
+        Create many directories, with the requests sent at once.
+        """
+        await self.__check_all([mkdir_request(dir, attr) for dir in dirs], dirs)
+
+    async def remove_dir(self, dir):
+        """
+        Remove a directory.
+
+        :param dir: The directory to remove. Path is relative to user's ~.
+        :return: None
+        """
+        await self.__check_all([path_request("SSH_FXP_RMDIR", dir)], [dir], recursive=True)
+
+    async def remove_dirs(self, dirs):
+        """
+        Remove many directories, with the requests sent at once.
+        """
+        await self.__check_all([path_request("SSH_FXP_RMDIR", dir) for dir in dirs], dirs, recursive=True)
+
+    async def iter_dir(self, dir):
+        """
+        Iterate over the files in a directory, as the server sends them. The next batch of entries is requested
+        before the current batch is handed out.
+
+        :param dir: Directory to crawl. Path is relative to user's ~.
+        :return: An async generator of (filename, longname, attributes) tuples
+        """
+        r_packet = await self.__request(path_request("SSH_FXP_OPENDIR", dir))
+        expect(r_packet, "SSH_FXP_HANDLE")
+        handle = r_packet.get_items()[0]
+
+        try:
+            future = await self.submit(handle_request("SSH_FXP_READDIR", handle))
+
+            while True:
+                r_packet = await future
+
+                if is_eof(r_packet):
+                    break # Done reading files from folder
+                expect(r_packet, "SSH_FXP_NAME")
+
+                # Prefetch the next batch
+                future = await self.submit(handle_request("SSH_FXP_READDIR", handle))
+
+                items = r_packet.get_items()
+                for i in range(1, len(items), 3):
+                    if not (self.cache is None) and items[i] != "." and items[i] != "..":
+                        path = posixpath.join(dir, items[i])
+                        self.cache.put("lstat", path, items[i + 2])
+                        if items[i + 2].get_file_type() != "S_IFLINK":
+                            self.cache.put("stat", path, items[i + 2])
+                    yield items[i], items[i + 1], items[i + 2]
+        finally:
+            check_status(await self.__request(handle_request("SSH_FXP_CLOSE", handle)))
+
+    async def listdir(self, dir):
+        """
+        Get the file names of files in a directory.
+        """
+        return [filename async for filename, longname, attr in self.iter_dir(dir)]
+
+    async def listdir_attr(self, dir):
+        """
+        Get the attributes of files in a directory.
+        """
+        return [attr async for filename, longname, attr in self.iter_dir(dir)]
+
+    async def walk(self, root, max_open_dirs=16, onerror=None):
+        """
+        Walk a directory tree breadth first, listing up to max_open_dirs directories at once. This works as
+        SFTP_client.walk() does.
+
+        :return: An async generator of (dirpath, dirs, files) tuples, one per directory, in the order the
+        directories finish. dirs and files are arrays of (filename, attributes) tuples.
+        """
+        if self.max_open_handles:
+            max_open_dirs = min(max_open_dirs, self.max_open_handles)
+
+        waiting = collections.deque([root]) # Directories found but not yet opened
+        active = {} # Listing tasks, to the directory they list
+
+        try:
+            while waiting or active:
+                while waiting and len(active) < max_open_dirs:
+                    dirpath = waiting.popleft()
+                    active[self.loop.create_task(self.__list_dir(dirpath))] = dirpath
+
+                done, _ = await asyncio.wait(list(active), return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    dirpath = active.pop(task)
+                    try:
+                        dirs, files = task.result()
+                    except Exception as e:
+                        if not (onerror is None):
+                            onerror(dirpath, e)
+                        continue
+
+                    waiting.extend(posixpath.join(dirpath, filename) for filename, attr in dirs)
+                    yield dirpath, dirs, files
+        finally:
+            # Stop the listings still running if the walk ends early. Each closes its handle.
+            for task in active:
+                task.cancel()
+
+    async def __list_dir(self, dir):
+        """
+        List a directory, split into subdirectories and everything else.
+        """
+        dirs = []
+        files = []
+        async for filename, longname, attr in self.iter_dir(dir):
+            if filename == "." or filename == "..":
+                continue
+            if attr.get_file_type() == "S_IFDIR":
+                dirs.append((filename, attr))
+            else:
+                files.append((filename, attr))
+
+        return dirs, files
+
+    async def stat(self, dir):
+        """
+        Get the attributes of a file, following symbolic links.
+        """
+        return await self.__cached("stat", "SSH_FXP_STAT", dir, self.__attrs)
+
+    async def stat_many(self, dirs):
+        """
+        Get the attributes of many files, following symbolic links, with the requests sent at once.
+
+        :return: An array of attributes, in the same order as dirs
+        """
+        return list(await asyncio.gather(*[self.stat(dir) for dir in dirs]))
+
+    async def lstat(self, dir):
+        """
+        Get the attributes of a file, NOT following symbolic links.
+        """
+        return await self.__cached("lstat", "SSH_FXP_LSTAT", dir, self.__attrs)
+
+    async def lstat_many(self, dirs):
+        """
+        Get the attributes of many files, NOT following symbolic links, with the requests sent at once.
+
+        :return: An array of attributes, in the same order as dirs
+        """
+        return list(await asyncio.gather(*[self.lstat(dir) for dir in dirs]))
+
+    def __attrs(self, r_packet):
+        expect(r_packet, "SSH_FXP_ATTRS")
+
+        return r_packet.get_items()[0]
+
+    async def setstat(self, dir, attr):
+        """
+        Set the attributes of a file.
+        """
+        await self.__check_all([setstat_request("SSH_FXP_SETSTAT", dir, attr)], [dir])
+
+    async def __open(self, dir, pflags, attr = None):
+        """
+        Open a file, returning its handle.
+        """
+        r_packet = await self.__request(open_request(dir, pflags, attr))
+        expect(r_packet, "SSH_FXP_HANDLE")
+
+        return r_packet.get_items()[0]
+
+    async def open(self, dir, mode="r"):
+        """
+        Open a file, keeping its handle open for many reads and writes.
+
+        :param dir: File to open. Path is relative to user's ~.
+        :param mode: A Python open() mode, such as "rb", "wb", "r+" or "a".
+        :return: An async_remote_file. Use it with async with to close the handle when done.
+        """
+        handle = await self.__open(dir, mode_pflags(mode))
+
+        return async_remote_file(self, handle, dir, mode)
+
+    async def create_file(self, dir, attr = None):
+        """
+        Create a file.
+        """
+        try:
+            handle = await self.__open(dir, ["SSH_FXF_CREAT"], attr)
+            check_status(await self.__request(handle_request("SSH_FXP_CLOSE", handle)))
+        finally:
+            self.__invalidate(dir)
+
+    async def write_file(self, dir, data=None, local_path=None):
+        """
+        Write data to a file, replacing its contents. The data is written in write_chunk_size chunks, with up to
+        max_writes writes outstanding at once.
+
+        :param data: Data to write. This may be bytes, a string, or an iterable of chunks of either.
+        :param local_path: If given, the contents of this local file are written instead of data.
+        :return: The number of bytes written.
+        """
+        # Check what is to be written before the remote file is truncated
+        f = None
+        if local_path is None:
+            if data is None:
+                raise TypeError("write_file() needs data or local_path.")
+            if isinstance(data, (bytes, bytearray, memoryview, str)):
+                data = [data]
+        else:
+            f = open(local_path, "rb")
+
+        try:
+            handle = await self.__open(dir, ["SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_TRUNC"])
+
+            try:
+                if f is None:
+                    written = await self.upload(handle, data)
+                else:
+                    written = await self.upload(handle, iter(lambda: f.read(self.write_chunk_size), bytes()))
+            finally:
+                try:
+                    check_status(await self.__request(handle_request("SSH_FXP_CLOSE", handle)))
+                finally:
+                    self.__invalidate(dir)
+        finally:
+            if not (f is None):
+                f.close()
+
+        return written
+
+    async def read_file(self, dir, amount=None, offset=0, local_path=None):
+        """
+        Read a file. The file is read in read_chunk_size chunks, with up to max_reads reads outstanding at once.
+
+        :param amount: The amount to read. Default reads to the end of the file.
+        :param offset: The offset to read from.
+        :param local_path: If given, the data is streamed to this local file instead of being returned.
+        :return: The data read, or the number of bytes written to local_path.
+        """
+        handle = await self.__open(dir, ["SSH_FXF_READ"])
+
+        try:
+            if local_path is None:
+                chunks = []
+                await self.download(handle, chunks.append, offset, amount)
+                data = bytes().join(chunks)
+            else:
+                with open(local_path, "wb") as f:
+                    data = await self.download(handle, f.write, offset, amount)
+        finally:
+            check_status(await self.__request(handle_request("SSH_FXP_CLOSE", handle)))
+
+        return data
+
+    async def download(self, handle, sink, offset=0, amount=None):
+        """
+        Read from an open handle, keeping up to max_reads reads in flight, and hand the data to sink in order.
+        Short reads are topped up, as the download engine does.
+
+        :return: The number of bytes read.
+        """
+        end = None if amount is None else offset + amount
+        chunk_size = self.read_chunk_size
+        reads = collections.deque() # (offset, length, future), in offset order
+        next_offset = offset
+        received = 0
+
+        try:
+            while True:
+                while len(reads) < self.max_reads and (end is None or next_offset < end):
+                    length = chunk_size if end is None else min(chunk_size, end - next_offset)
+                    reads.append((next_offset, length, await self.submit(read_request(handle, next_offset, length))))
+                    next_offset += length
+                if not reads:
+                    break
+
+                read_offset, length, future = reads.popleft()
+                r_packet = await future
+                if is_eof(r_packet):
+                    break
+                expect(r_packet, "SSH_FXP_DATA")
+
+                data = r_packet.get_items()[0]
+                if len(data) == 0:
+                    break
+                sink(data)
+                received += len(data)
+
+                if len(data) < length:
+                    # The server caps its reads, so ask for the rest and use its size from now on
+                    chunk_size = min(chunk_size, len(data))
+                    rest_offset = read_offset + len(data)
+                    reads.appendleft((rest_offset, length - len(data),
+                                      await self.submit(read_request(handle, rest_offset, length - len(data)))))
+        finally:
+            for read_offset, length, future in reads:
+                future.cancel()
+
+        return received
+
+    async def upload(self, handle, source, offset=0):
+        """
+        Write chunks from source to an open handle, keeping up to max_writes writes in flight.
+
+        :param source: An iterable of bytes or strings.
+        :return: The number of bytes written.
+        """
+        writes = collections.deque()
+        written = 0
+
+        try:
+            for data in source:
+                if isinstance(data, str):
+                    data = data.encode("utf-8")
+                view = memoryview(data)
+
+                for i in range(0, len(view), self.write_chunk_size):
+                    chunk = view[i:i + self.write_chunk_size]
+                    while len(writes) >= self.max_writes:
+                        check_status(await writes.popleft())
+
+                    writes.append(await self.submit(write_request(handle, offset + written, chunk)))
+                    written += len(chunk)
+
+            while writes:
+                check_status(await writes.popleft())
+        finally:
+            for future in writes:
+                future.cancel()
+
+        return written
+
+    async def rename(self, dir, new_dir):
+        """
+        Rename a file or directory.
+        """
+        try:
+            check_status(await self.__request(rename_request(dir, new_dir)))
+        finally:
+            self.__invalidate(dir, recursive=True)
+            self.__invalidate(new_dir, recursive=True)
+
+    async def remove_file(self, dir):
+        """
+        Remove a file.
+        """
+        await self.__check_all([path_request("SSH_FXP_REMOVE", dir)], [dir])
+
+    async def remove_files(self, dirs):
+        """
+        Remove many files, with the requests sent at once.
+        """
+        await self.__check_all([path_request("SSH_FXP_REMOVE", dir) for dir in dirs], dirs)
+
+    async def symlink(self, dir, link_to):
+        """
+        Create a symbolic link at dir, pointing to link_to.
+        """
+        await self.__check_all([symlink_request(dir, link_to)], [dir])
+
+    async def readlink(self, dir):
+        """
+        Read a symbolic link.
+        """
+        return await self.__cached("readlink", "SSH_FXP_READLINK", dir, self.__name)
+
+    async def canonicalize(self, dir):
+        """
+        Canonicalize a path.
+        """
+        return await self.__cached("canonicalize", "SSH_FXP_REALPATH", dir, self.__name)
+
+    def __name(self, r_packet):
+        expect(r_packet, "SSH_FXP_NAME")
+
+        return r_packet.get_items()[1]
+
+class async_remote_file():
+    """
+    A file object over an open SFTP handle, for AsyncSFTPClient.open().
+
+    read() and write() are pipelined like read_file() and write_file(), and wait until they are done. There is no
+    read-ahead or write-behind buffering between calls, so read and write in large pieces.
+    """
+
+    def __init__(self, client, handle, path, mode="r"):
+        self.client = client
+        self.handle = handle
+        self.path = path
+        self.mode = mode
+        self.position = None if "a" in mode else 0 # Appends start at the end, found on first use
+        self.closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    def readable(self):
+        return "r" in self.mode or "+" in self.mode
+
+    def writable(self):
+        return not (self.mode.startswith("r") and not "+" in self.mode)
+
+    async def tell(self):
+        if self.position is None:
+            self.position = (await self.stat()).get_size()
+
+        return self.position
+
+    async def seek(self, offset, whence=0):
+        """
+        Move the file position.
+
+        :param whence: 0 for the start of the file, 1 for the current position, 2 for the end of the file.
+        :return: The new position.
+        """
+        if whence == 1:
+            offset += await self.tell()
+        elif whence == 2:
+            offset += (await self.stat()).get_size()
+        if offset < 0:
+            raise ValueError("negative seek position " + str(offset))
+        self.position = offset
+
+        return self.position
+
+    async def read(self, size=-1):
+        """
+        Read up to size bytes. Reads to the end of the file if size is negative.
+        """
+        self.__check_open()
+        if not self.readable():
+            raise io.UnsupportedOperation("File not open for reading")
+
+        chunks = []
+        position = await self.tell()
+        self.position += await self.client.download(self.handle, chunks.append, position,
+                                                    None if size < 0 else size)
+
+        return bytes().join(chunks)
+
+    async def write(self, data):
+        """
+        Write data at the file position.
+
+        :return: The number of bytes written.
+        """
+        self.__check_open()
+        if not self.writable():
+            raise io.UnsupportedOperation("File not open for writing")
+
+        position = await self.tell()
+        written = await self.client.upload(self.handle, [data], position)
+        self.position += written
+
+        return written
+
+    async def stat(self):
+        """
+        Get the attributes of the open file, via SSH_FXP_FSTAT.
+        """
+        r_packet = await (await self.client.submit(handle_request("SSH_FXP_FSTAT", self.handle)))
+        expect(r_packet, "SSH_FXP_ATTRS")
+
+        return r_packet.get_items()[0]
+
+    async def setstat(self, attr):
+        """
+        Set the attributes of the open file, via SSH_FXP_FSETSTAT.
+        """
+        check_status(await (await self.client.submit(setstat_request("SSH_FXP_FSETSTAT", self.handle, attr))))
+
+    async def truncate(self, size=None):
+        """
+        Resize the file. Defaults to the current position.
+        """
+        if not self.writable():
+            raise io.UnsupportedOperation("File not open for writing")
+        if size is None:
+            size = await self.tell()
+        await self.setstat(attributes(size=size))
+
+        return size
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        try:
+            check_status(await (await self.client.submit(handle_request("SSH_FXP_CLOSE", self.handle))))
+        finally:
+            if not (self.client.cache is None):
+                self.client.cache.invalidate(self.path)
+
+    def __check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
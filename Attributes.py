@@ -1,9 +1,14 @@
 # Import stuff
-import Packet
+import struct
 
 # Define global vars
 pinkie_pie = "was here"
 
+# Precompiled encoders
+UINT32 = struct.Struct(">I")
+UINT64 = struct.Struct(">Q")
+PAIR = struct.Struct(">II") # uid and gid, or atime and mtime
+
 # Used by SFTP to denote what is included in an attribute object.
 FILEXFER_names = {
     "SSH_FILEXFER_ATTR_SIZE":        0x00000001, # Has size only
@@ -61,16 +66,21 @@ class attributes():
                so that number of pairs equals extended_count
     """
 
+    # Listings can hold millions of these, so they carry no per-instance __dict__.
+    __slots__ = ("size", "uid", "gid", "permissions", "atime", "mtime", "extended_type", "extended_data",
+                 "byte_length")
+
     def __init__(self, size = None, uid = None, gid = None, permissions = None, atime = None,
-                 mtime = None, extended_type = [], extended_data = [], b = None):
+                 mtime = None, extended_type = None, extended_data = None, b = None):
         self.size = size
         self.uid = uid
         self.gid = gid
         self.permissions = permissions
         self.atime = atime
         self.mtime = mtime
-        self.extended_type = extended_type
-        self.extended_data = extended_data
+        # No extensions share one empty tuple. Extensions get their own lists.
+        self.extended_type = () if extended_type is None else list(extended_type)
+        self.extended_data = () if extended_data is None else list(extended_data)
 
         self.byte_length = None # Only used when decoding attributes
 
@@ -80,6 +90,16 @@ class attributes():
     def get_byte_length(self):
         return self.byte_length
 
+    def copy(self):
+        """
+        :return: A new attributes object with the same fields, sharing no lists with this one.
+        """
+        copy = attributes(self.size, self.uid, self.gid, self.permissions, self.atime, self.mtime,
+                          self.extended_type or None, self.extended_data or None)
+        copy.byte_length = self.byte_length
+
+        return copy
+
     def get_flags(self):
         """
         Construct and return the flags 8-digit decimal code.
@@ -88,13 +108,13 @@ class attributes():
 
         if not (self.size is None):
             flags += FILEXFER_names["SSH_FILEXFER_ATTR_SIZE"]
-        if not (self.uid is None) and not (self.gid != None):
+        if not (self.uid is None) and not (self.gid is None):
             flags += FILEXFER_names["SSH_FILEXFER_ATTR_UIDGID"]
         if not (self.permissions is None):
             flags += FILEXFER_names["SSH_FILEXFER_ATTR_PERMISSIONS"]
         if not (self.atime is None) and not (self.mtime is None):
             flags += FILEXFER_names["SSH_FILEXFER_ATTR_ACMODTIME"]
-        if self.extended_type != [] and self.extended_data != []:
+        if self.extended_type and self.extended_data:
             flags += FILEXFER_names["SSH_FILEXFER_ATTR_EXTENDED"]
 
         return flags
@@ -160,86 +180,134 @@ class attributes():
         """
         Get the bytes representing this attributes object.
         """
-        msg = bytearray()
+        msg = bytearray(self.encoded_length())
+        self.encode_into(msg, 0)
 
+        return msg
+
+    def encoded_length(self):
+        """
+        Get the number of bytes this attributes object encodes to.
+        """
+        length = 4
+
+        if not (self.size is None):
+            length += 8
+        if not (self.uid is None) and not (self.gid is None):
+            length += 8
+        if not (self.permissions is None):
+            length += 4
+        if not (self.atime is None) and not (self.mtime is None):
+            length += 8
+        if self.extended_type and self.extended_data:
+            length += 4
+            for type, data in zip(self.extended_type, self.extended_data):
+                length += 8 + len(type.encode("utf-8")) + len(data.encode("utf-8"))
+
+        return length
+
+    def encode_into(self, buf, offset):
+        """
+        Encode this attributes object into a preallocated buffer.
+
+        :param buf: The buffer to write to.
+        :param offset: Where in the buffer to write.
+        :return: The offset just past the encoded attributes.
+        """
         # Attach attribute flags
-        msg += Packet.bittify(self.get_flags(), 4)
+        UINT32.pack_into(buf, offset, self.get_flags())
+        offset += 4
 
         # Attach attribute properties
         if not (self.size is None):
-            msg += Packet.bittify(self.size, 8)
+            UINT64.pack_into(buf, offset, self.size)
+            offset += 8
         if not (self.uid is None) and not (self.gid is None):
-            msg += Packet.bittify(self.uid, 4)
-            msg += Packet.bittify(self.gid, 4)
+            PAIR.pack_into(buf, offset, self.uid, self.gid)
+            offset += 8
         if not (self.permissions is None):
-            msg += Packet.bittify(self.permissions, 4)
+            UINT32.pack_into(buf, offset, self.permissions)
+            offset += 4
         if not (self.atime is None) and not (self.mtime is None):
-            msg += Packet.bittify(self.atime, 4)
-            msg += Packet.bittify(self.mtime, 4)
+            PAIR.pack_into(buf, offset, self.atime, self.mtime)
+            offset += 8
 
         # Attach extensions
-        if self.extended_type != [] and self.extended_data != []:
+        if self.extended_type and self.extended_data:
+            UINT32.pack_into(buf, offset, len(self.extended_type))
+            offset += 4
             for type, data in zip(self.extended_type, self.extended_data):
-                msg += Packet.bittify(type)
-                msg += Packet.bittify(data)
+                for string in (type.encode("utf-8"), data.encode("utf-8")):
+                    UINT32.pack_into(buf, offset, len(string))
+                    buf[offset + 4:offset + 4 + len(string)] = string
+                    offset += 4 + len(string)
 
-        return msg
+        return offset
 
-    def decode(self, b):
+    def decode(self, b, offset=0):
         """
-        Given a bytes object that starts with an encoded attributes object, extract the attributes object,
+        Given a buffer holding an encoded attributes object at offset, extract the attributes object,
         and store its byte length.
+
+        The buffer is read in place, so a whole NAME response can be decoded entry by entry without copies.
+
+        :param b: A bytes-like object.
+        :param offset: Where the attributes object starts in b.
+        :return: The offset just past the attributes object.
         """
         # Check what is included in this attributes file
-        flags = int.from_bytes(b[0:4], byteorder='big', signed=False)
+        i = offset
+        flags = UINT32.unpack_from(b, i)[0]
+        i += 4
 
         # Use FILEXFER_names as a guide
         has_size = flags&1 == 1
         has_uidgid = flags&2 == 2
         has_permissions = flags&4 == 4
         has_acmodtime = flags&8 == 8
-        has_extended = flags&16 == 16
+        has_extended = flags&FILEXFER_names["SSH_FILEXFER_ATTR_EXTENDED"] != 0
 
         # Extract the easy ints
-        i = 4
         if has_size:
-            self.size = int.from_bytes(b[i:i+8], byteorder='big', signed=False)
+            self.size = UINT64.unpack_from(b, i)[0]
             i += 8
         if has_uidgid:
-            self.uid = int.from_bytes(b[i:i+4], byteorder='big', signed=False)
-            self.gid = int.from_bytes(b[i+4:i+8], byteorder='big', signed=False)
+            self.uid, self.gid = PAIR.unpack_from(b, i)
             i += 8
         if has_permissions:
-            self.permissions = int.from_bytes(b[i:i+4], byteorder='big', signed=False)
+            self.permissions = UINT32.unpack_from(b, i)[0]
             i += 4
         if has_acmodtime:
-            self.atime = int.from_bytes(b[i:i+4], byteorder='big', signed=False)
-            self.mtime = int.from_bytes(b[i+4:i+8], byteorder='big', signed=False)
+            self.atime, self.mtime = PAIR.unpack_from(b, i)
             i += 8
 
         # Get the extensions (if included)
         if has_extended:
-            num_extensions = int.from_bytes(b[i:i+4], byteorder='big', signed=False)
-            i+= 4
+            num_extensions = UINT32.unpack_from(b, i)[0]
+            i += 4
 
-            for extension in range(1, num_extensions):
-                string_len = int.from_bytes(b[i:i+4], byteorder='big', signed=False)
-                type = b[i+4:i+4+string_len].decode("utf-8")
+            self.extended_type = []
+            self.extended_data = []
+
+            for extension in range(num_extensions):
+                string_len = UINT32.unpack_from(b, i)[0]
+                type = str(b[i+4:i+4+string_len], "utf-8")
 
                 self.extended_type.append(type)
 
                 i += 4 + string_len
 
-                string_len = int.from_bytes(b[i:i + 4], byteorder='big', signed=False)
-                data = b[i+4:i+4+string_len].decode("utf-8")
-
+                string_len = UINT32.unpack_from(b, i)[0]
+                data = str(b[i+4:i+4+string_len], "utf-8")
 
                 self.extended_data.append(data)
 
                 i += 4 + string_len
 
         # Record byte length for parsing purposes
-        self.byte_length = i
+        self.byte_length = i - offset
+
+        return i
 
     def FILEXFER_type_name(self, FILEXFER_id):
         """
@@ -261,7 +329,7 @@ class attributes():
         has_uidgid = flags&2 == 2
         has_permissions = flags&4 == 4
         has_acmodtime = flags&8 == 8
-        has_extended = flags&16 == 16
+        has_extended = flags&FILEXFER_names["SSH_FILEXFER_ATTR_EXTENDED"] != 0
 
         to_return += "\tAttributes"
         to_return += "\n\tFlags: " + str(flags)
@@ -7,6 +7,8 @@ It is assumed that both the file test_file and weird_directory exist.
 from SFTP_Client import SFTP_client
 from Attributes import attributes
 
+import logging
+
 # Global vars
 IP = "Some_IP"
 username = "Some_SSH_user"
@@ -16,6 +18,10 @@ password = None
 test_file = "rock"
 weird_directory = "~/../sftp/test/../rock"
 
+# Show every packet sent and received. Use Packet.TRACE instead of DEBUG to see their bytes too.
+logging.basicConfig()
+logging.getLogger("SFTP3").setLevel(logging.DEBUG)
+
 # Start an SFTP connection
 s = SFTP_client(IP, username=username, password=password, key_filename=key_filename)
 print("ls: " + s.pipe_command("ls")) # Unnecessary, but nice for checking the network connection.
@@ -23,7 +29,7 @@ print("ls: " + s.pipe_command("ls")) # Unnecessary, but nice for checking the ne
 # Test our SFTP project
 print("\nInitialization\n")
 
-s.open_sftp_channel(max_packet_size=2048)
+s.open_sftp_channel()
 
 print("\nDirectories\n")
 
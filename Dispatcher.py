@@ -0,0 +1,452 @@
+"""
+Use request_dispatcher to keep many SFTP requests in flight on one channel.
+"""
+# Handle imports
+from Packet import packet, UINT32
+from Tracing import request_trace
+
+import collections
+import threading
+import time
+
+# Define global vars
+# Priority classes, most urgent first. Requests in an earlier class are always sent before ones in a later class.
+PRIORITIES = ("metadata", "bulk")
+
+# Requests that move file data. They go in the "bulk" class by default, and count against the bandwidth limit.
+bulk_types = ("SSH_FXP_READ", "SSH_FXP_WRITE")
+
+# Requests whose first item is a handle. They are never sent ahead of requests still queued on the same handle.
+handle_types = ("SSH_FXP_CLOSE", "SSH_FXP_READ", "SSH_FXP_WRITE", "SSH_FXP_FSTAT", "SSH_FXP_FSETSTAT",
+                "SSH_FXP_READDIR")
+
+# Define classes
+class request_future():
+    """
+    The pending response to a single SFTP request.
+
+    Use request_future.result() to get the response packet. Waiting on a result reads responses off the
+    channel, handing each one to the future with the matching id, until this future's response arrives.
+
+    sent_at and received_at are the time.monotonic() times the request was sent and its response was read off
+    the channel.
+    """
+
+    def __init__(self, dispatcher, id, FXP_type=None):
+        self.dispatcher = dispatcher
+        self.id = id
+        self.FXP_type = FXP_type # The FXP_name of the request
+        self.response = None
+        self.error = None
+        self.priority = "metadata" # The class the request was scheduled in
+        self.sent_at = None
+        self.received_at = None
+        self.bytes_out = 0 # The size of the request, only counted when metrics or hooks are on
+        self.trace = None # The request_trace, if hooks were on when the request was sent
+        self.charge = None # (token_bucket, tokens) taken to send the request, if it was charged for bandwidth
+
+    def get_id(self):
+        return self.id
+
+    def get_rtt(self):
+        """
+        Get the round trip time of the request, in seconds, or None if it has not been answered.
+        """
+        if self.sent_at is None or self.received_at is None:
+            return None
+
+        return self.received_at - self.sent_at
+
+    def done(self):
+        return not (self.response is None and self.error is None)
+
+    def set_result(self, r_packet):
+        self.response = r_packet
+
+    def set_error(self, error):
+        self.error = error
+
+    def result(self):
+        """
+        Wait for and return the response packet.
+        """
+        while not self.done():
+            self.dispatcher.read_response(self.done)
+
+        if not (self.error is None):
+            raise self.error
+
+        return self.response
+
+class token_bucket():
+    """
+    A token bucket bandwidth limit. It may be shared by several dispatchers, such as every session in a pool.
+
+    Tokens are bytes. They refill at rate bytes per second, up to burst. A request may be sent whenever the bucket
+    is not empty, and its cost is taken even if that leaves the bucket in debt, so requests larger than burst are
+    still sent, just spaced out. Tokens taken for bytes that never moved, such as a short read, can be refunded.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        """
+        :param rate: The bandwidth limit, in bytes per second.
+        :param burst: The most bytes that may be sent at once after a quiet spell. Defaults to a tenth of a
+        second's worth.
+        :param clock: Returns the current time, in seconds.
+        """
+        self.rate = float(rate)
+        self.burst = rate / 10.0 if burst is None else float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+
+    def take(self, cost):
+        """
+        Take cost tokens if the bucket is not empty.
+
+        :return: 0 if the tokens were taken, else the number of seconds until they can be.
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at)*self.rate)
+            self.updated_at = now
+
+            if self.tokens <= 0:
+                return -self.tokens/self.rate + 0.001
+
+            self.tokens -= cost
+            return 0
+
+    def refund(self, amount):
+        """
+        Give back tokens that were taken but not used.
+        """
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + amount)
+
+class request_dispatcher():
+    """
+    A request multiplexer and scheduler for a single SFTP channel. It is safe to share between threads.
+
+    Responses are routed back to their request_future by request id. Ids are handed out per dispatcher, so they
+    never clash on the channel.
+
+    At most max_requests requests are in flight at once. Requests past that wait in a queue per priority class,
+    and whenever a slot frees up, the most urgent class goes first. By default, requests that move file data are
+    "bulk", and everything else is "metadata", so a stat is never stuck behind a long transfer. Bulk requests never
+    take the last metadata_slots slots. Within a class, each flow, such as each open file, takes its turn, so
+    concurrent transfers share the channel fairly. A request on a handle with bulk requests still queued, such as
+    its SSH_FXP_CLOSE, is queued behind them, since servers may reuse the handle once it is closed. If a
+    token_bucket is set as bucket, bulk requests also wait for its tokens. A read is charged the length it asks
+    for, and whatever the server doesn't return, such as past the end of the file, is refunded. A request that
+    fails to send, or is failed by fail_all(), is refunded in full.
+
+    If a request_metrics is set as metrics, every answered request is recorded in it. Any request_hooks in hooks
+    are called around every request sent while they are there.
+
+    Requests are sent under a lock so their bytes are never interleaved. Only one thread reads the channel at a
+    time. Whichever thread is waiting on a response reads the next one off the channel, hands it to its future
+    and sends whatever requests that frees up, while any other waiting threads sleep until it is done.
+    """
+
+    def __init__(self, send, recv, max_requests=64, metadata_slots=4, bucket=None):
+        """
+        :param send: Callable that sends buffers to the server, back to back.
+        :param recv: Callable that returns the bytes of the next packet from the server.
+        :param max_requests: The maximum number of requests in flight.
+        :param metadata_slots: The number of slots bulk requests leave free for metadata requests.
+        :param bucket: A token_bucket to limit the bandwidth of bulk requests with.
+        """
+        self.send = send
+        self.recv = recv
+        self.max_requests = max_requests
+        self.metadata_slots = metadata_slots
+        self.bucket = bucket
+        self.metrics = None # A request_metrics to record answered requests in, if any
+        self.hooks = [] # request_hooks to call around every request
+        self.pending = {} # Outstanding request_futures, sent or queued, by id
+        self.next_id = 1
+
+        self.queues = {priority: collections.OrderedDict() for priority in PRIORITIES} # flow -> deque of requests
+        self.queued = 0
+        self.in_flight = {priority: 0 for priority in PRIORITIES}
+        self.wake_at = None # When the bucket will next have tokens for a queued request
+
+        self.send_lock = threading.Lock() # Held while a request is being sent
+        self.condition = threading.Condition() # Guards everything but send and recv
+        self.reading = False # Whether a thread is reading a response off the channel
+
+    def get_outstanding(self):
+        return len(self.pending)
+
+    def get_queued(self):
+        return self.queued
+
+    def submit(self, c_packet, priority=None, flow=None):
+        """
+        Send a request without waiting on its response, or queue it if there is no room to send it yet.
+
+        :param c_packet: The request. It is given this dispatcher's next id.
+        :param priority: One of PRIORITIES. Defaults to "bulk" for reads and writes, and "metadata" otherwise.
+        :param flow: What the request shares its class fairly with. Defaults to the handle the request is on.
+        :return: A request_future for the response.
+        """
+        FXP_type = c_packet.get_FXP_type()
+        if priority is None:
+            priority = "bulk" if FXP_type in bulk_types else "metadata"
+        if flow is None and FXP_type in handle_types:
+            flow = bytes(c_packet.get_items()[0])
+
+        # The bandwidth a request costs is the file data it moves
+        cost = 0
+        if FXP_type == "SSH_FXP_READ":
+            cost = c_packet.get_items()[2]
+        elif FXP_type == "SSH_FXP_WRITE":
+            cost = len(c_packet.get_items()[2])
+
+        with self.condition:
+            c_packet.set_id(self.next_id)
+            self.next_id = (self.next_id + 1) % 4294967296
+            future = request_future(self, c_packet.get_id(), FXP_type)
+            if priority != "bulk" and FXP_type in handle_types and flow in self.queues["bulk"]:
+                priority = "bulk"
+            future.priority = priority
+            self.pending[future.get_id()] = future
+
+            self.queues[priority].setdefault(flow, collections.deque()).append((future, c_packet, cost))
+            self.queued += 1
+            batch = self.__schedule()
+
+        self.__send_batch(batch)
+
+        return future
+
+    def __schedule(self):
+        """
+        Take every queued request that may be sent now, most urgent first, and count them as in flight. Called
+        under the lock.
+
+        :return: The requests to send.
+        """
+        batch = []
+        total = sum(self.in_flight.values())
+        self.wake_at = None
+
+        for priority in PRIORITIES:
+            flows = self.queues[priority]
+            limit = self.max_requests if priority == "metadata" else self.max_requests - self.metadata_slots
+            limit = max(1, limit)
+
+            while flows and total < self.max_requests and self.in_flight[priority] < limit:
+                flow, requests = next(iter(flows.items()))
+                future, c_packet, cost = requests[0]
+
+                if cost and not (self.bucket is None):
+                    wait = self.bucket.take(cost)
+                    if wait:
+                        self.wake_at = time.monotonic() + wait
+                        break
+                    future.charge = (self.bucket, cost)
+
+                # Send it, and send the next flow's request next time
+                requests.popleft()
+                del flows[flow]
+                if requests:
+                    flows[flow] = requests
+                self.queued -= 1
+                self.in_flight[priority] += 1
+                total += 1
+                batch.append((future, c_packet))
+
+        return batch
+
+    def __send_batch(self, batch):
+        """
+        Send requests taken off the queue. A request that fails to send fails its future.
+        """
+        for future, c_packet in batch:
+            try:
+                if self.hooks:
+                    self.__send_traced(future, c_packet, list(self.hooks))
+                    continue
+
+                buffers = c_packet.buffers()
+                if not (self.metrics is None):
+                    future.bytes_out = sum(len(buffer) for buffer in buffers)
+
+                with self.send_lock:
+                    future.sent_at = time.monotonic()
+                    self.send(*buffers)
+            except Exception as e:
+                with self.condition:
+                    if not (self.pending.pop(future.get_id(), None) is None):
+                        self.in_flight[future.priority] -= 1
+                        self.__refund(future)
+                        future.set_error(e)
+                    self.condition.notify_all()
+
+    def __send_traced(self, future, c_packet, hooks):
+        """
+        Send a request, filling in a request_trace for it and calling the hooks around the send.
+        """
+        trace = request_trace(future.FXP_type, future.get_id())
+        trace.send_thread = threading.get_ident()
+        future.trace = trace
+
+        trace.encode_start = time.perf_counter()
+        buffers = c_packet.buffers()
+        trace.encode_end = time.perf_counter()
+        trace.bytes_out = future.bytes_out = sum(len(buffer) for buffer in buffers)
+        for hook in hooks:
+            hook.pre_send(trace)
+
+        with self.send_lock:
+            future.sent_at = time.monotonic()
+            trace.send_start = time.perf_counter()
+            self.send(*buffers)
+            trace.send_end = time.perf_counter()
+
+        for hook in hooks:
+            hook.post_send(trace)
+
+    def __decode_traced(self, msg):
+        """
+        Decode a response, filling in its request's request_trace and calling the hooks around the decode.
+        """
+        received_at = time.perf_counter()
+
+        trace = None
+        if len(msg) >= 9:
+            with self.condition:
+                future = self.pending.get(UINT32.unpack_from(msg, 5)[0])
+            if not (future is None):
+                trace = future.trace
+        if trace is None:
+            # Sent before the hooks were added
+            return packet(b=msg)
+
+        trace.received_at = received_at
+        trace.bytes_in = len(msg)
+        trace.receive_thread = threading.get_ident()
+        if trace.send_end is None:
+            # Another thread read the response before the sending thread got to note the send was done
+            trace.send_end = received_at
+
+        hooks = list(self.hooks)
+        for hook in hooks:
+            hook.on_response(trace)
+
+        r_packet = packet(b=msg)
+        trace.decoded_at = time.perf_counter()
+        trace.response_type = r_packet.get_FXP_type()
+        for hook in hooks:
+            hook.post_decode(trace)
+
+        return r_packet
+
+    def __refund(self, future, used=0):
+        """
+        Give back the bandwidth tokens a request was charged, less the bytes it actually moved.
+        """
+        if future.charge is None:
+            return
+
+        bucket, cost = future.charge
+        future.charge = None
+        if used < cost:
+            bucket.refund(cost - used)
+
+    def __is_idle(self):
+        return not self.pending
+
+    def read_response(self, until=None):
+        """
+        Read one response off the channel and hand it to the future waiting on it, then send what it frees up. If
+        another thread is already reading, wait for it to hand out a response instead. If every outstanding
+        request is queued on the bandwidth limit, wait for it instead. If reading fails, every outstanding request
+        fails with the same error.
+
+        :param until: If given, return straight away once until() is true. It is checked under the lock, so no
+        response can be missed between checking it and waiting.
+        """
+        with self.condition:
+            if not (until is None) and until():
+                return
+            if self.reading:
+                self.condition.wait()
+                return
+            if self.queued and not sum(self.in_flight.values()):
+                # Nothing will arrive until something is sent
+                if not (self.wake_at is None):
+                    self.condition.wait(max(0, self.wake_at - time.monotonic()))
+                batch = self.__schedule()
+                read = False
+            else:
+                self.reading = True
+                read = True
+
+        if not read:
+            self.__send_batch(batch)
+            return
+
+        try:
+            try:
+                msg = self.recv()
+            except BaseException as e:
+                # The stream is broken part way through a packet, so nothing outstanding will be answered
+                self.fail_all(e if isinstance(e, Exception) else RuntimeError("reading a response was interrupted"))
+                raise
+            received_at = time.monotonic()
+            if self.hooks:
+                r_packet = self.__decode_traced(msg)
+            else:
+                r_packet = packet(b=msg)
+        except BaseException:
+            with self.condition:
+                self.reading = False
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            self.reading = False
+            self.condition.notify_all()
+
+            waiting = self.pending.pop(r_packet.get_id(), None)
+            if waiting is None:
+                raise Exception("Got a response to unknown request " + str(r_packet.get_id()) + ".")
+            waiting.received_at = received_at
+            # Recorded before the result is handed over, so whoever waits on it sees it counted
+            if not (self.metrics is None):
+                self.metrics.record(waiting.FXP_type, r_packet, waiting.bytes_out, len(msg), waiting.get_rtt())
+            waiting.set_result(r_packet)
+
+            if not (waiting.charge is None) and waiting.FXP_type == "SSH_FXP_READ":
+                self.__refund(waiting, len(r_packet.get_items()[0]) if r_packet.get_FXP_type() == "SSH_FXP_DATA" else 0)
+
+            self.in_flight[waiting.priority] -= 1
+            batch = self.__schedule()
+
+        self.__send_batch(batch)
+
+    def drain(self):
+        """
+        Wait on every outstanding request.
+        """
+        while self.pending:
+            self.read_response(self.__is_idle)
+
+    def fail_all(self, error):
+        """
+        Fail every outstanding request, such as when the channel they were sent on has closed.
+        """
+        with self.condition:
+            for future in self.pending.values():
+                self.__refund(future)
+                future.set_error(error)
+            self.pending = {}
+            for priority in PRIORITIES:
+                self.queues[priority].clear()
+                self.in_flight[priority] = 0
+            self.queued = 0
+            self.condition.notify_all()
@@ -0,0 +1,126 @@
+"""
+A cache of remote file metadata, for SFTP_client.enable_cache().
+"""
+# Handle imports
+import collections
+import posixpath
+import threading
+import time
+
+from Attributes import attributes
+
+# Define classes
+class metadata_cache():
+    """
+    A cache of stat, lstat, canonicalize and readlink results, keyed by kind and path. Paths are normalized, so
+    "./a", "a" and "dir/../a" are the same entry.
+
+    Entries expire ttl seconds after they are stored. Once max_entries entries are held, the least recently used
+    entry is evicted. Errors, such as SSH_FX_NO_SUCH_FILE, may be cached like any other result.
+
+    Attributes are copied as they are stored and again as they are looked up, so a caller that changes a result
+    doesn't change it for everyone else.
+
+    hits and misses count lookups that were and were not answered from the cache. It is safe to share between
+    threads.
+    """
+
+    kinds = ("stat", "lstat", "canonicalize", "readlink")
+
+    def __init__(self, ttl=30, max_entries=100000, clock=time.monotonic):
+        """
+        :param ttl: How long entries are kept, in seconds.
+        :param max_entries: The most entries held at once.
+        :param clock: Returns the current time, in seconds.
+        """
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self.entries = collections.OrderedDict() # (kind, path) -> (expiry time, value), least recently used first
+        self.lock = threading.Lock() # Guards entries and the counters
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, kind, path):
+        """
+        Look up a result.
+
+        :return: (True, value) on a hit, else (False, None).
+        """
+        key = (kind, posixpath.normpath(path))
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] <= self.clock():
+                if not (entry is None):
+                    del self.entries[key]
+                self.misses += 1
+                return False, None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, self.__detach(entry[1])
+
+    def put(self, kind, path, value):
+        """
+        Store a result.
+        """
+        key = (kind, posixpath.normpath(path))
+        value = self.__detach(value)
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __detach(self, value):
+        """
+        :return: A copy of value if it is attributes, which callers may change, else value itself.
+        """
+        if isinstance(value, attributes):
+            return value.copy()
+
+        return value
+
+    def invalidate(self, path, recursive=False):
+        """
+        Forget every result for a path.
+
+        :param path: The path that changed.
+        :param recursive: Also forget every result for paths under path, such as after a directory is renamed.
+        """
+        path = posixpath.normpath(path)
+        with self.lock:
+            for kind in self.kinds:
+                self.entries.pop((kind, path), None)
+
+            if recursive:
+                if path == ".":
+                    # Every relative path is under the home directory
+                    under = lambda key: not key[1].startswith("/")
+                else:
+                    prefix = path.rstrip("/") + "/"
+                    under = lambda key: key[1].startswith(prefix)
+                for key in [key for key in self.entries if under(key)]:
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        """
+        Get the cache counters.
+
+        :return: A dictionary of hits, misses, evictions and the number of entries held.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.entries)
+        }
@@ -0,0 +1,193 @@
+"""
+Use request_metrics to see where the time goes on a connection, per request type.
+"""
+# Handle imports
+from Packet import FX_names
+
+import bisect
+import http.server
+import threading
+
+# Define global vars
+# Upper bounds of the latency histogram buckets, in seconds. Anything slower is only counted in +Inf.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+FX_types = {value: name for name, value in FX_names.items()} # FX status code -> FX_name
+
+# Statuses that are answers rather than errors
+not_errors = ("SSH_FX_OK", "SSH_FX_EOF")
+
+# Define classes
+class request_metrics():
+    """
+    Counts, errors, bytes and latency for each request type. It is safe to share between threads, so one
+    request_metrics can collect for many clients, such as every session in an SFTPPool.
+
+    Request types are named without their SSH_FXP_ prefix, such as "READ" or "STAT". For each one, it records:
+    count, the number of responses.
+    errors, the number of SSH_FXP_STATUS responses by FX_name. SSH_FX_OK and SSH_FX_EOF are not errors.
+    bytes_out and bytes_in, the bytes of the requests and responses, headers included.
+    latency, a histogram of the seconds between sending a request and reading its response off the channel.
+
+    Use snapshot() to read the numbers, to_prometheus() to get them in the Prometheus text format, or serve() to
+    export them over HTTP.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: The upper bounds of the latency histogram buckets, in seconds, in increasing order.
+        """
+        self.buckets = tuple(buckets)
+        self.operations = {} # Request type -> operation_metrics
+        self.lock = threading.Lock() # Guards operations
+
+    def record(self, FXP_type, r_packet, bytes_out, bytes_in, latency):
+        """
+        Record one answered request.
+
+        :param FXP_type: The FXP_name of the request.
+        :param r_packet: The response packet.
+        :param bytes_out: The size of the request, in bytes.
+        :param bytes_in: The size of the response, in bytes.
+        :param latency: Seconds from sending the request to reading its response, or None if unknown.
+        """
+        error = None
+        if r_packet.get_FXP_type() == "SSH_FXP_STATUS":
+            status = r_packet.get_items()[0]
+            error = FX_types.get(status, str(status))
+            if error in not_errors:
+                error = None
+
+        name = FXP_type[8:] if FXP_type.startswith("SSH_FXP_") else FXP_type
+        with self.lock:
+            operation = self.operations.get(name)
+            if operation is None:
+                operation = self.operations[name] = operation_metrics(len(self.buckets))
+
+            operation.count += 1
+            operation.bytes_out += bytes_out
+            operation.bytes_in += bytes_in
+            if not (error is None):
+                operation.errors[error] = operation.errors.get(error, 0) + 1
+            if not (latency is None):
+                operation.latency_counts[bisect.bisect_left(self.buckets, latency)] += 1
+                operation.latency_sum += latency
+
+    def snapshot(self):
+        """
+        Get a copy of the numbers so far.
+
+        :return: A dictionary of request type to a dictionary of count, errors, bytes_out, bytes_in and latency.
+        latency holds sum, count and buckets, a list of (upper bound, cumulative count) ending with float("inf").
+        """
+        with self.lock:
+            snapshot = {}
+            for name, operation in self.operations.items():
+                buckets = []
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), operation.latency_counts):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+
+                snapshot[name] = {
+                    "count": operation.count,
+                    "errors": dict(operation.errors),
+                    "bytes_out": operation.bytes_out,
+                    "bytes_in": operation.bytes_in,
+                    "latency": {"sum": operation.latency_sum, "count": cumulative, "buckets": buckets}
+                }
+
+            return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.operations = {}
+
+    def to_prometheus(self, prefix="sftp3"):
+        """
+        Get the numbers in the Prometheus text exposition format.
+
+        :param prefix: The prefix of every metric name.
+        :return: A str.
+        """
+        snapshot = self.snapshot()
+        lines = []
+
+        def family(name, kind, help):
+            lines.append("# HELP " + prefix + "_" + name + " " + help)
+            lines.append("# TYPE " + prefix + "_" + name + " " + kind)
+
+        family("requests_total", "counter", "SFTP requests answered, by request type.")
+        for name, operation in sorted(snapshot.items()):
+            lines.append(prefix + '_requests_total{type="' + name + '"} ' + str(operation["count"]))
+
+        family("request_errors_total", "counter", "SFTP requests answered with an error status, by request type "
+                                                  "and status.")
+        for name, operation in sorted(snapshot.items()):
+            for status, count in sorted(operation["errors"].items()):
+                lines.append(prefix + '_request_errors_total{type="' + name + '",status="' + status + '"} ' +
+                             str(count))
+
+        family("request_bytes_total", "counter", "Bytes of SFTP requests sent, by request type.")
+        for name, operation in sorted(snapshot.items()):
+            lines.append(prefix + '_request_bytes_total{type="' + name + '"} ' + str(operation["bytes_out"]))
+
+        family("response_bytes_total", "counter", "Bytes of SFTP responses received, by request type.")
+        for name, operation in sorted(snapshot.items()):
+            lines.append(prefix + '_response_bytes_total{type="' + name + '"} ' + str(operation["bytes_in"]))
+
+        family("request_duration_seconds", "histogram", "Seconds from sending an SFTP request to reading its "
+                                                        "response, by request type.")
+        for name, operation in sorted(snapshot.items()):
+            latency = operation["latency"]
+            for bound, count in latency["buckets"]:
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(prefix + '_request_duration_seconds_bucket{type="' + name + '",le="' + le + '"} ' +
+                             str(count))
+            lines.append(prefix + '_request_duration_seconds_sum{type="' + name + '"} ' + repr(latency["sum"]))
+            lines.append(prefix + '_request_duration_seconds_count{type="' + name + '"} ' + str(latency["count"]))
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, address="", prefix="sftp3"):
+        """
+        Export the numbers over HTTP for Prometheus to scrape, from a background thread. Every path answers.
+
+        :param port: The port to listen on. 0 picks a free one.
+        :param address: The address to listen on. Default is every address.
+        :return: The http.server. Its server_address holds the port, and shutdown() stops it.
+        """
+        metrics = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus(prefix).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((address, port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        return server
+
+class operation_metrics():
+    """
+    The numbers for one request type in a request_metrics.
+    """
+
+    __slots__ = ("count", "errors", "bytes_out", "bytes_in", "latency_counts", "latency_sum")
+
+    def __init__(self, buckets):
+        self.count = 0
+        self.errors = {} # FX_name -> count
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_counts = [0]*(buckets + 1) # Per bucket, not cumulative. The last is past every bound.
+        self.latency_sum = 0.0
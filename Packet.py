@@ -1,10 +1,21 @@
 """
-Use bittify() as a way to byte encode various objects.
+Use encode() as a way to byte encode SFTP requests. bittify() is the older, object by object encoder.
 """
 from Attributes import attributes
 
+import logging
+import struct
+import threading
+
 # Define global vars
-id = 1
+# A log level below DEBUG. Packets are logged at DEBUG by type, id and size, and their bytes only at TRACE.
+TRACE = 5
+logging.addLevelName(TRACE, "TRACE")
+
+logger = logging.getLogger("SFTP3.Packet")
+
+id = 1 # The next id assign_next_id() hands out. Clients number their requests themselves, per connection.
+id_lock = threading.Lock() # Guards id
 
 # The SFTP packet types
 FXP_names = {
@@ -60,7 +71,152 @@ PFLAG_names = {
     "SSH_FXF_EXCL":   0x00000020
 }
 
+# The arguments of each request, after the id. Each field is a "uint32", "uint64", "string" or "attrs".
+FXP_layouts = {
+    "SSH_FXP_INIT":     ("uint32",),
+    "SSH_FXP_OPEN":     ("string", "uint32", "attrs"),
+    "SSH_FXP_CLOSE":    ("string",),
+    "SSH_FXP_READ":     ("string", "uint64", "uint32"),
+    "SSH_FXP_WRITE":    ("string", "uint64", "string"),
+    "SSH_FXP_LSTAT":    ("string",),
+    "SSH_FXP_FSTAT":    ("string",),
+    "SSH_FXP_SETSTAT":  ("string", "attrs"),
+    "SSH_FXP_FSETSTAT": ("string", "attrs"),
+    "SSH_FXP_OPENDIR":  ("string",),
+    "SSH_FXP_READDIR":  ("string",),
+    "SSH_FXP_REMOVE":   ("string",),
+    "SSH_FXP_MKDIR":    ("string", "attrs"),
+    "SSH_FXP_RMDIR":    ("string",),
+    "SSH_FXP_REALPATH": ("string",),
+    "SSH_FXP_STAT":     ("string",),
+    "SSH_FXP_RENAME":   ("string", "string"),
+    "SSH_FXP_READLINK": ("string",),
+    "SSH_FXP_SYMLINK":  ("string", "string")
+}
+
+# Precompiled encoders
+UINT32 = struct.Struct(">I")
+UINT64 = struct.Struct(">Q")
+HEADER = struct.Struct(">IB") # uint32 length, byte type
+HEADER_ID = struct.Struct(">IBI") # uint32 length, byte type, uint32 id
+
+# Raw data at the end of a request that is at least this long is sent as its own buffer instead of being copied.
+max_inline = 1024
+
 # Define helper methods
+def field_kind(item, len=None):
+    """
+    Guess the layout field of an item, for requests without an entry in FXP_layouts.
+    """
+    if isinstance(item, attributes):
+        return "attrs"
+    if isinstance(item, (str, bytes, bytearray, memoryview)):
+        return "string"
+    if len == 8:
+        return "uint64"
+
+    return "uint32"
+
+def encode(FXP_type, id, items, lengths=None):
+    """
+    Encode a request into one preallocated buffer.
+
+    Format:
+    uint32             length
+    byte               type
+    uint32             id         present only if id is not None
+    ...                fields, as laid out in FXP_layouts
+
+    :return: A list of buffers to be sent back to back. Long raw data at the end of the request, like the payload of
+    an SSH_FXP_WRITE, is returned as its own memoryview instead of being copied.
+    """
+    kinds = FXP_layouts.get(FXP_type)
+    if kinds is None or len(kinds) != len(items):
+        if lengths is None:
+            lengths = [None]*len(items)
+        kinds = [field_kind(item, length) for item, length in zip(items, lengths)]
+
+    # Work out the size of every field
+    fields = []
+    size = HEADER.size if id is None else HEADER_ID.size
+    for kind, item in zip(kinds, items):
+        if kind == "string":
+            if isinstance(item, str):
+                item = item.encode("utf-8")
+            item = memoryview(item)
+            size += 4 + item.nbytes
+        elif kind == "attrs":
+            size += item.encoded_length()
+        elif kind == "uint64":
+            size += 8
+        else:
+            size += 4
+        fields.append(item)
+
+    # Leave long raw data at the end out of the buffer
+    data = None
+    if kinds and kinds[-1] == "string" and not isinstance(items[-1], str) and fields[-1].nbytes >= max_inline:
+        data = fields[-1]
+        size -= data.nbytes
+
+    buf = bytearray(size)
+    length = size - 4 + (0 if data is None else data.nbytes)
+    if id is None:
+        HEADER.pack_into(buf, 0, length, FXP_names[FXP_type])
+        offset = HEADER.size
+    else:
+        HEADER_ID.pack_into(buf, 0, length, FXP_names[FXP_type], id)
+        offset = HEADER_ID.size
+
+    for kind, item in zip(kinds, fields):
+        if kind == "string":
+            UINT32.pack_into(buf, offset, item.nbytes)
+            offset += 4
+            if item is data:
+                continue
+            buf[offset:offset + item.nbytes] = item
+            offset += item.nbytes
+        elif kind == "attrs":
+            offset = item.encode_into(buf, offset)
+        elif kind == "uint64":
+            UINT64.pack_into(buf, offset, to_int(item))
+            offset += 8
+        else:
+            UINT32.pack_into(buf, offset, to_int(item))
+            offset += 4
+
+    if data is None:
+        return [buf]
+
+    return [buf, data]
+
+def to_int(item):
+    """
+    Get an int from an int or its big endian bytes, such as from PFLAG_type_byte().
+    """
+    if isinstance(item, int):
+        return item
+
+    return int.from_bytes(item, byteorder='big', signed=False)
+
+def unpack_uint32(b, i):
+    """
+    Read a uint32 at offset i.
+
+    :return: The value, and the offset just past it.
+    """
+    return UINT32.unpack_from(b, i)[0], i + 4
+
+def unpack_string(b, i):
+    """
+    Read a string at offset i, without copying it.
+
+    :return: A slice of b holding the string's bytes, and the offset just past it.
+    """
+    length = UINT32.unpack_from(b, i)[0]
+
+    return b[i + 4:i + 4 + length], i + 4 + length
+
 def bittify(obj, len=None):
     """
     Take an object, and convert it to bytearray.
@@ -84,6 +240,10 @@ def bittify(obj, len=None):
     elif isinstance(obj, str):
         arr = bytearray(obj, "utf-8")
         pad = False
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        # Raw data, such as file contents, is encoded like a string.
+        arr = bytearray(obj)
+        pad = False
     elif isinstance(obj, attributes):
         arr = obj.bytes()
         pad = False
@@ -103,12 +263,26 @@ def bittify(obj, len=None):
             arr = bytearray(len - length) + arr
 
     # Strings should be appended with 4 bytes detailing their length.
-    if isinstance(obj, str):
-        arr = bittify([length], 4) + arr
+    if isinstance(obj, (str, bytes, bytearray, memoryview)):
+        arr = bittify(length, 4) + arr
 
     return arr
 
 # Define classes
+class SFTP_error(Exception):
+    """
+    An error status sent by an SFTP server.
+
+    status is the status code, as in FX_names.
+    """
+
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+    def get_status(self):
+        return self.status
+
 class packet():
     """
     A SFTP request/response as defined by the SFTP internet draft 02.
@@ -127,6 +301,8 @@ class packet():
     As such, packet will NOT interpret the contents of packet. That is for the implementer of packet.
     """
 
+    __slots__ = ("FXP_type", "id", "items", "lengths")
+
     def __init__(self, FXP_type=None, b=None, id=None):
         self.FXP_type = FXP_type
         self.id = id
@@ -138,8 +314,12 @@ class packet():
 
     def assign_next_id(self):
         global id
+        with id_lock:
+            self.id = id
+            id = (id+1)%4294967295
+
+    def set_id(self, id):
         self.id = id
-        id = (id+1)%4294967295
 
     def add(self, item, len=None):
         self.items.append(item)
@@ -160,7 +340,7 @@ class packet():
         return self.items
 
     def get_lengths(self):
-        return self.items
+        return self.lengths
 
     def bytes(self):
         """
@@ -171,27 +351,22 @@ class packet():
         byte               type
         byte[length - 1]   data payload
         """
-        msg = bytearray() # The request/response, aka "data payload"
-
-        # For each item in packet, turn it into a bytearray and append it to the message
-        for item, length in zip(self.items, self.lengths):
-            msg += bittify(item, length)
-
-        if not (self.id is None):
-            id_bytes = bittify(self.id, 4)
-            msg = id_bytes + msg
+        return bytes().join(self.buffers())
 
-        # Determine the message length and type
-        length_bytes = bittify(len(msg)+1, 4)
-        FXP_type_byte = self.FXP_type_byte()
-
-        # Attach message length and type
-        msg = length_bytes + FXP_type_byte + msg
+    def buffers(self):
+        """
+        Encode a packet as a list of buffers, to be sent back to back.
 
-        # Convert from bytearray to bytes for sending
-        msg= bytes(list(msg))
+        Long raw data at the end of a packet, like the payload of an SSH_FXP_WRITE, is left out of the header and
+        returned as its own memoryview, so it is never copied.
+        """
+        msg = encode(self.FXP_type, self.id, self.items, self.lengths)
 
-        print("Encoded packet: " + str(msg))
+        # Checked first, so nothing is formatted while logging is off
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Encoded %s id %s, %d bytes", self.FXP_type, self.id, sum(len(buffer) for buffer in msg))
+            if logger.isEnabledFor(TRACE):
+                logger.log(TRACE, "Encoded %s id %s: %r", self.FXP_type, self.id, bytes().join(msg))
 
         return msg
 
@@ -200,38 +375,44 @@ class packet():
         Decode a server bytearray response into a packet.
 
         As such, this method should ONLY be used to decode messages expected from an SFTP server.
+
+        The response is read through a memoryview with an offset cursor, so nothing is copied until a field is
+        turned into its own object.
         """
+        b = memoryview(b)
 
         # Get message length and type
-        len = int.from_bytes(b[0:4], byteorder='big', signed=False)
-        try:
-            FXP_type_id = b[4]
-        except Exception:
+        if len(b) < 5:
             raise Exception("Empty String received.")
-
-        print("Decoding packet of type " + str(FXP_type_id))
+        FXP_type_id = b[4]
 
         # Set packet type
         self.FXP_type = self.FXP_type_name(FXP_type_id)
 
         # Decode the rest of the message
-        msg = b[5:]
         if FXP_type_id == FXP_names["SSH_FXP_VERSION"]:
-            self.__decode_VERSION(msg)
+            self.__decode_VERSION(b, 5)
         elif FXP_type_id == FXP_names["SSH_FXP_HANDLE"]:
-            self.__decode_HANDLE(msg)
+            self.__decode_HANDLE(b, 5)
         elif FXP_type_id == FXP_names["SSH_FXP_STATUS"]:
-            self.__decode_STATUS(msg)
+            self.__decode_STATUS(b, 5)
         elif FXP_type_id == FXP_names["SSH_FXP_NAME"]:
-            self.__decode_NAME(msg)
+            self.__decode_NAME(b, 5)
         elif FXP_type_id == FXP_names["SSH_FXP_ATTRS"]:
-            self.__decode_ATTRS(msg)
+            self.__decode_ATTRS(b, 5)
         elif FXP_type_id == FXP_names["SSH_FXP_DATA"]:
-            self.__decode_DATA(msg)
+            self.__decode_DATA(b, 5)
+        elif FXP_type_id == FXP_names["SSH_FXP_EXTENDED_REPLY"]:
+            self.__decode_EXTENDED_REPLY(b, 5)
         else:
-            raise Exception("What. Tried to decode unexpected packet of type " + self.FXP_type + ".")
+            raise Exception("What. Tried to decode unexpected packet of type " + str(self.FXP_type) + ".")
 
-    def __decode_VERSION(self, b):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Decoded %s id %s, %d bytes", self.FXP_type, self.id, len(b))
+            if logger.isEnabledFor(TRACE):
+                logger.log(TRACE, "Decoded %s id %s: %r", self.FXP_type, self.id, bytes(b))
+
+    def __decode_VERSION(self, b, i):
         """
         Format:
         uint32 version
@@ -242,41 +423,33 @@ class packet():
         string extension_data
         """
         # Get the version number
-        self.add(int.from_bytes(b[0:4], byteorder='big', signed=False), 4)
+        version, i = unpack_uint32(b, i)
+        self.add(version, 4)
 
         # Get extension data
-        i = 4
         while i < len(b):
             # Extract the extension name
-            string_len = int.from_bytes(b[i:i + 4], byteorder='big', signed=False)
-            extension_name = b[i + 4:i + 4 + string_len].decode("utf-8")
-
-            self.add(extension_name, string_len)
-
-            i += 4 + string_len
+            extension_name, i = unpack_string(b, i)
+            self.add(str(extension_name, "utf-8"), len(extension_name))
 
             # Extract the extension data
-            string_len = int.from_bytes(b[i:i + 4], byteorder='big', signed=False)
-            extension_data = b[i + 4:i + 4 + string_len].decode("utf-8")
-
-            self.add(extension_data, string_len)
-
-            i += 4 + string_len
+            extension_data, i = unpack_string(b, i)
+            self.add(str(extension_data, "utf-8"), len(extension_data))
 
-    def __decode_HANDLE(self, b):
+    def __decode_HANDLE(self, b, i):
         """
         Format:
         uint32     id
         string     handle
         """
-        self.id = int.from_bytes(b[0:4], byteorder='big', signed=False)
+        self.id, i = unpack_uint32(b, i)
 
-        string_len = int.from_bytes(b[4:8], byteorder='big', signed=False)
-        handle = b[8:8 + string_len].decode("utf-8")
+        # Handles are opaque, and need not be text.
+        handle, i = unpack_string(b, i)
 
-        self.add(handle, 4)
+        self.add(bytes(handle), 4)
 
-    def __decode_STATUS(self, b):
+    def __decode_STATUS(self, b, i):
         """
         Format:
         uint32     id
@@ -284,29 +457,22 @@ class packet():
         string     error/status message (ISO-10646 UTF-8 [RFC-2279])
         string     language tag (as defined in [RFC-1766])
         """
-        self.id = int.from_bytes(b[0:4], byteorder='big', signed=False)
+        self.id, i = unpack_uint32(b, i)
 
-        self.add(int.from_bytes(b[4:8], byteorder='big', signed=False))
-
-        i = 8
+        status, i = unpack_uint32(b, i)
+        self.add(status)
 
         # Extract error message, if there is one
         if len(b) > i:
-            string_len = int.from_bytes(b[i:i + 4], byteorder='big', signed=False)
-            message = b[i + 4:i + 4 + string_len].decode("utf-8")
-
-            self.add(message)
-
-            i += 4 + string_len
+            message, i = unpack_string(b, i)
+            self.add(str(message, "utf-8"))
 
             # Extract language tag, if there is one
             if len(b) > i:
-                string_len = int.from_bytes(b[i:i + 4], byteorder='big', signed=False)
-                language = b[i + 4:i + 4 + string_len].decode("utf-8")
-
-                self.add(language)
+                language, i = unpack_string(b, i)
+                self.add(str(language, "utf-8"))
 
-    def __decode_NAME(self, b):
+    def __decode_NAME(self, b, i):
         """
         Format:
         uint32     id
@@ -316,61 +482,77 @@ class packet():
                 string     longname
                 ATTRS      attrs
         """
-        self.id = int.from_bytes(b[0:4], byteorder='big', signed=False)
+        self.id, i = unpack_uint32(b, i)
 
-        num_files = int.from_bytes(b[4:8], byteorder='big', signed=False)
+        num_files, i = unpack_uint32(b, i)
         self.add(num_files, 4)
 
-        i = 8
-        for file in range(1, num_files+1):
+        for file in range(num_files):
             # Extract filename
-            string_len = int.from_bytes(b[i:i + 4], byteorder='big', signed=False)
-            filename = b[i+4:i+4+string_len].decode("utf-8")
-
-            self.add(filename, string_len)
-
-            i += 4 + string_len
+            filename, i = unpack_string(b, i)
+            self.add(str(filename, "utf-8"), len(filename))
 
             # Extract longname
-            string_len = int.from_bytes(b[i:i + 4], byteorder='big', signed=False)
-            longname = b[i+4:i+4+string_len].decode("utf-8")
-
-            self.add(longname, string_len)
+            longname, i = unpack_string(b, i)
+            self.add(str(longname, "utf-8"), len(longname))
 
-            i += 4 + string_len
-
-            # Decode attributes
-            attr = attributes(b=b[i:]) # Shove in everything
+            # Decode attributes in place
+            attr = attributes()
+            i = attr.decode(b, i)
 
             self.add(attr)
 
-            i += attr.get_byte_length()
-
-    def __decode_ATTRS(self, b):
+    def __decode_ATTRS(self, b, i):
         """
         Format:
         uint32     id
         ATTRS      attrs <- Dummy attributes
         """
-        self.id = int.from_bytes(b[0:4], byteorder='big', signed=False)
+        self.id, i = unpack_uint32(b, i)
 
-        attr = attributes(b=b[4:])  # Shove in everything
+        attr = attributes()
+        attr.decode(b, i)
 
         self.add(attr)
 
-    def __decode_DATA(self, b):
+    def __decode_DATA(self, b, i):
         """
         Format:
         uint32     id
         string     data
         """
-        self.id = int.from_bytes(b[0:4], byteorder='big', signed=False)
+        self.id, i = unpack_uint32(b, i)
 
-        string_len = int.from_bytes(b[4:8], byteorder='big', signed=False)
-        data = b[8:8 + string_len].decode("utf-8")
+        # File contents are kept as a memoryview of the received packet, since they need not be text and
+        # should not be copied.
+        data, i = unpack_string(b, i)
 
         self.add(data, 4)
 
+    def __decode_EXTENDED_REPLY(self, b, i):
+        """
+        Format:
+        uint32     id
+        ...        extension specific data
+
+        The data is kept as bytes, since only the extension's request knows its layout.
+        """
+        self.id, i = unpack_uint32(b, i)
+
+        self.add(bytes(b[i:]), 4)
+
+    def status_error(self):
+        """
+        Get the SFTP_error an SSH_FXP_STATUS response stands for.
+        """
+        status = self.items[0]
+        if len(self.items) > 1:
+            message = self.items[1].lower()
+        else:
+            message = str(self.FX_type_name(status))
+
+        return SFTP_error(message, status)
+
     def FXP_type_byte(self):
         num = FXP_names[self.FXP_type]
 
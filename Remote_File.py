@@ -0,0 +1,366 @@
+"""
+A file-like object over an open SFTP handle, for SFTP_client.open().
+"""
+# Handle imports
+from Requests import handle_request, read_request, write_request, setstat_request, check_status, expect, is_eof
+from Attributes import attributes
+
+import collections
+import io
+
+# Define global vars
+# pflags for each open() mode. "b" is ignored, since remote files are always binary.
+MODE_pflags = {
+    "r":  ["SSH_FXF_READ"],
+    "r+": ["SSH_FXF_READ", "SSH_FXF_WRITE"],
+    "w":  ["SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_TRUNC"],
+    "w+": ["SSH_FXF_READ", "SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_TRUNC"],
+    "a":  ["SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_APPEND"],
+    "a+": ["SSH_FXF_READ", "SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_APPEND"],
+    "x":  ["SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_EXCL"],
+    "x+": ["SSH_FXF_READ", "SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_EXCL"]
+}
+
+# Define methods
+def mode_pflags(mode):
+    """
+    Get the PFLAG_names to open a file with, for a Python open() mode such as "rb" or "w+".
+    """
+    key = mode.replace("b", "")
+    if not key in MODE_pflags:
+        raise ValueError("invalid mode: " + mode)
+
+    return MODE_pflags[key]
+
+# Define classes
+class remote_file():
+    """
+    A file-like object that keeps one SFTP handle open.
+
+    Reads use an adaptive read-ahead buffer. While reads are sequential, the number of bytes requested ahead of
+    the read position doubles after every chunk, up to max_read_ahead. A seek outside the buffer drops it and
+    starts over at one chunk.
+
+    Writes are buffered and sent in write_chunk_size SSH_FXP_WRITE requests without waiting on their acks, up to
+    max_writes at once. Errors from those writes are raised by a later write(), flush() or close().
+
+    Use it as a context manager to close the handle when done.
+    """
+
+    def __init__(self, client, handle, path, mode="r", chunk_size=32768, max_read_ahead=1048576,
+                 write_chunk_size=None, max_writes=16):
+        """
+        :param client: The SFTP_client the handle belongs to.
+        :param handle: The open handle.
+        :param path: The path the handle was opened from.
+        :param mode: The mode the handle was opened with.
+        :param chunk_size: Bytes per SSH_FXP_READ.
+        :param max_read_ahead: The most bytes requested ahead of the read position.
+        :param write_chunk_size: Bytes per SSH_FXP_WRITE. Defaults to chunk_size.
+        :param max_writes: The maximum number of unacknowledged writes.
+        """
+        self.client = client
+        self.handle = handle
+        self.path = path
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.max_read_ahead = max_read_ahead
+        self.write_chunk_size = chunk_size if write_chunk_size is None else write_chunk_size
+        self.max_writes = max_writes
+        self.closed = False
+
+        self.position = 0
+
+        # Read-ahead state. buffer holds data starting at position, and ahead holds the outstanding reads after it.
+        self.buffer = memoryview(bytes())
+        self.ahead = collections.deque() # (offset, length, request_future), in offset order
+        self.read_ahead = chunk_size
+        self.eof = None # The offset of the end of the file, once a read has hit it
+
+        # Write-behind state. write_buffer holds data to be written at write_offset.
+        self.write_buffer = bytearray()
+        self.write_offset = 0
+        self.writes = collections.deque() # request_futures of unacknowledged writes, oldest first
+
+        if "a" in mode:
+            self.position = self.stat().get_size()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def readable(self):
+        return "r" in self.mode or "+" in self.mode
+
+    def writable(self):
+        return not (self.mode.startswith("r") and not "+" in self.mode)
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        """
+        Move the file position.
+
+        :param offset: The offset, relative to whence.
+        :param whence: 0 for the start of the file, 1 for the current position, 2 for the end of the file.
+        :return: The new position.
+        """
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            self.flush()
+            offset += self.stat().get_size()
+        if offset < 0:
+            raise ValueError("negative seek position " + str(offset))
+
+        # Keep the read-ahead buffer if the new position is inside it
+        if self.position <= offset <= self.position + len(self.buffer):
+            self.buffer = self.buffer[offset - self.position:]
+        elif offset != self.position:
+            self.__drop_read_ahead()
+        self.position = offset
+
+        return self.position
+
+    def read(self, size=-1):
+        """
+        Read up to size bytes. Reads to the end of the file if size is negative.
+        """
+        self.__check_open()
+        if not self.readable():
+            raise io.UnsupportedOperation("File not open for reading")
+        self.__flush_writes()
+
+        chunks = []
+        while size != 0:
+            if not self.buffer and not self.__fill_buffer():
+                break # End of file
+
+            chunk = self.buffer if size < 0 else self.buffer[:size]
+            chunks.append(chunk)
+            self.buffer = self.buffer[len(chunk):]
+            self.position += len(chunk)
+            if size > 0:
+                size -= len(chunk)
+
+        return bytes().join(chunks)
+
+    def readinto(self, b):
+        """
+        Read into a preallocated buffer.
+
+        :return: The number of bytes read.
+        """
+        data = self.read(len(b))
+        b[0:len(data)] = data
+
+        return len(data)
+
+    def write(self, data):
+        """
+        Write data at the file position. The write is buffered, and sent once a whole chunk is buffered.
+
+        :return: The number of bytes written.
+        """
+        self.__check_open()
+        if not self.writable():
+            raise io.UnsupportedOperation("File not open for writing")
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+
+        # Anything read ahead may now be stale
+        self.__drop_read_ahead()
+
+        # Writes are only buffered together while they are contiguous
+        if self.write_buffer and self.write_offset + len(self.write_buffer) != self.position:
+            self.__send_writes(True)
+        if not self.write_buffer:
+            self.write_offset = self.position
+
+        self.write_buffer += data
+        self.position += len(data)
+        self.__send_writes(False)
+
+        return len(data)
+
+    def flush(self):
+        """
+        Send any buffered data, and wait until every write has been acknowledged.
+        """
+        self.__check_open()
+        self.__flush_writes()
+
+    def stat(self):
+        """
+        Get the attributes of the open file, via SSH_FXP_FSTAT.
+        """
+        r_packet = self.client.submit(handle_request("SSH_FXP_FSTAT", self.handle)).result()
+        expect(r_packet, "SSH_FXP_ATTRS")
+
+        return r_packet.get_items()[0]
+
+    def setstat(self, attr):
+        """
+        Set the attributes of the open file, via SSH_FXP_FSETSTAT.
+        """
+        self.__flush_writes()
+
+        check_status(self.client.submit(setstat_request("SSH_FXP_FSETSTAT", self.handle, attr)).result())
+
+    def truncate(self, size=None):
+        """
+        Resize the file. Defaults to the current position.
+
+        :return: The new size.
+        """
+        if not self.writable():
+            raise io.UnsupportedOperation("File not open for writing")
+        if size is None:
+            size = self.position
+
+        self.setstat(attributes(size=size))
+        self.__drop_read_ahead()
+
+        return size
+
+    def close(self):
+        """
+        Flush any buffered writes and close the handle.
+        """
+        if self.closed:
+            return
+
+        try:
+            self.__flush_writes()
+        finally:
+            self.closed = True
+            self.__drop_read_ahead()
+
+            try:
+                check_status(self.client.submit(handle_request("SSH_FXP_CLOSE", self.handle)).result())
+            finally:
+                if self.writable() and not (self.client.cache is None):
+                    self.client.cache.invalidate(self.path)
+
+    def __iter__(self):
+        """
+        Iterate over the file's lines.
+        """
+        line = bytearray()
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+
+            start = 0
+            end = chunk.find(b"\n") + 1
+            while end > 0:
+                line += chunk[start:end]
+                yield bytes(line)
+                line = bytearray()
+                start = end
+                end = chunk.find(b"\n", start) + 1
+            line += chunk[start:]
+
+        if line:
+            yield bytes(line)
+
+    def __check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+    def __drop_read_ahead(self):
+        """
+        Forget the read-ahead buffer. Reads still in flight are left to be answered and ignored.
+        """
+        self.buffer = memoryview(bytes())
+        self.ahead.clear()
+        self.read_ahead = self.chunk_size
+        self.eof = None
+
+    def __fill_buffer(self):
+        """
+        Wait on the next read-ahead chunk and make it the buffer, topping up the reads in flight first.
+
+        :return: False at the end of the file.
+        """
+        if not (self.eof is None) and self.position >= self.eof:
+            return False
+
+        # Keep read_ahead bytes requested past the read position
+        if self.ahead:
+            next_offset = self.ahead[-1][0] + self.ahead[-1][1]
+        else:
+            next_offset = self.position
+        while next_offset < self.position + self.read_ahead:
+            self.ahead.append((next_offset, self.chunk_size, self.__submit_read(next_offset, self.chunk_size)))
+            next_offset += self.chunk_size
+
+        offset, length, future = self.ahead.popleft()
+        r_packet = future.result()
+
+        if is_eof(r_packet):
+            self.ahead.clear()
+            self.eof = offset
+            return False
+
+        data = r_packet.get_items()[0]
+        if len(data) == 0:
+            self.ahead.clear()
+            self.eof = offset
+            return False
+
+        # Short read, so ask for the rest of the chunk before anything after it.
+        if len(data) < length:
+            rest_offset = offset + len(data)
+            self.ahead.appendleft((rest_offset, length - len(data),
+                                   self.__submit_read(rest_offset, length - len(data))))
+
+        self.buffer = data
+
+        # Sequential reading, so read further ahead next time.
+        self.read_ahead = min(self.read_ahead*2, self.max_read_ahead)
+
+        return True
+
+    def __submit_read(self, offset, length):
+        return self.client.submit(read_request(self.handle, offset, length))
+
+    def __send_writes(self, everything):
+        """
+        Send the buffered data as SSH_FXP_WRITE requests, without waiting on their acks.
+
+        :param everything: If False, only whole chunks are sent and the rest stays buffered.
+        """
+        view = memoryview(self.write_buffer)
+        sent = 0
+        while len(view) - sent >= self.write_chunk_size or (everything and sent < len(view)):
+            chunk = bytes(view[sent:sent + self.write_chunk_size])
+
+            # Collect finished acks, and wait for room in the window
+            while self.writes and (self.writes[0].done() or len(self.writes) >= self.max_writes):
+                check_status(self.writes.popleft().result())
+
+            self.writes.append(self.client.submit(write_request(self.handle, self.write_offset, chunk)))
+
+            self.write_offset += len(chunk)
+            sent += len(chunk)
+
+        view.release()
+        del self.write_buffer[0:sent]
+
+    def __flush_writes(self):
+        """
+        Send everything buffered, and wait on every ack.
+        """
+        if self.write_buffer:
+            self.__send_writes(True)
+
+        while self.writes:
+            check_status(self.writes.popleft().result())
@@ -0,0 +1,219 @@
+"""
+Builders for SFTP requests, and checks for their responses. These are shared by every client.
+
+Requests are built without an id. The client that sends a request gives it one.
+"""
+# Handle imports
+from Packet import packet, FX_names, PFLAG_names
+from Attributes import attributes
+
+import struct
+
+# Define global vars
+LIMITS = struct.Struct(">QQQQ") # The reply to limits@openssh.com
+
+# Define methods
+def path_request(FXP_type, dir):
+    """
+    Build a request whose only argument is a path, such as STAT, REMOVE or OPENDIR.
+
+    Format:
+    uint32 id
+    string path
+    """
+    c_packet = packet(FXP_type)
+    c_packet.add(dir)
+
+    return c_packet
+
+def handle_request(FXP_type, handle):
+    """
+    Build a request whose only argument is a handle, such as CLOSE, READDIR or FSTAT.
+
+    Format:
+    uint32 id
+    string handle
+    """
+    c_packet = packet(FXP_type)
+    c_packet.add(handle)
+
+    return c_packet
+
+def open_request(dir, pflags, attr = None):
+    """
+    Build a request that opens a file.
+
+    Format:
+    uint32 id
+    string filename
+    uint32 pflags
+    ATTRS attrs
+
+    :param pflags: An array of PFLAG_names.
+    """
+    c_packet = packet("SSH_FXP_OPEN")
+    c_packet.add(dir)
+    c_packet.add(sum(PFLAG_names[pflag] for pflag in pflags), 4)
+    if attr is None:
+        attr = attributes()
+    c_packet.add(attr)
+
+    return c_packet
+
+def read_request(handle, offset, length):
+    """
+    Format:
+    uint32 id
+    string handle
+    uint64 offset
+    uint32 len
+    """
+    c_packet = packet("SSH_FXP_READ")
+    c_packet.add(handle)
+    c_packet.add(offset, 8)
+    c_packet.add(length, 4)
+
+    return c_packet
+
+def write_request(handle, offset, data):
+    """
+    Format:
+    uint32 id
+    string handle
+    uint64 offset
+    string data
+    """
+    c_packet = packet("SSH_FXP_WRITE")
+    c_packet.add(handle)
+    c_packet.add(offset, 8)
+    c_packet.add(data)
+
+    return c_packet
+
+def mkdir_request(dir, attr = None):
+    """
+    Format:
+    uint32 id
+    string path
+    ATTRS attrs
+    """
+    c_packet = packet("SSH_FXP_MKDIR")
+    c_packet.add(dir)
+    if attr is None:
+        attr = attributes()
+    c_packet.add(attr)
+
+    return c_packet
+
+def setstat_request(FXP_type, target, attr):
+    """
+    Build a SETSTAT request for a path, or a FSETSTAT request for a handle.
+
+    Format:
+    uint32 id
+    string path or handle
+    ATTRS attrs
+    """
+    c_packet = packet(FXP_type)
+    c_packet.add(target)
+    c_packet.add(attr)
+
+    return c_packet
+
+def rename_request(dir, new_dir):
+    """
+    Format:
+    uint32 id
+    string oldpath
+    string newpath
+    """
+    c_packet = packet("SSH_FXP_RENAME")
+    c_packet.add(dir)
+    c_packet.add(new_dir)
+
+    return c_packet
+
+def symlink_request(dir, link_to):
+    """
+    Format:
+    uint32 id
+    string linkpath
+    string targetpath
+
+    OpenSSH reads these the other way around, so the target is sent first.
+    """
+    c_packet = packet("SSH_FXP_SYMLINK")
+    c_packet.add(link_to)
+    c_packet.add(dir)
+
+    return c_packet
+
+def extended_request(extension_name):
+    """
+    Build a request for a vendor extension that takes no arguments, such as limits@openssh.com.
+
+    Format:
+    uint32 id
+    string extended-request
+    """
+    c_packet = packet("SSH_FXP_EXTENDED")
+    c_packet.add(extension_name)
+
+    return c_packet
+
+def parse_limits(r_packet):
+    """
+    Get the server limits out of the SSH_FXP_EXTENDED_REPLY to limits@openssh.com. A limit of 0 means unknown.
+
+    Format:
+    uint64 max-packet-length
+    uint64 max-read-length
+    uint64 max-write-length
+    uint64 max-open-handles
+
+    :return: A dictionary of max_packet_length, max_read_length, max_write_length and max_open_handles.
+    """
+    expect(r_packet, "SSH_FXP_EXTENDED_REPLY")
+
+    max_packet_length, max_read_length, max_write_length, max_open_handles = \
+        LIMITS.unpack_from(r_packet.get_items()[0])
+
+    return {
+        "max_packet_length": max_packet_length,
+        "max_read_length": max_read_length,
+        "max_write_length": max_write_length,
+        "max_open_handles": max_open_handles
+    }
+
+def check_status(r_packet):
+    """
+    Raise an exception if a response is not an SSH_FX_OK status.
+    """
+    expect(r_packet, "SSH_FXP_STATUS")
+
+    if r_packet.get_items()[0] != FX_names["SSH_FX_OK"]:
+        raise r_packet.status_error()
+
+def expect(r_packet, FXP_type):
+    """
+    Raise an exception if a response is not of the expected type. Error statuses are raised as SFTP_errors.
+    """
+    if r_packet.get_FXP_type() == FXP_type:
+        return
+
+    if r_packet.get_FXP_type() == "SSH_FXP_STATUS":
+        raise r_packet.status_error()
+
+    raise Exception("Expected " + FXP_type + " but got " + str(r_packet.get_FXP_type()) + ".")
+
+def is_eof(r_packet):
+    """
+    Check whether a response is an SSH_FX_EOF status. Any other status is raised as an SFTP_error.
+    """
+    if r_packet.get_FXP_type() != "SSH_FXP_STATUS":
+        return False
+
+    if r_packet.get_items()[0] != FX_names["SSH_FX_EOF"]:
+        raise r_packet.status_error()
+
+    return True
@@ -1,86 +1,251 @@
 # Handle imports
 from SSH_Client import SSH
-from Packet import packet
+from Packet import packet, SFTP_error, FX_names
+from Requests import path_request, handle_request, open_request, mkdir_request, setstat_request, rename_request, \
+    extended_request, parse_limits, \
+    symlink_request, check_status, expect, is_eof
+from Dispatcher import request_dispatcher, token_bucket
+from Transfer import window_controller, download, upload, striped_download, striped_upload
 from Attributes import attributes
+from Metadata_Cache import metadata_cache
+from Metrics import request_metrics
+from Remote_File import remote_file, mode_pflags
 
+import collections
+import logging
+import posixpath
 import socket
+import threading
+
+# Define global vars
+logger = logging.getLogger("SFTP3.SFTP_Client")
 
 # Define classes
 class SFTP_client(SSH):
     """
     A SFTP v3 client as per the SFTP internet draft 02.
 
-    Use open_sftp_session() to open an sftp channel, and use init() afterwards to start an sftp session.
+    Use open_sftp_channel() to open an sftp channel and start an sftp session. The channel is kept open and
+    shared by every request.
     Use stop() to close the sftp channel, freeing it for future usage.
-    """
 
-    conn_timeout = 0.2 # For connection timeouts
+    One client can be shared by many threads. Their requests are pipelined on the one channel, and each thread
+    gets back the responses to its own requests.
 
-    def open_sftp_channel(self, window_size=None, max_packet_size=None):
+    If the server offers the limits@openssh.com extension, the chunk sizes, the number of reads, writes and
+    requests in flight and the number of handles a walk holds open are tuned to the limits it reports. Otherwise
+    the defaults below, which every server accepts, are used. Use get_settings() to read back the values in use.
+    """
+
+    conn_timeout = 30 # For connection timeouts
+    window_size = 8388608 # Bytes the server may send on the channel before waiting on us
+    max_packet_size = 32768 # The largest SSH packet on the channel. SFTP packets may span many of these.
+    max_requests = 64 # The maximum number of requests in flight at once
+    read_chunk_size = 32768 # Bytes asked for per read. Most servers cap reads at 32-64 KiB.
+    max_reads = 16 # The maximum number of reads in flight at once, per file
+    write_chunk_size = 32768 # Bytes sent per write. This keeps each packet under the 34000 byte minimum servers accept.
+    max_writes = 16 # The maximum number of writes in flight at once, per file
+    auto_tune = True # Whether to tune the settings to the server's limits
+    adaptive = False # Whether transfers resize their window and chunks as they measure the link
+    in_flight_target = 4194304 # Bytes of reads, or of writes, that tuning aims to keep in flight per file
+    max_open_handles = None # The most handles the server lets a session hold open, if it reported a limit
+    min_chunk_size = 4096 # The smallest chunks adaptive transfers shrink to
+
+    # Settings that can be given to open_sftp_channel()
+    settings = ("window_size", "max_packet_size", "max_requests", "read_chunk_size", "max_reads",
+                "write_chunk_size", "max_writes")
+
+    def __init__(self, IP, username, password = None, key_filename = None, ssh = None):
+        SSH.__init__(self, IP, username, password=password, key_filename=key_filename, ssh=ssh)
+
+        self.socket = None # The sftp channel, shared by every request
+        self.overrides = {} # Settings given to open_sftp_channel(), which tuning leaves alone
+        self.extensions = {} # The extensions the server offered, by name
+        self.limits = None # What the server reported for limits@openssh.com, if it offered it
+        self.recv_buffer = bytearray() # Bytes received but not yet handed out as packets
+        self.dispatcher = request_dispatcher(self.__send, self.__recv, self.max_requests)
+        self.cache = None # The metadata_cache, if enabled
+        self.channel_lock = threading.RLock() # Held while the channel is opened or closed
+        self.last_transfer = None # The window_controller of the last read_file() or write_file()
+
+    def open_sftp_channel(self, window_size=None, max_packet_size=None, max_requests=None, read_chunk_size=None,
+                          max_reads=None, write_chunk_size=None, max_writes=None, auto_tune=None):
         """
         Connect to the sftp channel.
+
+        The channel stays open and is reused by every request. If it closes, it is reopened with the same
+        settings the next time a request is sent.
+
+        Every setting is optional. Settings that are given are kept as they are, for this channel and any channel
+        reopened after it. The rest are tuned to the server's limits.
+
+        :param window_size: Bytes the server may send on the channel before waiting on us. It is never tuned, since
+        it is fixed once the channel is open.
+        :param max_packet_size: The largest SSH packet on the channel.
+        :param max_requests: The maximum number of requests in flight at once.
+        :param read_chunk_size: Bytes asked for per read.
+        :param max_reads: The maximum number of reads in flight at once, per file.
+        :param write_chunk_size: Bytes sent per write.
+        :param max_writes: The maximum number of writes in flight at once, per file.
+        :param auto_tune: Whether to tune the other settings to the server's limits.
         """
-        if not max_packet_size is None:
-            self.max_packet_size = max_packet_size
+        with self.channel_lock:
+            given = (window_size, max_packet_size, max_requests, read_chunk_size, max_reads, write_chunk_size,
+                     max_writes)
+            for name, value in zip(self.settings, given):
+                if not (value is None):
+                    self.overrides[name] = value
+            if not (auto_tune is None):
+                self.auto_tune = auto_tune
+
+            self.close_sftp_channel()
 
-        transport = self.ssh.get_transport()
-        chan = transport.open_session(window_size=window_size,
-                              max_packet_size=max_packet_size, timeout=1)
-        if chan is None:
-            return None # Error, don't know why
-        chan.invoke_subsystem('sftp')
-        chan.settimeout(self.conn_timeout)
+            # Start from the defaults, so nothing tuned to a previous server sticks
+            for name in self.settings:
+                setattr(self, name, self.overrides.get(name, getattr(type(self), name)))
 
-        self.socket = chan
+            transport = self.ssh.get_transport()
+            chan = transport.open_session(window_size=self.window_size,
+                                  max_packet_size=self.max_packet_size, timeout=1)
+            if chan is None:
+                return None # Error, don't know why
+            chan.invoke_subsystem('sftp')
+            chan.settimeout(self.conn_timeout)
 
-        self.__initiate()
+            self.socket = chan
+            self.recv_buffer = bytearray()
 
-    def __send(self, msg):
+            self.__initiate()
+            self.__tune()
+
+    def close_sftp_channel(self):
         """
-        Send bytes to server.
+        Close the sftp channel, if one is open. Any open handles are lost.
+        """
+        with self.channel_lock:
+            if not (self.socket is None):
+                self.socket.close()
+                self.socket = None
+
+            # Requests sent on the old channel will never be answered.
+            self.dispatcher.fail_all(RuntimeError("sftp channel closed"))
+
+    def channel_is_open(self):
+        """
+        Check whether the sftp channel is still usable.
+        """
+        if self.socket is None:
+            return False
+
+        return not (self.socket.closed or self.socket.eof_received or self.socket.exit_status_ready())
+
+    def __ensure_channel(self):
+        """
+        Reopen the sftp channel if it has closed since it was last used.
+        """
+        if self.channel_is_open():
+            return
+
+        with self.channel_lock:
+            # Another thread may have reopened it while this one waited on the lock
+            if not self.channel_is_open():
+                self.open_sftp_channel()
+
+    def __send(self, *msgs):
         """
-        self.open_sftp_channel(window_size=2048)
+        Send bytes to server.
 
-        length = len(msg)
-        total_sent = 0
-        sent = 0
+        Several buffers may be given, such as a packet header and its payload. They are sent back to back without
+        being joined.
+        """
+        buffers = [memoryview(msg) for msg in msgs]
 
-        # Send message until everything is sent.
-        while sent < length:
-            sent += self.socket.__send(msg[total_sent:])
+        # Send the buffers until everything is sent, gathering them into one call where the channel allows it.
+        while buffers:
+            if hasattr(self.socket, "sendmsg"):
+                sent = self.socket.sendmsg(buffers)
+            else:
+                sent = self.socket.send(buffers[0])
             if sent == 0:
                 # This indicates an error or connection break
                 raise RuntimeError("socket connection broken")
-            total_sent += sent
+
+            # Drop what was sent
+            while buffers and sent >= buffers[0].nbytes:
+                sent -= buffers[0].nbytes
+                buffers.pop(0)
+            if sent:
+                buffers[0] = buffers[0][sent:]
 
     def __recv(self, max_packet_size = None):
         """
-        Listen for bytes from server.
-        """
-        msg = bytes()
-        recv = ""
+        Read one SFTP packet from the server.
 
+        Packets are framed by their 4 byte length header, so this returns as soon as a whole packet has
+        arrived. Bytes read past the end of the packet are kept in recv_buffer for the next call.
+
+        :return: A memoryview of the packet. Payloads can be sliced out of it without being copied.
+        """
         if max_packet_size is None:
             max_packet_size = self.max_packet_size
 
-        # Read from the connection until timeout.
-        while not (recv is None):
+        # Read until the length header is in.
+        self.__fill(4, max_packet_size)
+        length = 4 + int.from_bytes(self.recv_buffer[0:4], byteorder='big', signed=False)
+
+        if length <= len(self.recv_buffer) or length <= max_packet_size:
+            # Small packet, so read it into recv_buffer along with whatever follows it.
+            self.__fill(length, max_packet_size)
+            msg = self.recv_buffer[0:length]
+            del self.recv_buffer[0:length]
+        else:
+            # Large packet, like file data, so read the rest of it straight into its own buffer.
+            msg = bytearray(length)
+            received = len(self.recv_buffer)
+            msg[0:received] = self.recv_buffer
+            self.recv_buffer = bytearray()
+
+            view = memoryview(msg)
+            while received < length:
+                received += self.__recv_into(view[received:])
+
+        return memoryview(msg)
+
+    def __recv_into(self, view):
+        """
+        Read from the connection into a buffer, returning the number of bytes read.
+        """
+        try:
+            if hasattr(self.socket, "recv_into"):
+                received = self.socket.recv_into(view)
+            else:
+                recv = self.socket.recv(len(view))
+                received = len(recv)
+                view[0:received] = recv
+        except socket.timeout:
+            raise RuntimeError("timed out waiting on the server")
+
+        if received == 0:
+            # This indicates an error or connection break
+            raise RuntimeError("socket connection broken")
+
+        return received
+
+    def __fill(self, length, max_packet_size):
+        """
+        Read from the connection until recv_buffer holds at least length bytes.
+        """
+        while len(self.recv_buffer) < length:
             try:
-                recv = self.socket.__recv(max_packet_size)
+                recv = self.socket.recv(max(max_packet_size, length - len(self.recv_buffer)))
             except socket.timeout:
-                # Timeout occurred
-                recv = None
+                raise RuntimeError("timed out waiting on the server")
 
             if recv == bytes():
                 # This indicates an error or connection break
                 raise RuntimeError("socket connection broken")
 
-            if not (recv is None):
-                msg += recv
-
-        print("got: " + str(msg))
-
-        return msg
+            self.recv_buffer += recv
 
     def __initiate(self):
         """
@@ -98,14 +263,220 @@ class SFTP_client(SSH):
         c_packet.add(3, 4)
         bytes = c_packet.bytes()
         self.__send(bytes)
-        print("waiting on response")
+        logger.debug("Waiting on SSH_FXP_VERSION from %s@%s", self.username, self.IP)
         response = self.__recv()
         r_packet = packet(b=response)
 
         # Check that servers agree on the SFTP protocol version.
-        if r_packet.get_items()[0] != 3:
+        items = r_packet.get_items()
+        if items[0] != 3:
             raise Exception("SFTP cannot settle on the protocol version to use.")
 
+        # Keep the extensions the server offered, as name, data pairs
+        self.extensions = dict(zip(items[1::2], items[2::2]))
+
+    def __tune(self):
+        """
+        Ask the server for its limits, if it offers limits@openssh.com, and tune every setting that was not given to
+        open_sftp_channel() to them.
+
+        Chunks are made as large as the server allows. Then as many reads and writes are kept in flight as make up
+        in_flight_target bytes, as long as the reads fit in the channel window, and max_requests is raised to leave
+        room for them alongside metadata requests. The window itself is agreed when the channel opens, before the
+        server can be asked for its limits, so it is never tuned, and the reads are fitted to it instead.
+        max_open_handles is taken as the server reports it.
+        """
+        self.limits = None
+        self.max_open_handles = None
+        self.dispatcher.max_requests = self.max_requests
+        if not self.auto_tune or not "limits@openssh.com" in self.extensions:
+            return
+
+        self.limits = parse_limits(self.__request(extended_request("limits@openssh.com")))
+        max_packet_length = self.limits["max_packet_length"]
+        max_read_length = self.limits["max_read_length"]
+        max_write_length = self.limits["max_write_length"]
+
+        tuned = {}
+        if max_read_length:
+            tuned["read_chunk_size"] = max_read_length
+        if max_write_length:
+            tuned["write_chunk_size"] = max_write_length
+            if max_packet_length:
+                # Leave room for the rest of the SSH_FXP_WRITE packet
+                tuned["write_chunk_size"] = min(max_write_length, max_packet_length - 1024)
+        for name, value in tuned.items():
+            if not name in self.overrides:
+                setattr(self, name, value)
+
+        if self.limits["max_open_handles"]:
+            self.max_open_handles = self.limits["max_open_handles"]
+
+        # Reads in flight can't outgrow the channel window, or the server stalls waiting on it
+        max_reads = min(self.in_flight_target // self.read_chunk_size,
+                        self.window_size // (self.read_chunk_size + 1024))
+        max_writes = self.in_flight_target // self.write_chunk_size
+        if not "max_requests" in self.overrides:
+            self.max_requests = max(self.max_requests, max(max_reads, max_writes) + self.dispatcher.metadata_slots)
+            self.dispatcher.max_requests = self.max_requests
+        tuned = {
+            "max_reads": max(1, min(max_reads, self.max_requests)),
+            "max_writes": max(1, min(max_writes, self.max_requests))
+        }
+        for name, value in tuned.items():
+            if not name in self.overrides:
+                setattr(self, name, value)
+
+    def get_settings(self):
+        """
+        Get the settings in use on the channel, after tuning.
+
+        :return: A dictionary of every setting open_sftp_channel() takes, max_open_handles, and limits, the
+        server's limits if it reported them.
+        """
+        settings = {name: getattr(self, name) for name in self.settings}
+        settings["auto_tune"] = self.auto_tune
+        settings["max_open_handles"] = self.max_open_handles
+        settings["limits"] = self.limits
+
+        return settings
+
+    def enable_cache(self, ttl=30, max_entries=100000):
+        """
+        Cache the results of stat, lstat, canonicalize and readlink. Missing files are cached too.
+
+        listdir, listdir_attr and iter_dir fill the cache with the attributes they read. Methods that change a path
+        forget what was cached for it. Changes made by anyone else are only seen once entries expire.
+
+        :param ttl: How long results are kept, in seconds.
+        :param max_entries: The most results kept at once. The least recently used are dropped first.
+        :return: The metadata_cache. Its get_stats() reports hits and misses.
+        """
+        self.cache = metadata_cache(ttl, max_entries)
+
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
+
+    def enable_metrics(self, metrics=None):
+        """
+        Record the count, errors, bytes and latency of every request, by request type.
+
+        :param metrics: A request_metrics to record into, such as one shared with other clients. Default is a new one.
+        :return: The request_metrics. Use snapshot() or to_prometheus() on it to read the numbers.
+        """
+        self.dispatcher.metrics = request_metrics() if metrics is None else metrics
+
+        return self.dispatcher.metrics
+
+    def disable_metrics(self):
+        self.dispatcher.metrics = None
+
+    def add_hooks(self, hooks):
+        """
+        Call a request_hooks around every request from now on, such as a request_profiler.
+
+        :param hooks: A request_hooks.
+        :return: hooks.
+        """
+        self.dispatcher.hooks.append(hooks)
+
+        return hooks
+
+    def remove_hooks(self, hooks):
+        self.dispatcher.hooks.remove(hooks)
+
+    def __cache_lookup(self, kind, dir):
+        """
+        :return: (True, value) if the cache holds a result for dir, else (False, None).
+        """
+        if self.cache is None:
+            return False, None
+
+        return self.cache.get(kind, dir)
+
+    def __cache_fetch(self, kind, dir, fetch):
+        """
+        Call fetch() and cache its result. A SSH_FX_NO_SUCH_FILE error is cached as well, then raised.
+        """
+        try:
+            value = fetch()
+        except SFTP_error as e:
+            if not (self.cache is None) and e.get_status() == FX_names["SSH_FX_NO_SUCH_FILE"]:
+                self.cache.put(kind, dir, e)
+            raise
+
+        if not (self.cache is None):
+            self.cache.put(kind, dir, value)
+
+        return value
+
+    def __cache_value(self, value):
+        """
+        Return a cached result, raising it if it is a cached error.
+        """
+        if isinstance(value, SFTP_error):
+            raise SFTP_error(str(value), value.get_status())
+
+        return value
+
+    def __cached(self, kind, FXP_type, dir, parse):
+        """
+        Answer from the cache if possible, else send a request whose only argument is dir, and cache what parse()
+        makes of its response.
+        """
+        found, value = self.__cache_lookup(kind, dir)
+        if not found:
+            return self.__cache_fetch(kind, dir, lambda: parse(self.__request(path_request(FXP_type, dir))))
+
+        return self.__cache_value(value)
+
+    def __invalidate(self, dir, recursive=False):
+        """
+        Forget what is cached for a path that has changed.
+        """
+        if not (self.cache is None):
+            self.cache.invalidate(dir, recursive)
+
+    def submit(self, c_packet, priority=None, flow=None):
+        """
+        Send a request without waiting on its response. This is the low-level interface every SFTP method is
+        built on, and it allows many requests to be in flight at once.
+
+        Requests are scheduled by priority class. Reads and writes are "bulk", and everything else is "metadata",
+        which is sent first, so metadata calls stay fast while transfers run. See request_dispatcher.
+
+        :param c_packet: The request packet.
+        :param priority: "metadata" or "bulk", to override the class the request is scheduled in.
+        :param flow: What the request takes turns with in its class. Defaults to the handle the request is on.
+        :return: A request_future. Use result() on it to get the response packet.
+        """
+        self.__ensure_channel()
+
+        return self.dispatcher.submit(c_packet, priority, flow)
+
+    def set_bandwidth_limit(self, rate, burst=None):
+        """
+        Limit the file data this client reads and writes, across every transfer.
+
+        :param rate: The limit in bytes per second, or None for no limit.
+        :param burst: The most bytes sent at once after a quiet spell. Defaults to a tenth of a second's worth.
+        :return: The token_bucket. Set it as the bucket of other clients' dispatchers to share the limit.
+        """
+        self.dispatcher.bucket = None if rate is None else token_bucket(rate, burst)
+
+        return self.dispatcher.bucket
+
+    def __request(self, c_packet):
+        """
+        Send a request and wait on its response.
+
+        :param c_packet: The request packet.
+        :return: The response packet.
+        """
+        return self.submit(c_packet).result()
+
     def create_dir(self, dir, attr = None):
         """
         Create a directory.
@@ -114,30 +485,26 @@ class SFTP_client(SSH):
         :param attr: Attributes for the directory. Normally, this can be left alone.
         :return: None
         """
+        try:
+            check_status(self.__request(mkdir_request(dir, attr)))
+        finally:
+            self.__invalidate(dir)
 
-        # Create directory
-        """
-        uint32 id
-        string path
-        ATTRS attrs
+    def create_dirs(self, dirs, attr = None):
         """
-        c_packet = packet("SSH_FXP_MKDIR")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        if attr is None:
-            attr = attributes()
-        c_packet.add(attr)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
+        Create many directories, with the requests pipelined.
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+        :param dirs: The directories to create. Paths are relative to user's ~.
+        :param attr: Attributes for the directories. Normally, this can be left alone.
+        :return: None
+        """
+        futures = [self.submit(mkdir_request(dir, attr)) for dir in dirs]
+        try:
+            for future in futures:
+                check_status(future.result())
+        finally:
+            for dir in dirs:
+                self.__invalidate(dir)
 
     def remove_dir(self, dir):
         """
@@ -146,104 +513,92 @@ class SFTP_client(SSH):
         :param dir: The directory to remove. Path is relative to user's ~.
         :return: None
         """
+        try:
+            check_status(self.__request(path_request("SSH_FXP_RMDIR", dir)))
+        finally:
+            self.__invalidate(dir, recursive=True)
 
-        # Make directory
+    def remove_dirs(self, dirs):
         """
-        uint32 id
-        string path
+        Remove many directories, with the requests pipelined.
+
+        :param dirs: The directories to remove. Paths are relative to user's ~.
+        :return: None
         """
-        c_packet = packet("SSH_FXP_RMDIR")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        # waiting on response
-        response = self.__recv()
-        r_packet = packet(b=response)
+        futures = [self.submit(path_request("SSH_FXP_RMDIR", dir)) for dir in dirs]
+        try:
+            for future in futures:
+                check_status(future.result())
+        finally:
+            for dir in dirs:
+                self.__invalidate(dir, recursive=True)
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+    def __open_dir(self, dir):
+        """
+        Open a directory for reading, returning its handle.
+        """
+        r_packet = self.__request(path_request("SSH_FXP_OPENDIR", dir))
+        expect(r_packet, "SSH_FXP_HANDLE")
 
-    def listdir(self, dir):
+        return r_packet.get_items()[0]
+
+    def iter_dir(self, dir):
         """
-        Get the file names of files in a directory.
+        Iterate over the files in a directory, as the server sends them.
+
+        The next batch of entries is requested before the current batch is handed out, so the server is working
+        while the caller is. The directory handle is closed when the generator finishes or is closed.
 
         :param dir: Directory to crawl. Path is relative to user's ~.
-        :return: An array of strings
+        :return: A generator of (filename, longname, attributes) tuples
         """
+        handle = self.__open_dir(dir)
 
-        filenames = []
+        try:
+            future = self.submit(handle_request("SSH_FXP_READDIR", handle))
 
-        # List directory
-        """
-        uint32     id
-        string     path
-        """
-        c_packet = packet("SSH_FXP_OPENDIR")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        # waiting on response
-        response = self.__recv()
-        r_packet = packet(b=response)
-        handle = r_packet.get_items()[0]
+            # Read filenames from the directory until the directory is exhausted.
+            while True:
+                r_packet = future.result()
 
-        # Read filenames from the directory until the directory is exhausted.
-        reading = True
-        while reading:
-            try:
-                # Read in filenames
-                """
-                uint32     id
-                string     handle
-                """
-                c_packet = packet("SSH_FXP_READDIR")
-                c_packet.assign_next_id()
-                c_packet.add(handle)
-                bytes = c_packet.bytes()
-                self.__send(bytes)
-                # waiting on response
-                response = self.__recv()
-                r_packet = packet(b=response)
-
-                if r_packet.get_FXP_type() == "SSH_FXP_STATUS":
-                    reading = False # Done reading files from folder
-                else:
-                    items = r_packet.get_items()
+                if is_eof(r_packet):
+                    break # Done reading files from folder
+                expect(r_packet, "SSH_FXP_NAME")
 
-                    # Parse out filenames
-                    for i in range(1, len(items), 3):
-                        filenames.append(items[i])
+                # Prefetch the next batch
+                future = self.submit(handle_request("SSH_FXP_READDIR", handle))
 
-            except Exception as e:
-                print(e)
-                reading = False
+                items = r_packet.get_items()
+                if not (self.cache is None):
+                    self.__cache_listing(dir, items)
+                for i in range(1, len(items), 3):
+                    yield items[i], items[i + 1], items[i + 2]
+        finally:
+            check_status(self.__request(handle_request("SSH_FXP_CLOSE", handle)))
 
-        # Close the directory.
+    def __cache_listing(self, dir, items):
         """
-        uint32     id
-        string     handle
+        Cache the attributes of a batch of directory entries. READDIR attributes describe links, not their targets.
         """
-        c_packet = packet("SSH_FXP_CLOSE")
-        c_packet.assign_next_id()
-        c_packet.add(handle)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        # waiting on response
-        response = self.__recv()
-        r_packet = packet(b=response)
+        for i in range(1, len(items), 3):
+            filename = items[i]
+            if filename == "." or filename == "..":
+                continue
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+            path = posixpath.join(dir, filename)
+            attr = items[i + 2]
+            self.cache.put("lstat", path, attr)
+            if attr.get_file_type() != "S_IFLINK":
+                self.cache.put("stat", path, attr)
 
-        return filenames
+    def listdir(self, dir):
+        """
+        Get the file names of files in a directory.
+
+        :param dir: Directory to crawl. Path is relative to user's ~.
+        :return: An array of strings
+        """
+        return [filename for filename, longname, attr in self.iter_dir(dir)]
 
     def listdir_attr(self, dir):
         """
@@ -252,74 +607,113 @@ class SFTP_client(SSH):
         :param dir: Directory to crawl. Path is relative to user's ~.
         :return: An array of attributes
         """
-        attrs = []
+        return [attr for filename, longname, attr in self.iter_dir(dir)]
 
-        # Open a directory.
+    def walk(self, root, max_open_dirs=16, onerror=None):
         """
-        uint32     id
-        string     path
-        """
-        c_packet = packet("SSH_FXP_OPENDIR")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        # waiting on response
-        response = self.__recv()
-        r_packet = packet(b=response)
-        handle = r_packet.get_items()[0]
-
-        # Read filenames from the directory until the directory is exhausted.
-        """
-        uint32     id
-        string     handle
-        """
-        reading = True
-        while reading:
-            try:
-                c_packet = packet("SSH_FXP_READDIR")
-                c_packet.assign_next_id()
-                c_packet.add(handle)
-                bytes = c_packet.bytes()
-                self.__send(bytes)
-                # waiting on response
-                response = self.__recv()
-                r_packet = packet(b=response)
-
-                if r_packet.get_FXP_type() == "SSH_FXP_STATUS":
-                    reading = False # Done reading files from folder
-                else:
-                    items = r_packet.get_items()
-
-                    # Parse out attributes
-                    for i in range(3, len(items), 3):
-                        attrs.append(items[i])
+        Walk a directory tree breadth first.
 
-            except Exception as e:
-                print(e)
-                reading = False
+        Up to max_open_dirs directories are listed at once, with their OPENDIR, READDIR and CLOSE requests
+        pipelined on the one channel. Subdirectories are found from the S_IFDIR bit of the attributes READDIR
+        returns, so no extra stat calls are made. Symbolic links are not followed.
 
-        # Close the directory.
-        """
-        uint32     id
-        string     handle
+        :param root: Directory to walk. Path is relative to user's ~.
+        :param max_open_dirs: The maximum number of directories open at once. It is lowered to max_open_handles if
+        the server reported fewer.
+        :param onerror: Called with the path and exception of any directory that can't be listed. Such directories
+        are skipped.
+        :return: A generator of (dirpath, dirs, files) tuples, one per directory, in the order the directories finish.
+        dirs and files are arrays of (filename, attributes) tuples.
         """
-        c_packet = packet("SSH_FXP_CLOSE")
-        c_packet.assign_next_id()
-        c_packet.add(handle)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        # waiting on response
-        response = self.__recv()
-        r_packet = packet(b=response)
+        if self.max_open_handles:
+            max_open_dirs = min(max_open_dirs, self.max_open_handles)
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+        waiting = collections.deque([root]) # Directories found but not yet opened
+        active = [] # walk_states of the directories being listed
 
-        return attrs
+        try:
+            while waiting or active:
+                # Open more directories while there is room
+                while waiting and len(active) < max_open_dirs:
+                    dirpath = waiting.popleft()
+                    active.append(walk_state(dirpath, self.submit(path_request("SSH_FXP_OPENDIR", dirpath))))
+
+                # Move along every directory whose last request has been answered
+                progressed = False
+                for state in list(active):
+                    if not state.future.done():
+                        continue
+                    progressed = True
+
+                    try:
+                        finished = self.__walk_step(state)
+                    except Exception as e:
+                        active.remove(state)
+                        if not (state.handle is None) and state.phase != "close":
+                            self.submit(handle_request("SSH_FXP_CLOSE", state.handle))
+                        if not (onerror is None):
+                            onerror(state.dirpath, e)
+                        continue
+
+                    if finished:
+                        active.remove(state)
+                        waiting.extend(posixpath.join(state.dirpath, filename) for filename, attr in state.dirs)
+                        yield state.dirpath, state.dirs, state.files
+
+                if not progressed:
+                    self.dispatcher.read_response(lambda: any(state.future.done() for state in active))
+        finally:
+            # Close whatever is still open if the walk ends early
+            for state in active:
+                try:
+                    if state.phase == "open":
+                        self.__walk_step(state)
+                    if state.phase == "read":
+                        state.future.result()
+                        state.phase = "close"
+                        state.future = self.submit(handle_request("SSH_FXP_CLOSE", state.handle))
+                    state.future.result()
+                except Exception:
+                    pass
+
+    def __walk_step(self, state):
+        """
+        Handle the response to a walk_state's last request, and send its next one.
+
+        :return: True once the directory has been listed and closed.
+        """
+        r_packet = state.future.result()
+
+        if state.phase == "open":
+            expect(r_packet, "SSH_FXP_HANDLE")
+            state.handle = r_packet.get_items()[0]
+            state.phase = "read"
+            state.future = self.submit(handle_request("SSH_FXP_READDIR", state.handle))
+            return False
+
+        if state.phase == "read":
+            if is_eof(r_packet):
+                state.phase = "close"
+                state.future = self.submit(handle_request("SSH_FXP_CLOSE", state.handle))
+                return False
+            expect(r_packet, "SSH_FXP_NAME")
+
+            state.future = self.submit(handle_request("SSH_FXP_READDIR", state.handle))
+
+            items = r_packet.get_items()
+            for i in range(1, len(items), 3):
+                filename = items[i]
+                attr = items[i + 2]
+                if filename == "." or filename == "..":
+                    continue
+                if attr.get_file_type() == "S_IFDIR":
+                    state.dirs.append((filename, attr))
+                else:
+                    state.files.append((filename, attr))
+            return False
+
+        check_status(r_packet)
+        return True
 
     def stat(self, dir):
         """
@@ -328,24 +722,16 @@ class SFTP_client(SSH):
         :param dir: File to read attributes of. Path is relative to user's ~.
         :return: An attributes
         """
+        return self.__cached("stat", "SSH_FXP_STAT", dir, self.__attrs)
 
-        # Get file attributes via STAT, which follows symbolic links
-        """
-        uint32 id
-        string path
+    def stat_many(self, dirs):
         """
-        c_packet = packet("SSH_FXP_STAT")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
-
-        attr = r_packet.get_items()[0]
+        Get the attributes of many files, following symbolic links, with the requests pipelined.
 
-        return attr
+        :param dirs: Files to read attributes of. Paths are relative to user's ~.
+        :return: An array of attributes, in the same order as dirs
+        """
+        return self.__stat_many("stat", "SSH_FXP_STAT", dirs)
 
     def lstat(self, dir):
         """
@@ -354,24 +740,49 @@ class SFTP_client(SSH):
         :param dir: File to read attributes of. Path is relative to user's ~.
         :return: AN attributes
         """
+        return self.__cached("lstat", "SSH_FXP_LSTAT", dir, self.__attrs)
 
-        # Attempt LSTAT, aka get file attirbutes and do NOT follow smybolic links
+    def lstat_many(self, dirs):
         """
-        uint32 id
-        string path
+        Get the attributes of many files, NOT following symbolic links, with the requests pipelined.
+
+        :param dirs: Files to read attributes of. Paths are relative to user's ~.
+        :return: An array of attributes, in the same order as dirs
         """
-        c_packet = packet("SSH_FXP_LSTAT")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
+        return self.__stat_many("lstat", "SSH_FXP_LSTAT", dirs)
+
+    def __stat_many(self, kind, FXP_type, dirs):
+        """
+        Pipeline STAT or LSTAT requests for every path the cache can't answer.
+        """
+        known = {}
+        futures = {}
+        for dir in dirs:
+            if dir in known or dir in futures:
+                continue
+
+            found, value = self.__cache_lookup(kind, dir)
+            if found:
+                known[dir] = value
+            else:
+                futures[dir] = self.submit(path_request(FXP_type, dir))
+
+        attrs = []
+        for dir in dirs:
+            if not dir in known:
+                future = futures[dir]
+                known[dir] = self.__cache_fetch(kind, dir, lambda: self.__attrs(future.result()))
+            attrs.append(self.__cache_value(known[dir]))
+
+        return attrs
 
-        attr = r_packet.get_items()[0]
+    def __attrs(self, r_packet):
+        """
+        Get the attributes out of an SSH_FXP_ATTRS response.
+        """
+        expect(r_packet, "SSH_FXP_ATTRS")
 
-        return attr
+        return r_packet.get_items()[0]
 
     def setstat(self, dir, attr):
         """
@@ -381,28 +792,37 @@ class SFTP_client(SSH):
         :param attr: The attributes to use.
         :return: None
         """
+        try:
+            check_status(self.__request(setstat_request("SSH_FXP_SETSTAT", dir, attr)))
+        finally:
+            self.__invalidate(dir)
 
-        # SSH_FXP_SETSTAT
+    def __open(self, dir, pflags, attr = None):
         """
-        uint32 id
-        string path
-        ATTRS attrs
+        Open a file, returning its handle.
+
+        :param dir: File to open. Path is relative to user's ~.
+        :param pflags: The PFLAG_names to open the file with.
+        :param attr: The attributes of the file, if it is created.
         """
-        c_packet = packet("SSH_FXP_SETSTAT")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        c_packet.add(attr)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
+        r_packet = self.__request(open_request(dir, pflags, attr))
+        expect(r_packet, "SSH_FXP_HANDLE")
+
+        return r_packet.get_items()[0]
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+    def open(self, dir, mode="r"):
+        """
+        Open a file, keeping its handle open for many reads and writes.
+
+        :param dir: File to open. Path is relative to user's ~.
+        :param mode: A Python open() mode, such as "rb", "wb", "r+" or "a".
+        :return: A remote_file. It supports read, write, seek, tell and stat, and closes the handle when used as a
+        context manager.
+        """
+        handle = self.__open(dir, mode_pflags(mode))
+
+        return remote_file(self, handle, dir, mode, self.read_chunk_size, self.read_chunk_size*self.max_reads,
+                           self.write_chunk_size, self.max_writes)
 
     def create_file(self, dir, attr = None):
         """
@@ -412,190 +832,195 @@ class SFTP_client(SSH):
         :param attr: The attributes of a file. Default will create an empty file.
         :return: None
         """
+        try:
+            handle = self.__open(dir, ["SSH_FXF_CREAT"], attr)
+            check_status(self.__request(handle_request("SSH_FXP_CLOSE", handle)))
+        finally:
+            self.__invalidate(dir)
 
-        # Create
+    def write_file(self, dir, data=None, local_path=None):
         """
-        string filename
-        uint32 pflags
-        ATTRS attrs
-        """
-        c_packet = packet("SSH_FXP_OPEN")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        c_packet.add(c_packet.PFLAG_type_byte("SSH_FXF_CREAT"), 4)
-        if attr is None:
-            attr = attributes()
-        c_packet.add(attr)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
-        handle = r_packet.get_items()[0]
+        Write data to a file, replacing its contents.
 
-        # Close
-        """
-        uint32 id
-        string handle
-        """
-        c_packet = packet("SSH_FXP_CLOSE")
-        c_packet.assign_next_id()
-        c_packet.add(handle)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv() # Read any potential messages.
-        r_packet = packet(b=response)
+        The data is written in write_chunk_size chunks, with max_writes writes outstanding at once. If adaptive is
+        on, the window grows or shrinks from there with the round trip times it measures. See
+        get_transfer_metrics().
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+        :param dir: File to write. Path is relative to user's ~.
+        :param data: Data to write. This may be bytes, a string, or an iterable of chunks of either.
+        :param local_path: If given, the contents of this local file are written instead of data.
+        :return: The number of bytes written.
+        """
+        # Check what is to be written before the remote file is truncated
+        f = None
+        if local_path is None:
+            if data is None:
+                raise TypeError("write_file() needs data or local_path.")
+            if isinstance(data, (bytes, bytearray, memoryview, str)):
+                data = [data]
+        else:
+            f = open(local_path, "rb")
+
+        try:
+            handle = self.__open(dir, ["SSH_FXF_WRITE", "SSH_FXF_CREAT", "SSH_FXF_TRUNC"])
+
+            try:
+                engine = upload(self, handle, controller=self.transfer_controller("write"))
+                self.last_transfer = engine.controller
 
-    def write_file(self, dir, data):
+                if f is None:
+                    written = engine.run(data)
+                else:
+                    written = engine.run(iter(lambda: f.read(self.write_chunk_size), bytes()))
+            finally:
+                try:
+                    check_status(self.__request(handle_request("SSH_FXP_CLOSE", handle)))
+                finally:
+                    self.__invalidate(dir)
+        finally:
+            if not (f is None):
+                f.close()
+
+        return written
+
+    def read_file(self, dir, amount=None, offset=0, local_path=None):
         """
-        Write data to a file.
+        Read a file.
 
-        :param dir: File to write. Path is relative to user's ~.
-        :param data: Data to write
-        :return: None
+        The file is read in read_chunk_size chunks, with max_reads reads outstanding at once. If adaptive is on,
+        the window grows or shrinks from there with the round trip times it measures. See get_transfer_metrics().
+
+        :param dir: File to read. Path is relative to user's ~.
+        :param amount: The amount to read. Default reads to the end of the file.
+        :param offset: The offset to read from.
+        :param local_path: If given, the data is streamed to this local file instead of being returned.
+        :return: The data read, or the number of bytes written to local_path.
         """
+        handle = self.__open(dir, ["SSH_FXF_READ"])
 
-        # Open
+        try:
+            engine = download(self, handle, controller=self.transfer_controller("read"))
+            self.last_transfer = engine.controller
+
+            if local_path is None:
+                chunks = []
+                engine.run(chunks.append, offset, amount)
+                data = bytes().join(chunks)
+            else:
+                with open(local_path, "wb") as f:
+                    data = engine.run(f.write, offset, amount)
+        finally:
+            check_status(self.__request(handle_request("SSH_FXP_CLOSE", handle)))
+
+        return data
+
+    def transfer_controller(self, direction):
         """
-        string filename
-        uint32 pflags
-        ATTRS attrs
+        Make a window_controller for one transfer. It starts from the tuned settings. If adaptive is on, the window
+        may grow up to max_requests, and chunks may grow up to the largest the server reported in
+        limits@openssh.com, or shrink down to min_chunk_size. Reads in flight are also kept within the channel
+        window, as in tuning.
+
+        :param direction: "read" or "write".
         """
-        c_packet = packet("SSH_FXP_OPEN")
-        c_packet.assign_next_id()
-        c_packet.add("file_t")
-        c_packet.add(c_packet.PFLAG_type_byte("SSH_FXF_WRITE"), 4)
-        attr = attributes()
-        c_packet.add(attr)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
-        handle = r_packet.get_items()[0]
+        limits = self.limits or {}
+        if direction == "read":
+            window, chunk_size = self.max_reads, self.read_chunk_size
+            max_chunk_size = limits.get("max_read_length") or chunk_size
+
+            # However the window and chunks change, reads in flight never outgrow the channel window
+            max_chunk_size = max(chunk_size, min(max_chunk_size, self.window_size // window - 1024))
+            max_window = min(self.max_requests, max(window, self.window_size // (max_chunk_size + 1024)))
+        else:
+            window, chunk_size = self.max_writes, self.write_chunk_size
+            max_chunk_size = limits.get("max_write_length") or chunk_size
+            if limits.get("max_packet_length"):
+                max_chunk_size = min(max_chunk_size, limits["max_packet_length"] - 1024)
+            max_chunk_size = max(chunk_size, max_chunk_size)
+            max_window = self.max_requests
 
-        # Write
+        return window_controller(window, chunk_size, max_window=max_window, max_chunk_size=max_chunk_size,
+                                 min_chunk_size=self.min_chunk_size, adaptive=self.adaptive)
+
+    def get_transfer_metrics(self):
         """
-        uint32 id
-        string handle
-        uint64 offset
-        string data
+        Get what the last read_file() or write_file() measured, and how it sized its window and chunks.
+
+        :return: The dictionary window_controller.get_metrics() returns, or None before any transfer.
         """
-        try:
-            c_packet = packet("SSH_FXP_WRITE")
-            c_packet.assign_next_id()
-            c_packet.add(handle)
-            c_packet.add(0, 8)
-            c_packet.add(data)
-            bytes = c_packet.bytes()
-            self.__send(bytes)
-            print("waiting on response")
-            response = self.__recv()
-            packet(b=response)
-        except Exception as e:
-            print(e)
-
-        # Close
-        """
-        uint32 id
-        string handle
-        """
-        c_packet = packet("SSH_FXP_CLOSE")
-        c_packet.assign_next_id()
-        c_packet.add(handle)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
+        if self.last_transfer is None:
+            return None
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+        return self.last_transfer.get_metrics()
 
-    def read_file(self, dir, amount, offset=0):
+    def read_file_striped(self, dir, local_path, channels=4, clients=None, stripe_size=8388608, progress=None,
+                          retries=3):
         """
-        Read a file.
+        Download a large file over several sftp channels at once, to get past the throughput of one channel.
+
+        Each channel reads its own stripes of the file, straight into place in the local file. A stripe that fails
+        is retried from where it got to, on whichever channel is free first. If a channel may be broken, the extra
+        channels are reopened, but this client's own channel and those of the given clients are left alone, and
+        just stop taking stripes.
 
         :param dir: File to read. Path is relative to user's ~.
-        :param amount: The amount to read.
-        :param offset: The offset to read from.
-        :return: The data read.
+        :param local_path: Where to write the file locally.
+        :param channels: The number of channels to use. The extra channels are opened on this client's SSH
+        connection, and closed afterwards.
+        :param clients: The SFTP_clients to use instead, such as sessions from an SFTPPool on other transports.
+        :param stripe_size: The number of bytes in each stripe.
+        :param progress: Called with the number of bytes read so far and the file size, across every channel.
+        :param retries: How many times a stripe may fail and be retried.
+        :return: The number of bytes read.
         """
-        data = ""
+        return self.__striped(striped_download, dir, local_path, channels, clients, stripe_size, progress, retries)
 
-        # Open
+    def write_file_striped(self, dir, local_path, channels=4, clients=None, stripe_size=8388608, progress=None,
+                           retries=3):
         """
-        string filename
-        uint32 pflags
-        ATTRS attrs
+        Upload a large local file over several sftp channels at once, replacing the remote file's contents.
+
+        Each channel writes its own stripes of the file. A stripe that fails is retried from its last
+        acknowledged write, on whichever channel is free first. See read_file_striped() for the parameters.
+
+        :return: The number of bytes written.
         """
-        c_packet = packet("SSH_FXP_OPEN")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        c_packet.add(c_packet.PFLAG_type_byte("SSH_FXF_READ"), 4)
-        attr = attributes()
-        c_packet.add(attr)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
-        handle = r_packet.get_items()[0]
+        try:
+            return self.__striped(striped_upload, dir, local_path, channels, clients, stripe_size, progress, retries)
+        finally:
+            self.__invalidate(dir)
 
-        # Read
+    def __striped(self, engine, dir, local_path, channels, clients, stripe_size, progress, retries):
         """
-        uint32 id
-        string handle
-        uint64 offset
-        uint32 len
+        Run a striped transfer, opening sibling channels for it if no clients are given.
         """
+        siblings = []
         try:
-            c_packet = packet("SSH_FXP_READ")
-            c_packet.assign_next_id()
-            c_packet.add(handle)
-            c_packet.add(offset, 8)
-            c_packet.add(amount, 4)
-            bytes = c_packet.bytes()
-            self.__send(bytes)
-            print("waiting on response")
-            response = self.__recv()
-            r_packet = packet(b=response)
-
-            data = r_packet.get_items()[0]
-        except Exception as e:
-            print(e)
-
-        # Close
-        """
-        uint32 id
-        string handle
-        """
-        c_packet = packet("SSH_FXP_CLOSE")
-        c_packet.assign_next_id()
-        c_packet.add(handle)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
+            if clients is None:
+                siblings = [self.sibling() for i in range(channels - 1)]
+                clients = [self] + siblings
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+            return engine(clients, dir, stripe_size, retries, siblings).run(local_path, progress)
+        finally:
+            for client in siblings:
+                client.stop()
 
-        return data
+    def sibling(self):
+        """
+        Open another SFTP session on this client's SSH connection, with its own sftp channel and the same settings.
+        Stopping it leaves the SSH connection open.
+
+        :return: An SFTP_client. It shares this client's bandwidth limit, metrics and hooks.
+        """
+        client = SFTP_client(self.IP, self.username, ssh=self.ssh)
+        client.conn_timeout = self.conn_timeout
+        client.overrides = dict(self.overrides)
+        client.dispatcher.bucket = self.dispatcher.bucket
+        client.dispatcher.metrics = self.dispatcher.metrics
+        client.dispatcher.hooks = list(self.dispatcher.hooks)
+        client.open_sftp_channel(auto_tune=self.auto_tune)
+
+        return client
 
     def rename(self, dir, new_dir):
         """
@@ -605,28 +1030,11 @@ class SFTP_client(SSH):
         :param new_dir: Move file to here. Path is relative to user's ~.
         :return: None
         """
-
-        # Rename
-        """
-        uint32 id
-        string oldpath
-        string newpath
-        """
-        c_packet = packet("SSH_FXP_RENAME")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        c_packet.add(new_dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
-
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+        try:
+            check_status(self.__request(rename_request(dir, new_dir)))
+        finally:
+            self.__invalidate(dir, recursive=True)
+            self.__invalidate(new_dir, recursive=True)
 
     def remove_file(self, dir):
         """
@@ -635,25 +1043,25 @@ class SFTP_client(SSH):
         :param dir: File to remove. Path is relative to user's ~.
         :return: None
         """
-        # Remove
-        """
-        uint32 id
-        string filename
+        try:
+            check_status(self.__request(path_request("SSH_FXP_REMOVE", dir)))
+        finally:
+            self.__invalidate(dir)
+
+    def remove_files(self, dirs):
         """
-        c_packet = packet("SSH_FXP_REMOVE")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
+        Remove many files, with the requests pipelined.
 
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+        :param dirs: Files to remove. Paths are relative to user's ~.
+        :return: None
+        """
+        futures = [self.submit(path_request("SSH_FXP_REMOVE", dir)) for dir in dirs]
+        try:
+            for future in futures:
+                check_status(future.result())
+        finally:
+            for dir in dirs:
+                self.__invalidate(dir)
 
     def symlink(self, dir, link_to):
         """
@@ -663,27 +1071,10 @@ class SFTP_client(SSH):
         :param link_to: Where to symbolic link to. Path is relative to user's ~.
         :return:
         """
-        # SSH_FXP_SYMLINK
-        """
-        uint32 id
-        string linkpath
-        string targetpath
-        """
-        c_packet = packet("SSH_FXP_SYMLINK")
-        c_packet.assign_next_id()
-        c_packet.add(link_to)
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
-
-        # Check for errors
-        status_type = r_packet.get_items()[0]
-        status_message = r_packet.get_items()[1].lower()
-        if status_type != r_packet.FX_type_byte("SSH_FX_OK") and status_message != "success":
-            raise Exception(status_message)
+        try:
+            check_status(self.__request(symlink_request(dir, link_to)))
+        finally:
+            self.__invalidate(dir)
 
     def readlink(self, dir):
         """
@@ -692,22 +1083,7 @@ class SFTP_client(SSH):
         :param dir: Symbolic link to read. Path is relative to user's ~.
         :return:
         """
-
-        # SSH_FXP_READLINK
-        """
-        uint32 id
-        string path
-        """
-        c_packet = packet("SSH_FXP_READLINK")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
-
-        return r_packet.get_items()[1]
+        return self.__cached("readlink", "SSH_FXP_READLINK", dir, self.__name)
 
     def canonicalize(self, dir):
         """
@@ -716,19 +1092,33 @@ class SFTP_client(SSH):
         :param dir: Some path.
         :return: The canonicalzed path.
         """
+        return self.__cached("canonicalize", "SSH_FXP_REALPATH", dir, self.__name)
 
-        # SSH_FXP_REALPATH
+    def __name(self, r_packet):
         """
-        uint32 id
-        string path
+        Get the filename out of a single entry SSH_FXP_NAME response.
         """
-        c_packet = packet("SSH_FXP_REALPATH")
-        c_packet.assign_next_id()
-        c_packet.add(dir)
-        bytes = c_packet.bytes()
-        self.__send(bytes)
-        print("waiting on response")
-        response = self.__recv()
-        r_packet = packet(b=response)
+        expect(r_packet, "SSH_FXP_NAME")
+
+        return r_packet.get_items()[1]
+
+    def stop(self):
+        self.close_sftp_channel()
+        SSH.stop(self)
+
+class walk_state():
+    """
+    The progress of one directory in SFTP_client.walk().
+
+    phase is "open", "read" or "close", and future is the request_future of the directory's last request.
+    """
+
+    __slots__ = ("dirpath", "phase", "future", "handle", "dirs", "files")
 
-        return r_packet.get_items()[1]
\ No newline at end of file
+    def __init__(self, dirpath, future):
+        self.dirpath = dirpath
+        self.phase = "open"
+        self.future = future
+        self.handle = None
+        self.dirs = []
+        self.files = []
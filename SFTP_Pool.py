@@ -0,0 +1,386 @@
+"""
+Use SFTPPool to reuse logged in SFTP sessions instead of logging in for every job.
+"""
+# Handle imports
+from SFTP_Client import SFTP_client
+from Packet import SFTP_error
+from Dispatcher import token_bucket
+from Requests import path_request, expect
+
+import collections
+import contextlib
+import threading
+import time
+
+# Define classes
+class SFTPPool():
+    """
+    A pool of SFTP_clients, keyed by (IP, username). It is safe to share between threads.
+
+    Use checkout() to get a session and checkin() to give it back, or use session() as a context manager. Each
+    host must be registered with its credentials first, either with register() or by passing them to checkout().
+
+    Logging in is the slow part of starting a session, so one SSH transport carries up to channels_per_transport
+    sessions, each on its own sftp channel. A new transport is only connected once every transport is full.
+
+    Each host keeps at least min_size and at most max_size sessions. Sessions left idle for idle_timeout seconds
+    are closed, down to min_size. A session that has been idle for health_check_interval seconds is checked with a
+    round trip to the server before it is handed out, and replaced if it fails. Both happen during checkout() and
+    checkin(), or when reap() is called, since the pool runs no threads of its own.
+
+    If bandwidth_limit is given, every session shares one token_bucket, so the pool as a whole stays under it. If
+    metrics is given, every session records its requests in it.
+    """
+
+    def __init__(self, min_size=0, max_size=8, channels_per_transport=4, idle_timeout=300, health_check_interval=30,
+                 bandwidth_limit=None, metrics=None):
+        """
+        :param min_size: The fewest sessions kept open per host. They are opened when the host is registered.
+        :param max_size: The most sessions open per host. checkout() waits for a session past that.
+        :param channels_per_transport: The most sftp channels opened on one SSH transport.
+        :param idle_timeout: Seconds a session may sit unused before it is closed.
+        :param health_check_interval: Seconds a session may sit unused before it is checked on checkout.
+        :param bandwidth_limit: The most file data every session together may move, in bytes per second.
+        :param metrics: A request_metrics for every session to record its requests in.
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.channels_per_transport = channels_per_transport
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.bucket = None if bandwidth_limit is None else token_bucket(bandwidth_limit)
+        self.metrics = metrics
+
+        self.hosts = {} # (IP, username) -> host_pool
+        self.condition = threading.Condition() # Guards everything, and is notified when a session frees up
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def register(self, IP, username, password = None, key_filename = None):
+        """
+        Give the credentials for a host, and open its first min_size sessions.
+        """
+        with self.condition:
+            key = (IP, username)
+            if key in self.hosts:
+                self.hosts[key].password = password
+                self.hosts[key].key_filename = key_filename
+                return
+            self.hosts[key] = host_pool(IP, username, password, key_filename)
+
+        while True:
+            with self.condition:
+                host = self.hosts[key]
+                if host.size >= self.min_size:
+                    return
+                host.size += 1
+
+            try:
+                client = self.__open_session(host)
+            except BaseException:
+                with self.condition:
+                    host.size -= 1
+                raise
+            self.__release(host, client)
+
+    def checkout(self, IP, username, password = None, key_filename = None, timeout = None):
+        """
+        Get a session for a host, opening one if none are idle.
+
+        :param password: The password, if the host has not been registered.
+        :param key_filename: The key_filename, if the host has not been registered.
+        :param timeout: Seconds to wait for a session once max_size are open. Default waits forever.
+        :return: An SFTP_client with an open sftp channel. Give it back with checkin().
+        """
+        key = (IP, username)
+        if not (password is None and key_filename is None) and not key in self.hosts:
+            self.register(IP, username, password, key_filename)
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        closing = []
+        try:
+            with self.condition:
+                if not key in self.hosts:
+                    raise ValueError("No credentials for " + username + "@" + IP + ". Register the host first.")
+                host = self.hosts[key]
+                client, last_used = self.__wait_for_session(host, deadline, closing)
+        finally:
+            self.__close(closing)
+
+        # Log in or check health outside the lock, so other checkouts aren't held up
+        try:
+            if client is None:
+                return self.__open_session(host)
+            if time.monotonic() - last_used < self.health_check_interval or self.__is_healthy(client):
+                return client
+        except BaseException:
+            with self.condition:
+                host.size -= 1
+                host.in_use -= 1
+                self.condition.notify()
+            raise
+
+        # The session was broken, so replace it
+        with self.condition:
+            closing = self.__discard(host, client)
+        self.__close(closing)
+
+        try:
+            return self.__open_session(host)
+        except BaseException:
+            with self.condition:
+                host.size -= 1
+                host.in_use -= 1
+                self.condition.notify()
+            raise
+
+    def checkin(self, client, discard = False):
+        """
+        Give a session back to the pool.
+
+        :param client: An SFTP_client from checkout().
+        :param discard: Close the session instead of keeping it, such as after its connection broke.
+        """
+        with self.condition:
+            host = self.hosts[(client.IP, client.username)]
+            host.in_use -= 1
+
+            closing = None
+            if discard or self.closed or not client.channel_is_open():
+                host.size -= 1
+                closing = self.__discard(host, client)
+                self.condition.notify()
+
+        if closing is None:
+            self.__release(host, client)
+        else:
+            self.__close(closing)
+
+    @contextlib.contextmanager
+    def session(self, IP, username, password = None, key_filename = None, timeout = None):
+        """
+        Check out a session for the length of a with block.
+
+        The session is closed rather than reused if anything other than an SFTP_error escapes the block, since
+        its connection may be broken.
+        """
+        client = self.checkout(IP, username, password, key_filename, timeout)
+        try:
+            yield client
+        except SFTP_error:
+            self.checkin(client)
+            raise
+        except BaseException:
+            self.checkin(client, discard=True)
+            raise
+        self.checkin(client)
+
+    def reap(self):
+        """
+        Close the sessions that have been idle for longer than idle_timeout, down to min_size per host.
+        """
+        closing = []
+        with self.condition:
+            for host in self.hosts.values():
+                closing += self.__reap(host)
+        self.__close(closing)
+
+    def get_stats(self):
+        """
+        Get the size of the pool.
+
+        :return: A dictionary of (IP, username) to a dictionary of open, idle and in use sessions, and transports.
+        """
+        with self.condition:
+            return {key: {"open": host.size, "idle": len(host.idle), "in_use": host.in_use,
+                          "transports": len(host.transports)} for key, host in self.hosts.items()}
+
+    def close(self):
+        """
+        Close every idle session and transport. Sessions still checked out are closed when checked in.
+        """
+        closing = []
+        with self.condition:
+            self.closed = True
+            for host in self.hosts.values():
+                while host.idle:
+                    host.size -= 1
+                    closing += self.__discard(host, host.idle.pop()[0])
+            self.condition.notify_all()
+        self.__close(closing)
+
+    def __open_session(self, host):
+        """
+        Open a session on a transport with room for another channel, connecting a new transport if there is none.
+        The caller has already counted it in host.size.
+        """
+        with self.condition:
+            transport = None
+            for candidate in host.transports:
+                if candidate.channels < self.channels_per_transport and candidate.is_active():
+                    transport = candidate
+                    break
+            if not (transport is None):
+                transport.channels += 1
+
+        if transport is None:
+            client = SFTP_client(host.IP, host.username, password=host.password, key_filename=host.key_filename)
+            transport = transport_state(client.ssh)
+            with self.condition:
+                host.transports.append(transport)
+        else:
+            client = SFTP_client(host.IP, host.username, ssh=transport.ssh)
+
+        with self.condition:
+            host.clients[client] = transport
+        client.dispatcher.bucket = self.bucket
+        client.dispatcher.metrics = self.metrics
+
+        try:
+            client.open_sftp_channel()
+            if not client.channel_is_open():
+                raise RuntimeError("Could not open an sftp channel to " + host.username + "@" + host.IP + ".")
+        except BaseException:
+            with self.condition:
+                closing = self.__discard(host, client)
+            self.__close(closing)
+            raise
+
+        return client
+
+    def __release(self, host, client):
+        """
+        Put a session back on the idle list and wake a waiting checkout.
+        """
+        with self.condition:
+            host.idle.append((client, time.monotonic()))
+            closing = self.__reap(host)
+            self.condition.notify()
+        self.__close(closing)
+
+    def __is_healthy(self, client):
+        """
+        Check a session with a round trip to the server. The request is submitted directly, so the session's
+        metadata cache can't answer it.
+        """
+        try:
+            expect(client.submit(path_request("SSH_FXP_REALPATH", ".")).result(), "SSH_FXP_NAME")
+        except Exception:
+            return False
+
+        return client.channel_is_open()
+
+    def __wait_for_session(self, host, deadline, closing):
+        """
+        Wait for an idle session or room to open one. Called under the lock. Sessions reaped meanwhile are added to
+        closing, for the caller to close once the lock is released.
+
+        :return: (SFTP_client, time it was checked in) for an idle session, or (None, None) if one is to be opened.
+        """
+        while True:
+            if self.closed:
+                raise RuntimeError("SFTPPool is closed")
+            closing += self.__reap(host)
+
+            if host.idle:
+                host.in_use += 1
+                return host.idle.pop() # The most recently used session is the likeliest to be healthy
+            if host.size < self.max_size:
+                host.size += 1
+                host.in_use += 1
+                return None, None
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if not (remaining is None) and remaining <= 0:
+                raise TimeoutError("No SFTP session for " + host.username + "@" + host.IP + " became free in time.")
+            self.condition.wait(remaining)
+
+    def __reap(self, host):
+        """
+        Take the host's sessions that have been idle too long out of the pool, leaving at least min_size open.
+        Called under the lock.
+
+        :return: What to close, for __close() once the lock is released.
+        """
+        closing = []
+        expired = time.monotonic() - self.idle_timeout
+        while host.idle and host.idle[0][1] < expired and host.size > self.min_size:
+            host.size -= 1
+            closing += self.__discard(host, host.idle.popleft()[0])
+
+        return closing
+
+    def __discard(self, host, client):
+        """
+        Take a session out of the pool, and its transport once no channels are left on it. Called under the lock.
+        The caller uncounts it from host.size.
+
+        :return: What to close, for __close() once the lock is released. Closing goes over the network, so it must
+        not hold up the other hosts.
+        """
+        closing = [client]
+        transport = host.clients.pop(client, None)
+
+        if transport is None:
+            return closing
+        transport.channels -= 1
+        if transport.channels <= 0:
+            host.transports.remove(transport)
+            closing.append(transport.ssh)
+
+        return closing
+
+    def __close(self, closing):
+        """
+        Close the sessions and SSH connections __discard() took out of the pool. Called outside the lock.
+        """
+        for item in closing:
+            try:
+                if isinstance(item, SFTP_client):
+                    item.close_sftp_channel()
+                else:
+                    item.close()
+            except Exception:
+                pass
+
+class host_pool():
+    """
+    The sessions of one (IP, username) in an SFTPPool.
+
+    size counts every open session, including ones being opened and ones checked out. idle holds
+    (SFTP_client, time it was checked in) tuples, oldest first.
+    """
+
+    __slots__ = ("IP", "username", "password", "key_filename", "size", "in_use", "idle", "transports", "clients")
+
+    def __init__(self, IP, username, password, key_filename):
+        self.IP = IP
+        self.username = username
+        self.password = password
+        self.key_filename = key_filename
+        self.size = 0
+        self.in_use = 0
+        self.idle = collections.deque()
+        self.transports = [] # transport_states
+        self.clients = {} # SFTP_client -> the transport_state it is on
+
+class transport_state():
+    """
+    One SSH connection in an SFTPPool, and the number of sftp channels open on it.
+    """
+
+    __slots__ = ("ssh", "channels")
+
+    def __init__(self, ssh):
+        self.ssh = ssh
+        self.channels = 1
+
+    def is_active(self):
+        transport = self.ssh.get_transport()
+
+        return not (transport is None) and transport.is_active()
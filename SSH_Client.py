@@ -7,20 +7,27 @@ class SSH():
     Paramiko SSH implementation
     """
 
-    def __init__(self, IP, username, password = None, key_filename = None):
+    def __init__(self, IP, username, password = None, key_filename = None, ssh = None):
         """
-        Either password or key_filename is required.
+        Either password, key_filename or ssh is required.
 
         :param IP: The IP of the remote machine.
         :param username: The username of a user on the remote machine.
         :param password: The password of a user on a remote machine.
         :param key_filename: The key_filename on a remote machine.
+        :param ssh: A connected paramiko SSHClient to share, instead of logging in again. It is left open by stop().
         """
-        assert not ((password is None) and (key_filename is None)), "Please provide a password or key_filename."
+        assert not ((password is None) and (key_filename is None) and (ssh is None)), \
+            "Please provide a password or key_filename."
 
         self.IP = IP
+        self.username = username
 
-        self.max_packet_size = 1024
+        # Reuse an existing connection if given one
+        self.owns_ssh = ssh is None
+        if not self.owns_ssh:
+            self.ssh = ssh
+            return
 
         # Start parakimo for commands
         self.ssh = paramiko.SSHClient()
@@ -46,4 +53,5 @@ class SSH():
         return output
 
     def stop(self):
-        self.ssh.close()
\ No newline at end of file
+        if self.owns_ssh:
+            self.ssh.close()
\ No newline at end of file
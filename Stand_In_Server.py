@@ -0,0 +1,505 @@
+"""
+Use stand_in_server to run SFTP_client against a local directory instead of an SSH host, for tests and benchmarks.
+"""
+# Handle imports
+from Packet import FXP_names, FX_names, PFLAG_names, FXP_layouts, UINT32, UINT64, encode, unpack_uint32, unpack_string
+from Attributes import attributes
+
+import errno
+import os
+import posixpath
+import shutil
+import socket
+import stat
+import tempfile
+import threading
+import time
+
+# Define global vars
+FXP_types = {value: name for name, value in FXP_names.items()} # FXP type byte -> FXP_name
+
+# The status sent back for an OSError, by errno. Anything else is SSH_FX_FAILURE.
+errno_FX = {
+    errno.ENOENT: "SSH_FX_NO_SUCH_FILE",
+    errno.ENOTDIR: "SSH_FX_NO_SUCH_FILE",
+    errno.EACCES: "SSH_FX_PERMISSION_DENIED",
+    errno.EPERM: "SSH_FX_PERMISSION_DENIED"
+}
+
+# What the stand-in reports for limits@openssh.com, as OpenSSH does. max_read can be lowered per server.
+max_packet_length = 262144
+max_read_length = 261120
+max_write_length = 261120
+
+# Define classes
+class stand_in_server():
+    """
+    A local SFTP v3 server for tests and benchmarks. It serves a directory over socket pairs, with no SSH or
+    network involved, so runs are offline and reproducible.
+
+    Use client() to get an SFTP_client connected to it, or pass ssh=connect() to SFTP_client yourself. connect()
+    returns an object with the parts of a paramiko SSHClient that SFTP_client uses, so siblings and striped
+    transfers work too. Each sftp channel is served by its own session.
+
+    The link can be made slower than a socket pair:
+    latency is added to every response, counted from when its request arrived.
+    bandwidth caps the bytes per second moved each way on a channel.
+    max_read caps the bytes returned per SSH_FXP_READ, as many servers do.
+
+    Paths are resolved under root, which acts as both / and the home directory.
+    """
+
+    def __init__(self, root=None, latency=0.0, bandwidth=None, max_read=None, limits=True, readdir_batch=100):
+        """
+        :param root: The directory to serve. Defaults to a temporary directory, removed by close().
+        :param latency: Seconds added to every response.
+        :param bandwidth: Bytes per second each way on a channel. Default is as fast as a socket pair.
+        :param max_read: The most bytes returned per read. Default is what limits@openssh.com reports.
+        :param limits: Whether to offer the limits@openssh.com extension.
+        :param readdir_batch: The most entries returned per SSH_FXP_READDIR.
+        """
+        self.owns_root = root is None
+        self.root = tempfile.mkdtemp(prefix="sftp3-") if root is None else root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.max_read = max_read
+        self.limits = limits
+        self.readdir_batch = readdir_batch
+
+        self.sessions = []
+        self.requests = 0 # Requests answered, across every session
+        self.lock = threading.Lock() # Guards sessions and requests
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def connect(self):
+        """
+        Get a stand-in for a connected paramiko SSHClient. Pass it to SFTP_client as ssh.
+        """
+        return stand_in_ssh(self)
+
+    def client(self, **settings):
+        """
+        Get an SFTP_client with an open sftp channel to this server.
+
+        :param settings: Settings for open_sftp_channel(), such as max_requests or auto_tune.
+        :return: An SFTP_client.
+        """
+        from SFTP_Client import SFTP_client
+
+        client = SFTP_client("stand-in", "stand-in", ssh=self.connect())
+        client.open_sftp_channel(**settings)
+
+        return client
+
+    def open_channel(self):
+        """
+        Start a session on a new socket pair.
+
+        :return: The client's end, as a stand_in_channel.
+        """
+        client_end, server_end = socket.socketpair()
+        session = stand_in_session(self, server_end)
+        with self.lock:
+            self.sessions.append(session)
+        session.start()
+
+        return stand_in_channel(client_end)
+
+    def get_stats(self):
+        """
+        :return: A dictionary of the number of channels opened and requests answered.
+        """
+        with self.lock:
+            return {"channels": len(self.sessions), "requests": self.requests}
+
+    def path(self, dir):
+        """
+        Get the local path of a remote path. Nothing outside root can be reached.
+        """
+        if not isinstance(dir, str):
+            dir = bytes(dir).decode("utf-8")
+
+        return os.path.join(self.root, posixpath.normpath("/" + dir).lstrip("/"))
+
+    def close(self):
+        """
+        Close every session, and remove root if it is a temporary directory.
+        """
+        with self.lock:
+            sessions = self.sessions
+            self.sessions = []
+        for session in sessions:
+            session.close()
+
+        if self.owns_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+class stand_in_ssh():
+    """
+    The parts of a paramiko SSHClient, and of its transport, that SFTP_client uses, backed by a stand_in_server.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.active = True
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return self.active
+
+    def open_session(self, window_size=None, max_packet_size=None, timeout=None):
+        return self.server.open_channel()
+
+    def exec_command(self, cmd):
+        raise NotImplementedError("The stand-in server only serves sftp.")
+
+    def close(self):
+        self.active = False
+
+class stand_in_channel():
+    """
+    The client's end of a stand_in_session, with the parts of a paramiko Channel that the clients use.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.closed = False
+        self.eof_received = False
+
+    def invoke_subsystem(self, name):
+        if name != "sftp":
+            raise ValueError("The stand-in server only serves sftp.")
+
+    def exit_status_ready(self):
+        return self.closed
+
+    def settimeout(self, timeout):
+        self.sock.settimeout(timeout)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, data):
+        return self.sock.send(data)
+
+    def sendall(self, data):
+        return self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        return self.sock.sendmsg(buffers)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def recv_into(self, view):
+        return self.sock.recv_into(view)
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+class stand_in_session():
+    """
+    One sftp channel of a stand_in_server.
+
+    One thread reads requests and answers them in order, as OpenSSH does. Another sends the responses once their
+    latency has passed, so requests are pipelined as they would be on a real link.
+    """
+
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.handles = {} # handle -> ("file", fd) or ("dir", [local path, names left to send])
+        self.next_handle = 0
+
+        self.responses = [] # (time to send at, buffers), in order
+        self.condition = threading.Condition() # Guards responses and closed
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self.__read_requests, daemon=True).start()
+        threading.Thread(target=self.__send_responses, daemon=True).start()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+        for kind, obj in self.handles.values():
+            if kind == "file":
+                os.close(obj)
+        self.handles = {}
+
+    def __recv_exactly(self, length):
+        msg = bytearray(length)
+        view = memoryview(msg)
+        received = 0
+        while received < length:
+            count = self.sock.recv_into(view[received:])
+            if count == 0:
+                raise EOFError("client closed the channel")
+            received += count
+
+        return msg
+
+    def __throttle(self, length):
+        """
+        Take as long as length bytes take to cross the link.
+        """
+        if self.server.bandwidth:
+            time.sleep(length/float(self.server.bandwidth))
+
+    def __read_requests(self):
+        try:
+            while True:
+                length = UINT32.unpack(self.__recv_exactly(4))[0]
+                msg = self.__recv_exactly(length)
+                self.__throttle(4 + length)
+                arrived = time.monotonic()
+
+                buffers = self.__answer(memoryview(msg))
+                with self.server.lock:
+                    self.server.requests += 1
+
+                with self.condition:
+                    self.responses.append((arrived + self.server.latency, buffers))
+                    self.condition.notify()
+        except (EOFError, OSError):
+            self.close()
+
+    def __send_responses(self):
+        while True:
+            with self.condition:
+                while not self.responses and not self.closed:
+                    self.condition.wait()
+                if not self.responses:
+                    return
+                send_at, buffers = self.responses.pop(0)
+
+            wait = send_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.__throttle(sum(len(buffer) for buffer in buffers))
+
+            try:
+                for buffer in buffers:
+                    self.sock.sendall(buffer)
+            except OSError:
+                return
+
+    def __answer(self, b):
+        """
+        Carry out one request.
+
+        :param b: The request, after its length header.
+        :return: The buffers of the response.
+        """
+        FXP_type = FXP_types.get(b[0])
+
+        if FXP_type == "SSH_FXP_INIT":
+            items = [3]
+            if self.server.limits:
+                items += ["limits@openssh.com", "1"]
+            return encode("SSH_FXP_VERSION", None, items)
+
+        id, i = unpack_uint32(b, 1)
+        if FXP_type == "SSH_FXP_EXTENDED":
+            name, i = unpack_string(b, i)
+            if bytes(name) == b"limits@openssh.com" and self.server.limits:
+                max_read = max_read_length if self.server.max_read is None else self.server.max_read
+                return encode("SSH_FXP_EXTENDED_REPLY", id, [max_packet_length, max_read, max_write_length, 0],
+                              [8, 8, 8, 8])
+            return self.__status(id, "SSH_FX_OP_UNSUPPORTED", "Unsupported extension")
+
+        if not FXP_type in FXP_layouts:
+            return self.__status(id, "SSH_FX_OP_UNSUPPORTED", "Unsupported request")
+
+        # Read the request's fields, as laid out in FXP_layouts
+        items = []
+        for kind in FXP_layouts[FXP_type]:
+            if kind == "uint32":
+                item, i = unpack_uint32(b, i)
+            elif kind == "uint64":
+                item = UINT64.unpack_from(b, i)[0]
+                i += 8
+            elif kind == "attrs":
+                item = attributes()
+                i = item.decode(b, i)
+            else:
+                item, i = unpack_string(b, i)
+            items.append(item)
+
+        try:
+            return getattr(self, "_stand_in_session__" + FXP_type[8:])(id, *items)
+        except OSError as e:
+            return self.__status(id, errno_FX.get(e.errno, "SSH_FX_FAILURE"), e.strerror or "Failure")
+        except KeyError:
+            return self.__status(id, "SSH_FX_FAILURE", "Invalid handle")
+
+    def __status(self, id, FX_name, message=""):
+        return encode("SSH_FXP_STATUS", id, [FX_names[FX_name], message, ""])
+
+    def __ok(self, id):
+        return self.__status(id, "SSH_FX_OK", "Success")
+
+    def __handle(self, handle, kind):
+        found_kind, obj = self.handles[bytes(handle)]
+        if found_kind != kind:
+            raise KeyError(handle)
+
+        return obj
+
+    def __attributes(self, s):
+        return attributes(size=s.st_size, uid=s.st_uid, gid=s.st_gid, permissions=s.st_mode,
+                          atime=int(s.st_atime), mtime=int(s.st_mtime))
+
+    def __set_attributes(self, target, attr):
+        """
+        Apply attributes to a local path or file descriptor.
+        """
+        if not (attr.size is None):
+            os.truncate(target, attr.size)
+        if not (attr.permissions is None):
+            os.chmod(target, stat.S_IMODE(attr.permissions))
+        if not (attr.atime is None) and not (attr.mtime is None):
+            os.utime(target, (attr.atime, attr.mtime))
+
+    def __OPEN(self, id, dir, pflags, attr):
+        flags = 0
+        if pflags & PFLAG_names["SSH_FXF_READ"] and pflags & PFLAG_names["SSH_FXF_WRITE"]:
+            flags = os.O_RDWR
+        elif pflags & PFLAG_names["SSH_FXF_WRITE"]:
+            flags = os.O_WRONLY
+        if pflags & PFLAG_names["SSH_FXF_APPEND"]:
+            flags |= os.O_APPEND
+        if pflags & PFLAG_names["SSH_FXF_CREAT"]:
+            flags |= os.O_CREAT
+        if pflags & PFLAG_names["SSH_FXF_TRUNC"]:
+            flags |= os.O_TRUNC
+        if pflags & PFLAG_names["SSH_FXF_EXCL"]:
+            flags |= os.O_EXCL
+
+        mode = 0o644 if attr.permissions is None else stat.S_IMODE(attr.permissions)
+
+        return self.__open_handle(id, "file", os.open(self.server.path(dir), flags, mode))
+
+    def __open_handle(self, id, kind, obj):
+        handle = str(self.next_handle).encode("utf-8")
+        self.next_handle += 1
+        self.handles[handle] = (kind, obj)
+
+        return encode("SSH_FXP_HANDLE", id, [handle])
+
+    def __CLOSE(self, id, handle):
+        kind, obj = self.handles.pop(bytes(handle))
+        if kind == "file":
+            os.close(obj)
+
+        return self.__ok(id)
+
+    def __READ(self, id, handle, offset, length):
+        max_read = max_read_length if self.server.max_read is None else self.server.max_read
+        data = os.pread(self.__handle(handle, "file"), min(length, max_read), offset)
+        if not data:
+            return self.__status(id, "SSH_FX_EOF", "End of file")
+
+        return encode("SSH_FXP_DATA", id, [data])
+
+    def __WRITE(self, id, handle, offset, data):
+        os.pwrite(self.__handle(handle, "file"), data, offset)
+
+        return self.__ok(id)
+
+    def __LSTAT(self, id, dir):
+        return encode("SSH_FXP_ATTRS", id, [self.__attributes(os.lstat(self.server.path(dir)))])
+
+    def __STAT(self, id, dir):
+        return encode("SSH_FXP_ATTRS", id, [self.__attributes(os.stat(self.server.path(dir)))])
+
+    def __FSTAT(self, id, handle):
+        return encode("SSH_FXP_ATTRS", id, [self.__attributes(os.fstat(self.__handle(handle, "file")))])
+
+    def __SETSTAT(self, id, dir, attr):
+        self.__set_attributes(self.server.path(dir), attr)
+
+        return self.__ok(id)
+
+    def __FSETSTAT(self, id, handle, attr):
+        self.__set_attributes(self.__handle(handle, "file"), attr)
+
+        return self.__ok(id)
+
+    def __OPENDIR(self, id, dir):
+        local = self.server.path(dir)
+        names = [".", ".."] + sorted(os.listdir(local))
+
+        return self.__open_handle(id, "dir", [local, names])
+
+    def __READDIR(self, id, handle):
+        local, names = self.__handle(handle, "dir")
+        if not names:
+            return self.__status(id, "SSH_FX_EOF", "End of file")
+
+        batch = names[:self.server.readdir_batch]
+        del names[:self.server.readdir_batch]
+
+        items = [len(batch)]
+        for name in batch:
+            s = os.lstat(os.path.join(local, name))
+            longname = stat.filemode(s.st_mode) + " 1 " + str(s.st_uid) + " " + str(s.st_gid) + " " + \
+                str(s.st_size) + " " + time.strftime("%b %d %H:%M", time.gmtime(s.st_mtime)) + " " + name
+            items += [name, longname, self.__attributes(s)]
+
+        return encode("SSH_FXP_NAME", id, items)
+
+    def __REMOVE(self, id, dir):
+        os.remove(self.server.path(dir))
+
+        return self.__ok(id)
+
+    def __MKDIR(self, id, dir, attr):
+        mode = 0o755 if attr.permissions is None else stat.S_IMODE(attr.permissions)
+        os.mkdir(self.server.path(dir), mode)
+
+        return self.__ok(id)
+
+    def __RMDIR(self, id, dir):
+        os.rmdir(self.server.path(dir))
+
+        return self.__ok(id)
+
+    def __REALPATH(self, id, dir):
+        path = posixpath.normpath("/" + bytes(dir).decode("utf-8"))
+
+        return encode("SSH_FXP_NAME", id, [1, path, path, attributes()])
+
+    def __RENAME(self, id, dir, new_dir):
+        # Like OpenSSH, SSH_FXP_RENAME never replaces an existing file
+        if os.path.lexists(self.server.path(new_dir)):
+            return self.__status(id, "SSH_FX_FAILURE", "File exists")
+        os.rename(self.server.path(dir), self.server.path(new_dir))
+
+        return self.__ok(id)
+
+    def __READLINK(self, id, dir):
+        target = os.readlink(self.server.path(dir))
+
+        return encode("SSH_FXP_NAME", id, [1, target, target, attributes()])
+
+    def __SYMLINK(self, id, target, link):
+        # OpenSSH reads the target first, and SFTP_client sends it that way
+        os.symlink(bytes(target).decode("utf-8"), self.server.path(link))
+
+        return self.__ok(id)
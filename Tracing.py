@@ -0,0 +1,200 @@
+"""
+Use request_hooks to see each request on its way through the client, and request_profiler to see where the time goes.
+"""
+# Handle imports
+import json
+import threading
+
+# Define global vars
+# The phases of a request, in order. wait covers the network and the server, from the send to reading the response.
+PHASES = ("encode", "send", "wait", "decode")
+
+# Define classes
+class request_trace():
+    """
+    One request's trip through the client, filled in as it goes. Hooks are given the same request_trace at every
+    point, with everything up to that point filled in.
+
+    Times are time.perf_counter() timestamps, which are monotonic. Sizes are whole packets, headers included.
+    """
+
+    __slots__ = ("FXP_type", "id", "bytes_out", "encode_start", "encode_end", "send_start", "send_end",
+                 "send_thread", "response_type", "bytes_in", "received_at", "decoded_at", "receive_thread")
+
+    def __init__(self, FXP_type, id):
+        self.FXP_type = FXP_type # The FXP_name of the request
+        self.id = id
+        self.bytes_out = None
+        self.encode_start = None
+        self.encode_end = None
+        self.send_start = None # Once the channel is free to send on
+        self.send_end = None
+        self.send_thread = None # The threading.get_ident() of the thread that sent the request
+        self.response_type = None # The FXP_name of the response
+        self.bytes_in = None
+        self.received_at = None # When the whole response had been read off the channel
+        self.decoded_at = None
+        self.receive_thread = None # The threading.get_ident() of the thread that read the response
+
+    def get_phases(self):
+        """
+        Get the seconds spent in each phase, once the response has been decoded.
+
+        :return: A dictionary of phase name, from PHASES, to seconds.
+        """
+        return {
+            "encode": self.encode_end - self.encode_start,
+            "send": self.send_end - self.send_start,
+            "wait": self.received_at - self.send_end,
+            "decode": self.decoded_at - self.received_at
+        }
+
+class request_hooks():
+    """
+    Hook points around every request. Subclass it, override the points you need, and add it to a client with
+    SFTP_client.add_hooks().
+
+    pre_send is called once a request is encoded, just before it is sent.
+    post_send is called once it has been sent.
+    on_response is called once its response has been read off the channel, before it is decoded.
+    post_decode is called once its response has been decoded.
+
+    Each is given the request's request_trace. Hooks run on whichever thread is sending or reading, and should
+    return quickly, since the next request waits on them.
+    """
+
+    def pre_send(self, trace):
+        pass
+
+    def post_send(self, trace):
+        pass
+
+    def on_response(self, trace):
+        pass
+
+    def post_decode(self, trace):
+        pass
+
+class request_profiler(request_hooks):
+    """
+    A request_hooks that breaks the time spent on requests into the PHASES: encode, send, wait and decode.
+
+    Use get_summary() for the totals, write_chrome_trace() for a timeline to open in chrome://tracing or Perfetto,
+    and write_folded() for folded stacks that flamegraph.pl and speedscope read.
+
+    Requests are pipelined, so their waits overlap. Phase totals can add up to more than the wall time.
+    """
+
+    def __init__(self, max_traces=1000000):
+        """
+        :param max_traces: The most request_traces kept for write_chrome_trace(). Totals count every request.
+        """
+        self.max_traces = max_traces
+        self.traces = []
+        self.dropped = 0 # Traces not kept, past max_traces
+        self.totals = {} # Request type -> {"count", and seconds per phase}
+        self.first = None # The earliest timestamp seen
+        self.last = None # The latest timestamp seen
+        self.lock = threading.Lock() # Guards everything, since several threads may be sending and reading
+
+    def post_decode(self, trace):
+        phases = trace.get_phases()
+
+        with self.lock:
+            totals = self.totals.get(trace.FXP_type)
+            if totals is None:
+                totals = self.totals[trace.FXP_type] = dict.fromkeys(("count",) + PHASES, 0)
+            totals["count"] += 1
+            for phase, seconds in phases.items():
+                totals[phase] += seconds
+
+            if self.first is None or trace.encode_start < self.first:
+                self.first = trace.encode_start
+            if self.last is None or trace.decoded_at > self.last:
+                self.last = trace.decoded_at
+
+            if len(self.traces) < self.max_traces:
+                self.traces.append(trace)
+            else:
+                self.dropped += 1
+
+    def reset(self):
+        with self.lock:
+            self.traces = []
+            self.dropped = 0
+            self.totals = {}
+            self.first = None
+            self.last = None
+
+    def get_summary(self):
+        """
+        :return: A dictionary of wall, the seconds from the first request to the last response, requests, the
+        number of requests, phases, the seconds spent in each phase, and by_type, a dictionary of request type to
+        its count and phases.
+        """
+        with self.lock:
+            phases = dict.fromkeys(PHASES, 0)
+            requests = 0
+            by_type = {}
+            for FXP_type, totals in self.totals.items():
+                by_type[FXP_type] = dict(totals)
+                requests += totals["count"]
+                for phase in PHASES:
+                    phases[phase] += totals[phase]
+
+            wall = 0 if self.first is None else self.last - self.first
+
+            return {"wall": wall, "requests": requests, "phases": phases, "by_type": by_type}
+
+    def write_chrome_trace(self, path):
+        """
+        Write the kept requests in the Chrome trace event format.
+
+        Encoding, sending and decoding are shown on the thread that did them. Waits overlap, so each is shown as
+        its own async span, which Chrome and Perfetto draw on separate rows.
+
+        :param path: The JSON file to write.
+        """
+        with self.lock:
+            traces = list(self.traces)
+            start = self.first
+
+        def us(at):
+            return (at - start) * 1e6
+
+        events = []
+        for index, trace in enumerate(traces):
+            name = trace.FXP_type[8:] if trace.FXP_type.startswith("SSH_FXP_") else trace.FXP_type
+            args = {"id": trace.id, "bytes_out": trace.bytes_out, "bytes_in": trace.bytes_in,
+                    "response": trace.response_type}
+
+            for phase, begin, end, thread in (("encode", trace.encode_start, trace.encode_end, trace.send_thread),
+                                              ("send", trace.send_start, trace.send_end, trace.send_thread),
+                                              ("decode", trace.received_at, trace.decoded_at, trace.receive_thread)):
+                events.append({"name": name + " " + phase, "cat": phase, "ph": "X", "pid": 1, "tid": thread,
+                               "ts": us(begin), "dur": us(end) - us(begin), "args": args})
+
+            # Request ids repeat across channels, so spans are numbered by their index instead
+            events.append({"name": name + " wait", "cat": "wait", "ph": "b", "pid": 1, "id": index,
+                           "ts": us(trace.send_end), "args": args})
+            events.append({"name": name + " wait", "cat": "wait", "ph": "e", "pid": 1, "id": index,
+                           "ts": us(trace.received_at)})
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def write_folded(self, path):
+        """
+        Write the phase totals as folded stacks, one "SFTP;type;phase microseconds" line each.
+
+        :param path: The text file to write.
+        """
+        summary = self.get_summary()
+
+        with open(path, "w") as f:
+            for FXP_type, totals in sorted(summary["by_type"].items()):
+                name = FXP_type[8:] if FXP_type.startswith("SSH_FXP_") else FXP_type
+                for phase in PHASES:
+                    microseconds = int(round(totals[phase] * 1e6))
+                    if microseconds > 0:
+                        f.write("SFTP;" + name + ";" + phase + " " + str(microseconds) + "\n")
@@ -0,0 +1,615 @@
+"""
+Pipelined transfer engines that move file contents over an open handle.
+"""
+# Handle imports
+from Requests import path_request, handle_request, open_request, read_request, write_request, check_status, expect, \
+    is_eof
+from Packet import SFTP_error
+
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import math
+import os
+import threading
+import time
+
+# Define classes
+class window_controller():
+    """
+    Decides how many requests a transfer keeps in flight, and how large each one is.
+
+    Every answered request is reported with its size and round trip time. Once a window's worth of requests has
+    been answered, a round ends, and the controller looks at the round:
+
+    * If the smoothed round trip time is close to the lowest one seen, requests aren't queueing anywhere, so the
+      window grows. It doubles each round at first, like TCP slow start, then grows by one request per round.
+    * If the round trip time has risen well above the lowest one, requests are queueing, so the window shrinks by
+      a quarter. It never shrinks below the bandwidth-delay product, the number of requests the best throughput
+      seen needs at the lowest round trip time, plus one, so the link is kept full. On a link limited by its
+      bandwidth, requests queue behind each other however few are in flight, so this is where the window settles.
+    * Chunks double once the window is at max_window, or while the throughput holds at the best seen even though
+      requests are queueing. They halve only once the window is at min_window and the throughput has dropped too.
+      Chunks stay within their bounds, and by default never shrink below the size they started at.
+
+    Each decision is kept in events, with the measurements behind it, so get_metrics() can show why a transfer ran
+    at the speed it did. With adaptive off, the window and chunk size stay put and only the measurements are kept.
+    """
+
+    decrease = 0.75 # The window is multiplied by this when requests are queueing
+    hold = 0.9 # The fraction of the best throughput a round must reach for the throughput to count as holding
+    tolerance = 0.5 # How far above the lowest round trip time the smoothed one may rise before it counts as queueing
+    slack = 0.002 # Seconds of round trip time jitter that never count as queueing
+    max_events = 64 # The number of decisions kept
+
+    def __init__(self, window, chunk_size, max_window=None, min_window=1, max_chunk_size=None,
+                 min_chunk_size=None, adaptive=True, clock=time.monotonic):
+        """
+        :param window: The number of requests to keep in flight at first.
+        :param chunk_size: The number of bytes per request at first.
+        :param max_window: The most requests in flight. Defaults to window.
+        :param min_window: The fewest requests in flight.
+        :param max_chunk_size: The most bytes per request. Defaults to chunk_size.
+        :param min_chunk_size: The fewest bytes per request. Defaults to chunk_size.
+        :param adaptive: Whether to change the window and chunk size.
+        :param clock: Returns the current time, in seconds.
+        """
+        self.window = window
+        self.chunk_size = chunk_size
+        self.max_window = window if max_window is None else max(window, max_window)
+        self.min_window = min(min_window, window)
+        self.max_chunk_size = chunk_size if max_chunk_size is None else max(chunk_size, max_chunk_size)
+        self.min_chunk_size = chunk_size if min_chunk_size is None else min(min_chunk_size, chunk_size)
+        self.adaptive = adaptive
+        self.clock = clock
+
+        self.slow_start = True
+        self.min_rtt = None
+        self.srtt = None # Smoothed round trip time
+        self.max_throughput = 0.0 # The best throughput of any round, in bytes per second
+        self.started_at = None
+        self.round_started_at = None
+        self.round_requests = 0
+        self.round_bytes = 0
+
+        self.requests = 0
+        self.bytes = 0
+        self.increases = 0
+        self.decreases = 0
+        self.events = collections.deque(maxlen=self.max_events)
+
+    def limit_chunk_size(self, chunk_size):
+        """
+        Cap the chunk size, such as when the server returns less than was asked for.
+        """
+        self.max_chunk_size = max(1, min(self.max_chunk_size, chunk_size))
+        self.min_chunk_size = min(self.min_chunk_size, self.max_chunk_size)
+        self.chunk_size = min(self.chunk_size, self.max_chunk_size)
+
+    def on_sent(self):
+        """
+        Note that a request was sent, to time the first round from.
+        """
+        if self.round_started_at is None:
+            self.round_started_at = self.clock()
+            if self.started_at is None:
+                self.started_at = self.round_started_at
+
+    def on_response(self, length, rtt):
+        """
+        Report an answered request.
+
+        :param length: The number of bytes the request moved.
+        :param rtt: The request's round trip time in seconds, or None if it is unknown.
+        """
+        self.on_sent()
+        self.requests += 1
+        self.bytes += length
+        self.round_requests += 1
+        self.round_bytes += length
+
+        if not (rtt is None):
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+            self.srtt = rtt if self.srtt is None else 0.875*self.srtt + 0.125*rtt
+
+        if self.round_requests >= self.window:
+            self.__end_round()
+
+    def __end_round(self):
+        now = self.clock()
+        duration = now - (now if self.round_started_at is None else self.round_started_at)
+        throughput = self.round_bytes / duration if duration > 0 else 0.0
+        self.max_throughput = max(self.max_throughput, throughput)
+        self.round_started_at = now
+        self.round_requests = 0
+        self.round_bytes = 0
+
+        if not self.adaptive or self.min_rtt is None:
+            return
+
+        queueing = self.srtt > self.min_rtt*(1 + self.tolerance) + self.slack
+        holding = throughput >= self.max_throughput*self.hold
+        if queueing:
+            self.slow_start = False
+
+            # Keep enough requests in flight to fill the link at the best throughput seen, and one more for jitter
+            pipe = int(math.ceil(self.max_throughput*self.min_rtt/self.chunk_size)) + 1
+            window = max(self.min_window, int(self.window*self.decrease), min(pipe, self.max_window))
+            if window < self.window:
+                self.window = window
+                self.decreases += 1
+                self.__log("decrease", "round trip " + self.__ms(self.srtt) + " is over " + self.__ms(self.min_rtt),
+                           throughput)
+            elif holding and self.chunk_size < self.max_chunk_size:
+                self.chunk_size = min(self.max_chunk_size, self.chunk_size*2)
+                self.increases += 1
+                self.__log("grow chunk", "throughput holds while queueing", throughput)
+            elif not holding and self.window == self.min_window and self.chunk_size > self.min_chunk_size:
+                self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+                self.decreases += 1
+                self.__log("shrink chunk", "throughput dropped at the smallest window", throughput)
+        elif self.window < self.max_window:
+            self.window = min(self.max_window, self.window*2 if self.slow_start else self.window + 1)
+            self.increases += 1
+            self.__log("increase", "round trip " + self.__ms(self.srtt) + " is near " + self.__ms(self.min_rtt),
+                       throughput)
+        elif self.chunk_size < self.max_chunk_size:
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size*2)
+            self.increases += 1
+            self.__log("grow chunk", "no queueing at the largest window", throughput)
+
+    def __ms(self, seconds):
+        return str(round(seconds*1000, 2)) + " ms"
+
+    def __log(self, action, reason, throughput):
+        self.events.append({
+            "time": self.clock() - self.started_at,
+            "action": action,
+            "reason": reason,
+            "window": self.window,
+            "chunk_size": self.chunk_size,
+            "srtt": self.srtt,
+            "min_rtt": self.min_rtt,
+            "throughput": throughput
+        })
+
+    def get_metrics(self):
+        """
+        Get what the controller measured and decided.
+
+        :return: A dictionary of the current window and chunk size, the round trip times and throughput measured,
+        counts of requests, bytes and decisions, and events, the most recent decisions with their reasons.
+        """
+        elapsed = 0.0 if self.started_at is None else self.clock() - self.started_at
+
+        return {
+            "window": self.window,
+            "chunk_size": self.chunk_size,
+            "min_rtt": self.min_rtt,
+            "srtt": self.srtt,
+            "throughput": self.bytes / elapsed if elapsed > 0 else 0.0,
+            "max_throughput": self.max_throughput,
+            "requests": self.requests,
+            "bytes": self.bytes,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            "slow_start": self.slow_start,
+            "events": list(self.events)
+        }
+
+class download():
+    """
+    A download engine for one open file handle.
+
+    The file is split into chunks, and a window of SSH_FXP_READ requests is kept outstanding at once. Responses are
+    handed to the sink in offset order. Short reads are topped up with a read for the rest of the chunk, and the
+    chunk size shrinks to what the server actually returns, since most servers cap reads.
+
+    The window and chunk size come from a window_controller. By default they stay at max_reads and chunk_size.
+    """
+
+    def __init__(self, client, handle, chunk_size=32768, max_reads=16, controller=None):
+        """
+        :param client: The SFTP_client the handle belongs to.
+        :param handle: A handle opened for reading.
+        :param chunk_size: The number of bytes to ask for per read.
+        :param max_reads: The maximum number of reads outstanding at once.
+        :param controller: A window_controller to size the window and chunks with instead.
+        """
+        self.client = client
+        self.handle = handle
+        if controller is None:
+            controller = window_controller(max_reads, chunk_size, adaptive=False)
+        self.controller = controller
+
+    def run(self, sink, offset=0, amount=None):
+        """
+        Read the file.
+
+        :param sink: Called with each chunk of data, in offset order.
+        :param offset: The offset to read from.
+        :param amount: The amount to read. Reads to the end of the file if None.
+        :return: The number of bytes read.
+        """
+        end = None if amount is None else offset + amount
+        next_offset = offset
+        in_flight = collections.deque() # (offset, length, request_future), oldest first
+        eof = False
+        total = 0
+
+        controller = self.controller
+
+        while True:
+            # Keep the window of reads full
+            while not eof and len(in_flight) < controller.window and (end is None or next_offset < end):
+                length = controller.chunk_size
+                if not (end is None):
+                    length = min(length, end - next_offset)
+
+                controller.on_sent()
+                in_flight.append((next_offset, length, self.client.submit(read_request(self.handle, next_offset, length))))
+                next_offset += length
+
+            if not in_flight:
+                break
+
+            chunk_offset, length, future = in_flight.popleft()
+            r_packet = future.result()
+
+            if eof:
+                continue # Everything past the end of the file is dropped
+
+            if is_eof(r_packet):
+                eof = True
+                continue
+
+            data = r_packet.get_items()[0]
+            if len(data) == 0:
+                eof = True
+                continue
+
+            controller.on_response(len(data), future.get_rtt())
+            sink(data)
+            total += len(data)
+
+            # Short read, so ask for the rest of the chunk before anything after it.
+            if len(data) < length:
+                controller.limit_chunk_size(len(data))
+
+                rest_offset = chunk_offset + len(data)
+                rest_length = length - len(data)
+                future = self.client.submit(read_request(self.handle, rest_offset, rest_length))
+                in_flight.appendleft((rest_offset, rest_length, future))
+
+        return total
+
+class upload():
+    """
+    An upload engine for one open file handle.
+
+    The data is split into chunks, written at increasing offsets with a window of SSH_FXP_WRITE requests
+    outstanding at once. Every SSH_FXP_STATUS reply is checked, and run() only returns once every write has been
+    acknowledged.
+
+    The window and chunk size come from a window_controller. By default they stay at max_writes and chunk_size.
+    """
+
+    def __init__(self, client, handle, chunk_size=32768, max_writes=16, controller=None):
+        """
+        :param client: The SFTP_client the handle belongs to.
+        :param handle: A handle opened for writing.
+        :param chunk_size: The number of bytes to send per write.
+        :param max_writes: The maximum number of writes outstanding at once.
+        :param controller: A window_controller to size the window and chunks with instead.
+        """
+        self.client = client
+        self.handle = handle
+        if controller is None:
+            controller = window_controller(max_writes, chunk_size, adaptive=False)
+        self.controller = controller
+
+    def run(self, source, offset=0, progress=None):
+        """
+        Write to the file.
+
+        :param source: An iterable of chunks of data. Chunks may be of any size.
+        :param offset: The offset to write at.
+        :param progress: Called with the length of each write once it is acknowledged. Acks are checked in offset
+        order, so everything reported has been written.
+        :return: The number of bytes written.
+        """
+        in_flight = collections.deque() # (length, request_future), oldest first
+        total = 0
+
+        for chunk in self.__chunks(source):
+            # Wait for room in the window of writes
+            while len(in_flight) >= self.controller.window:
+                self.__acknowledge(in_flight.popleft(), progress)
+
+            self.controller.on_sent()
+            in_flight.append((len(chunk), self.client.submit(write_request(self.handle, offset, chunk))))
+            offset += len(chunk)
+            total += len(chunk)
+
+        # Wait on the remaining acks
+        while in_flight:
+            self.__acknowledge(in_flight.popleft(), progress)
+
+        return total
+
+    def __acknowledge(self, write, progress):
+        length, future = write
+        check_status(future.result())
+        self.controller.on_response(length, future.get_rtt())
+
+        if not (progress is None):
+            progress(length)
+
+    def __chunks(self, source):
+        """
+        Re-split an iterable of data into chunks of the controller's chunk size.
+
+        Chunks are memoryviews of the source data wherever possible. Data is only copied to join up pieces smaller
+        than a chunk.
+        """
+        pending = bytearray()
+
+        for data in source:
+            if isinstance(data, str):
+                data = data.encode("utf-8")
+            data = memoryview(data)
+
+            # Top up a partial chunk first
+            if pending:
+                take = self.controller.chunk_size - len(pending)
+                pending += data[:take]
+                data = data[take:]
+                if len(pending) < self.controller.chunk_size:
+                    continue
+                yield pending
+                pending = bytearray()
+
+            while data.nbytes >= self.controller.chunk_size:
+                chunk_size = self.controller.chunk_size
+                yield data[:chunk_size]
+                data = data[chunk_size:]
+
+            pending += data
+
+        if pending:
+            yield pending
+
+class striped_transfer():
+    """
+    Move one file over several SFTP_clients at once, each working on its own range of the file.
+
+    The file is cut into stripe_size stripes, and every client takes the next stripe as soon as it finishes its
+    last, so faster channels do more of the work. Each client is driven by its own thread, and keeps one handle
+    to the remote file open.
+
+    If a stripe fails, the rest of it is queued again, for whichever client is free first. If the server itself
+    refused the request, its client reopens its handle. Otherwise the channel may be broken: a client the transfer
+    opened itself reopens its sftp channel, and any other client, such as the caller's own, stops taking stripes,
+    since closing its channel would fail every other request in flight on it. A stripe that fails more than
+    retries times, or once no client is left to take it, fails the transfer.
+
+    Subclasses say how to prepare both files and how to move one stripe.
+    """
+
+    pflags = None # The PFLAG_names each client opens the remote file with
+    local_mode = None # The mode each client opens the local file with
+    direction = None # "read" or "write", for SFTP_client.transfer_controller()
+
+    def __init__(self, clients, path, stripe_size=8388608, retries=3, owned=()):
+        """
+        :param clients: The SFTP_clients to stripe across. They may share an SSH transport or not.
+        :param path: The remote file. Path is relative to user's ~.
+        :param stripe_size: The number of bytes in each stripe.
+        :param retries: How many times a stripe may fail and be retried.
+        :param owned: The clients opened for this transfer alone, whose channels it may close and reopen.
+        """
+        self.clients = clients
+        self.path = path
+        self.stripe_size = stripe_size
+        self.retries = retries
+        self.owned = list(owned)
+
+        self.condition = threading.Condition() # Guards the state below while the transfer runs
+        self.stripes = collections.deque() # (offset, length, failures) of stripes left to move
+        self.busy = 0 # Stripes being moved
+        self.active = 0 # Clients still taking stripes
+        self.moved = 0
+        self.size = 0
+        self.progress = None
+        self.error = None
+        self.controllers = [] # The window_controller of each client, once the transfer has run
+
+    def run(self, local_path, progress=None):
+        """
+        Move the file.
+
+        :param local_path: The local file.
+        :param progress: Called with the number of bytes moved so far and the file size, across every client.
+        :return: The number of bytes moved.
+        """
+        self.size = self.prepare(local_path)
+        self.stripes = collections.deque((offset, min(self.stripe_size, self.size - offset), 0)
+                                         for offset in range(0, self.size, self.stripe_size))
+        self.moved = 0
+        self.progress = progress
+        self.error = None
+        self.busy = 0
+        self.active = len(self.clients)
+        self.controllers = [client.transfer_controller(self.direction) for client in self.clients]
+
+        with ThreadPoolExecutor(len(self.clients)) as executor:
+            workers = [executor.submit(self.__work, client, controller, local_path)
+                       for client, controller in zip(self.clients, self.controllers)]
+            for worker in workers:
+                worker.result()
+
+        if not (self.error is None):
+            raise self.error
+
+        return self.moved
+
+    def prepare(self, local_path):
+        """
+        Get both files ready to be moved.
+
+        :return: The number of bytes to move.
+        """
+        raise NotImplementedError
+
+    def move(self, client, controller, handle, f, offset, length, report):
+        """
+        Move one stripe.
+
+        :param controller: The client's window_controller, kept from stripe to stripe.
+        :param f: The local file, opened with local_mode.
+        :param report: Called with the number of bytes moved, in offset order, as they are moved.
+        """
+        raise NotImplementedError
+
+    def __work(self, client, controller, local_path):
+        """
+        Move stripes over one client until there are none left.
+        """
+        handle = None
+
+        with open(local_path, self.local_mode) as f:
+            while True:
+                with self.condition:
+                    # A stripe being moved elsewhere may yet fail and be queued again
+                    while not self.stripes and self.busy and self.error is None:
+                        self.condition.wait()
+                    if not self.stripes or not (self.error is None):
+                        break
+                    offset, length, failures = self.stripes.popleft()
+                    self.busy += 1
+
+                moved = [0]
+                def report(amount):
+                    moved[0] += amount
+                    self.__report(amount)
+
+                retire = False
+                try:
+                    if handle is None:
+                        handle = self.__open(client)
+                    self.move(client, controller, handle, f, offset, length, report)
+                except Exception as e:
+                    if isinstance(e, SFTP_error):
+                        handle = self.__close(client, handle, e)
+                    elif client in self.owned:
+                        # The channel may be broken, so start over on a new one
+                        handle = None
+                        client.close_sftp_channel()
+                    else:
+                        # The channel may be broken, but it isn't this transfer's to close
+                        handle = None
+                        retire = True
+
+                    with self.condition:
+                        if retire:
+                            self.active -= 1
+                        if failures >= self.retries or not self.active:
+                            if self.error is None:
+                                self.error = e
+                        elif moved[0] < length:
+                            self.stripes.appendleft((offset + moved[0], length - moved[0], failures + 1))
+                finally:
+                    with self.condition:
+                        self.busy -= 1
+                        self.condition.notify_all()
+
+                if retire or not (self.error is None):
+                    break
+
+        self.__close(client, handle)
+
+    def __report(self, amount):
+        with self.condition:
+            self.moved += amount
+            if not (self.progress is None):
+                self.progress(self.moved, self.size)
+
+    def __open(self, client):
+        r_packet = client.submit(open_request(self.path, self.pflags)).result()
+        expect(r_packet, "SSH_FXP_HANDLE")
+
+        return r_packet.get_items()[0]
+
+    def __close(self, client, handle, error=None):
+        """
+        Close a handle, returning None. After a failure, errors from the close are ignored.
+        """
+        if handle is None:
+            return None
+
+        try:
+            check_status(client.submit(handle_request("SSH_FXP_CLOSE", handle)).result())
+        except Exception as e:
+            with self.condition:
+                if error is None and self.error is None:
+                    self.error = e
+
+        return None
+
+class striped_download(striped_transfer):
+    """
+    Download one file over several SFTP_clients at once.
+    """
+
+    pflags = ["SSH_FXF_READ"]
+    local_mode = "r+b"
+    direction = "read"
+
+    def prepare(self, local_path):
+        # Sent directly, since a size from the metadata cache may be stale
+        r_packet = self.clients[0].submit(path_request("SSH_FXP_STAT", self.path)).result()
+        expect(r_packet, "SSH_FXP_ATTRS")
+        size = r_packet.get_items()[0].get_size()
+
+        # Size the local file up front, so every stripe can be written in place
+        with open(local_path, "wb") as f:
+            f.truncate(size)
+
+        return size
+
+    def move(self, client, controller, handle, f, offset, length, report):
+        f.seek(offset)
+
+        def sink(data):
+            f.write(data)
+            report(len(data))
+
+        download(client, handle, controller=controller).run(sink, offset, length)
+
+class striped_upload(striped_transfer):
+    """
+    Upload one file over several SFTP_clients at once.
+    """
+
+    pflags = ["SSH_FXF_WRITE"]
+    local_mode = "rb"
+    direction = "write"
+
+    def prepare(self, local_path):
+        # Create or empty the remote file before any stripe is written
+        self.clients[0].write_file(self.path, bytes())
+
+        return os.path.getsize(local_path)
+
+    def move(self, client, controller, handle, f, offset, length, report):
+        f.seek(offset)
+
+        def source():
+            remaining = length
+            while remaining > 0:
+                data = f.read(min(controller.chunk_size, remaining))
+                if not data:
+                    raise RuntimeError("local file shrank during the upload")
+                remaining -= len(data)
+                yield data
+
+        upload(client, handle, controller=controller).run(source(), offset, report)
@@ -0,0 +1,80 @@
+"""
+A micro-benchmark of encoding and decoding, in µs per packet, for packet and attributes.
+
+Run with: python bench/bench_codec.py
+"""
+# Handle imports
+import os
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Packet import packet
+from Attributes import attributes
+from Requests import path_request, open_request, read_request, write_request
+from bench_memory import name_response
+
+# Define global vars
+handle = bytes(4)
+payload = os.urandom(32768)
+
+# Define methods
+def response(FXP_type_byte, body):
+    return struct.pack(">IB", len(body) + 1, FXP_type_byte) + body
+
+def build_requests():
+    """
+    Build one of each request that sits on the hot path.
+    """
+    requests = {
+        "OPEN": open_request("some/remote/dir/file.bin", ["SSH_FXF_READ"]),
+        "READ": read_request(handle, 1 << 32, 32768),
+        "WRITE 32 KiB": write_request(handle, 1 << 32, payload),
+        "STAT": path_request("SSH_FXP_STAT", "some/remote/dir/file.bin")
+    }
+    for c_packet in requests.values():
+        c_packet.set_id(1)
+
+    return requests
+
+def build_responses():
+    """
+    Build one of each response that sits on the hot path.
+    """
+    attr = attributes(size=1, uid=1000, gid=1000, permissions=0o100644, atime=1, mtime=2).bytes()
+
+    return {
+        "STATUS": response(101, struct.pack(">II", 1, 0) + struct.pack(">I", 7) + b"Success" + struct.pack(">I", 0)),
+        "HANDLE": response(102, struct.pack(">II", 1, len(handle)) + handle),
+        "DATA 32 KiB": response(103, struct.pack(">II", 1, len(payload)) + payload),
+        "ATTRS": response(105, struct.pack(">I", 1) + bytes(attr)),
+        "NAME 100 entries": name_response(100)
+    }
+
+def time_us(function, number):
+    return {"value": min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6, "unit": "µs"}
+
+def run(number=2000):
+    """
+    Time encoding each request and decoding each response, and both for attributes.
+
+    :return: A dictionary of measurement name to {"value", "unit"}.
+    """
+    results = {}
+    for name, c_packet in build_requests().items():
+        results["encode " + name] = time_us(c_packet.buffers, number)
+    for name, b in build_responses().items():
+        results["decode " + name] = time_us(lambda: packet(b=b), number)
+
+    attr = attributes(size=1, uid=1000, gid=1000, permissions=0o100644, atime=1, mtime=2)
+    b = attr.bytes()
+    results["encode attributes"] = time_us(attr.bytes, number)
+    results["decode attributes"] = time_us(lambda: attributes(b=b), number)
+
+    return results
+
+if __name__ == "__main__":
+    for name, result in run().items():
+        print("%-24s %8.2f %s" % (name, result["value"], result["unit"]))
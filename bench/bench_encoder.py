@@ -0,0 +1,89 @@
+"""
+A micro-benchmark of packet encoding. It compares encode() against the old bittify() based encoding.
+
+Run with: python bench/bench_encoder.py
+"""
+# Handle imports
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Packet
+from Packet import packet, bittify, PFLAG_names
+from Attributes import attributes
+
+# Define global vars
+handle = bytes(4)
+payload = os.urandom(32768)
+
+# Define methods
+def build_packets():
+    """
+    Build one of each request that sits on the hot path.
+    """
+    packets = {}
+
+    c_packet = packet("SSH_FXP_OPEN", id=1)
+    c_packet.add("some/remote/dir/file.bin")
+    c_packet.add(PFLAG_names["SSH_FXF_READ"], 4)
+    c_packet.add(attributes())
+    packets["OPEN"] = c_packet
+
+    c_packet = packet("SSH_FXP_READ", id=2)
+    c_packet.add(handle)
+    c_packet.add(1 << 32, 8)
+    c_packet.add(32768, 4)
+    packets["READ"] = c_packet
+
+    c_packet = packet("SSH_FXP_WRITE", id=3)
+    c_packet.add(handle)
+    c_packet.add(1 << 32, 8)
+    c_packet.add(payload)
+    packets["WRITE 32 KiB"] = c_packet
+
+    c_packet = packet("SSH_FXP_STAT", id=4)
+    c_packet.add("some/remote/dir/file.bin")
+    packets["STAT"] = c_packet
+
+    return packets
+
+def bittify_bytes(c_packet):
+    """
+    Encode a packet the way packet.bytes() used to, one bittify() call per item.
+    """
+    msg = bytearray()
+    for item, length in zip(c_packet.get_items(), c_packet.get_lengths()):
+        msg += bittify(item, length)
+
+    msg = bittify(c_packet.get_id(), 4) + msg
+    msg = bittify(len(msg)+1, 4) + c_packet.FXP_type_byte() + msg
+
+    return bytes(list(msg))
+
+def encode_buffers(c_packet):
+    return Packet.encode(c_packet.get_FXP_type(), c_packet.get_id(), c_packet.get_items(), c_packet.get_lengths())
+
+def time_us(function, c_packet, number):
+    return min(timeit.repeat(lambda: function(c_packet), number=number, repeat=5)) / number * 1e6
+
+def run(number=200):
+    """
+    Time both encoders on each request.
+
+    :return: A dictionary of request name to (bittify µs, encode µs).
+    """
+    results = {}
+    for name, c_packet in build_packets().items():
+        # Both encoders must agree before their speed is worth comparing.
+        assert bittify_bytes(c_packet) == bytes().join(encode_buffers(c_packet)), name
+
+        results[name] = (time_us(bittify_bytes, c_packet, number), time_us(encode_buffers, c_packet, number))
+
+    return results
+
+if __name__ == "__main__":
+    print("%-14s %12s %12s %8s" % ("request", "bittify µs", "encode µs", "speedup"))
+    for name, (old, new) in run().items():
+        print("%-14s %12.2f %12.2f %7.1fx" % (name, old, new, old / new))
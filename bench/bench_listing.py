@@ -0,0 +1,71 @@
+"""
+A benchmark of listdir_attr against a local stand_in_server, for directories of 1k to 1M entries. It reports the time
+taken and the peak memory traced while listing.
+
+The server runs in the same process, so the peak includes its buffers too, though it only holds one READDIR batch at
+a time. Making the 1M entry directory takes a while.
+
+Run with: python bench/bench_listing.py [largest directory]
+"""
+# Handle imports
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Stand_In_Server import stand_in_server
+
+# Define global vars
+SIZES = (1000, 10000, 100000, 1000000)
+
+# Define methods
+def count_name(count):
+    if count >= 1000000:
+        return str(count // 1000000) + "M"
+
+    return str(count // 1000) + "k"
+
+def run(sizes=SIZES):
+    """
+    List a directory of each size, once timed and once traced.
+
+    :return: A dictionary of measurement name to {"value", "unit"}.
+    """
+    results = {}
+
+    with stand_in_server() as server:
+        client = server.client()
+
+        made = 0
+        os.mkdir(os.path.join(server.root, "listing"))
+        for count in sorted(sizes):
+            # Each directory is the last one plus more entries
+            while made < count:
+                open(os.path.join(server.root, "listing", "file%07d" % made), "wb").close()
+                made += 1
+
+            start = time.perf_counter()
+            listing = client.listdir_attr("listing")
+            elapsed = time.perf_counter() - start
+            assert len(listing) >= count
+            del listing
+
+            tracemalloc.start()
+            listing = client.listdir_attr("listing")
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del listing
+
+            results["listdir_attr " + count_name(count) + " time"] = {"value": elapsed, "unit": "s"}
+            results["listdir_attr " + count_name(count) + " peak"] = {"value": peak / 1e6, "unit": "MB"}
+
+        client.stop()
+
+    return results
+
+if __name__ == "__main__":
+    largest = int(sys.argv[1]) if len(sys.argv) > 1 else SIZES[-1]
+    for name, result in run([size for size in SIZES if size <= largest]).items():
+        print("%-26s %10.3f %s" % (name, result["value"], result["unit"]))
@@ -0,0 +1,93 @@
+"""
+A memory benchmark of decoded directory listings. It reports the bytes held per attributes object and per entry of a
+decoded SSH_FXP_NAME response. A control class with the same fields in a per-instance __dict__ is measured alongside,
+so the saving from __slots__ can be re-measured on any Python.
+
+Run with: python bench/bench_memory.py
+"""
+# Handle imports
+import os
+import struct
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Packet import packet
+from Attributes import attributes
+
+# Define classes
+class dict_attributes:
+    """
+    A control for attributes: the same fields and defaults, kept in a per-instance __dict__ instead of __slots__.
+    """
+
+    def __init__(self, size = None, uid = None, gid = None, permissions = None, atime = None,
+                 mtime = None, extended_type = None, extended_data = None):
+        self.size = size
+        self.uid = uid
+        self.gid = gid
+        self.permissions = permissions
+        self.atime = atime
+        self.mtime = mtime
+        self.extended_type = () if extended_type is None else list(extended_type)
+        self.extended_data = () if extended_data is None else list(extended_data)
+
+        self.byte_length = None
+
+# Define methods
+def name_response(count):
+    """
+    Build an SSH_FXP_NAME response with count entries, each with size, uid/gid, permissions and times.
+    """
+    body = bytearray(struct.pack(">II", 1, count))
+    for i in range(count):
+        filename = ("file%07d" % i).encode("utf-8")
+        body += struct.pack(">I", len(filename)) + filename
+        body += struct.pack(">I", len(filename)) + filename
+        body += struct.pack(">IQIIIII", 0xF, i, 1000, 1000, 0o100644, 1500000000, 1500000000)
+
+    return struct.pack(">IB", len(body) + 1, 104) + bytes(body)
+
+def measure(function, count):
+    """
+    :return: The bytes still held per item after function(count) returns, and the peak bytes per item.
+    """
+    tracemalloc.start()
+    held = function(count)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del held
+
+    return current / count, peak / count
+
+def make_attributes(count):
+    return [attributes(size=i, uid=1000, gid=1000, permissions=0o100644, atime=1, mtime=2) for i in range(count)]
+
+def make_dict_attributes(count):
+    return [dict_attributes(size=i, uid=1000, gid=1000, permissions=0o100644, atime=1, mtime=2) for i in range(count)]
+
+def decode_listing(count):
+    return packet(b=name_response(count)).get_items()[1:]
+
+def run(count=100000):
+    """
+    :return: A dictionary of measurement name to bytes per item.
+    """
+    attrs_held, attrs_peak = measure(make_attributes, count)
+    dict_held, dict_peak = measure(make_dict_attributes, count)
+    listing_held, listing_peak = measure(decode_listing, count)
+
+    return {
+        "attributes held": attrs_held,
+        "__dict__ control held": dict_held,
+        "listing entry held": listing_held,
+        "listing entry peak": listing_peak
+    }
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = run(count)
+    for name, value in results.items():
+        print("%-22s %8.1f bytes" % (name, value))
+    print("%-22s %8.1f bytes" % ("__slots__ saving", results["__dict__ control held"] - results["attributes held"]))
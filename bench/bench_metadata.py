@@ -0,0 +1,79 @@
+"""
+A benchmark of metadata operations per second against a local stand_in_server. Each operation is timed both one
+round trip at a time and pipelined.
+
+Run with: python bench/bench_metadata.py [count] [latency in seconds]
+"""
+# Handle imports
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Stand_In_Server import stand_in_server
+
+# Define methods
+def ops_per_second(function, count, repeat):
+    """
+    Call function(round) repeat times, and rate the fastest round as count operations.
+    """
+    best = None
+    for round in range(repeat):
+        start = time.perf_counter()
+        function(round)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return {"value": count / best, "unit": "ops/s"}
+
+def make_files(server, names):
+    for name in names:
+        open(os.path.join(server.root, name), "wb").close()
+
+def run(count=1000, latency=0.0, repeat=3):
+    """
+    Time stat, create_dir and remove_file, and their pipelined versions.
+
+    :param count: The number of operations timed for each.
+    :param latency: Seconds the server adds to every response.
+    :param repeat: The number of rounds to time. The fastest counts.
+    :return: A dictionary of measurement name to {"value", "unit"}.
+    """
+    results = {}
+
+    # Every round creates or removes its own names
+    def names(prefix, round):
+        return [prefix + str(round) + "_%07d" % i for i in range(count)]
+
+    with stand_in_server(latency=latency) as server:
+        client = server.client()
+        for round in range(repeat):
+            make_files(server, names("remove_file", round))
+            make_files(server, names("remove_files", round))
+        make_files(server, names("stat", 0))
+
+        results["stat"] = ops_per_second(lambda round: [client.stat(name) for name in names("stat", 0)], count,
+                                         repeat)
+        results["stat_many"] = ops_per_second(lambda round: client.stat_many(names("stat", 0)), count, repeat)
+
+        results["create_dir"] = ops_per_second(
+            lambda round: [client.create_dir(name) for name in names("create_dir", round)], count, repeat)
+        results["create_dirs"] = ops_per_second(lambda round: client.create_dirs(names("create_dirs", round)),
+                                                count, repeat)
+
+        results["remove_file"] = ops_per_second(
+            lambda round: [client.remove_file(name) for name in names("remove_file", round)], count, repeat)
+        results["remove_files"] = ops_per_second(lambda round: client.remove_files(names("remove_files", round)),
+                                                 count, repeat)
+
+        client.stop()
+
+    return results
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    for name, result in run(count, latency).items():
+        print("%-14s %10.0f %s" % (name, result["value"], result["unit"]))
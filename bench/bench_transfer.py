@@ -0,0 +1,87 @@
+"""
+A benchmark of download and upload throughput against a local stand_in_server, across file sizes and chunk sizes.
+
+Each fixed chunk size is timed with adaptive transfers off, so the chunk size is what is measured. The "auto" rows
+use the client's defaults, tuned to the server's limits, and the "adaptive" rows add adaptive transfers on top.
+
+Run with: python bench/bench_transfer.py [latency in seconds]
+"""
+# Handle imports
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from Stand_In_Server import stand_in_server
+
+# Define global vars
+FILE_SIZES = (1048576, 16777216, 67108864)
+CHUNK_SIZES = (32768, 131072, 261120)
+
+# Define methods
+def size_name(size):
+    if size >= 1048576:
+        return str(size // 1048576) + " MiB"
+
+    return str(size // 1024) + " KiB"
+
+def megabytes_per_second(function, size, repeat):
+    """
+    Call function repeat times, and rate the fastest call as moving size bytes.
+    """
+    best = None
+    for round in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return {"value": size / best / 1e6, "unit": "MB/s"}
+
+def time_transfers(results, client, label, blob, repeat):
+    """
+    Time uploads then downloads of blob.
+    """
+    name = "file_" + str(len(blob))
+    size = size_name(len(blob))
+
+    results["upload " + size + " " + label] = megabytes_per_second(lambda: client.write_file(name, blob), len(blob),
+                                                                   repeat)
+    results["download " + size + " " + label] = megabytes_per_second(lambda: client.read_file(name), len(blob),
+                                                                     repeat)
+
+def run(file_sizes=FILE_SIZES, chunk_sizes=CHUNK_SIZES, latency=0.0, repeat=3):
+    """
+    Time uploads and downloads of each file size with each chunk size.
+
+    :param latency: Seconds the server adds to every response.
+    :param repeat: The number of times each transfer is timed. The fastest counts.
+    :return: A dictionary of measurement name to {"value", "unit"}.
+    """
+    results = {}
+    blobs = [os.urandom(size) for size in file_sizes]
+
+    with stand_in_server(latency=latency) as server:
+        for chunk_size in chunk_sizes:
+            client = server.client(read_chunk_size=chunk_size, write_chunk_size=chunk_size)
+            client.adaptive = False
+            for blob in blobs:
+                time_transfers(results, client, size_name(chunk_size) + " chunks", blob, repeat)
+            client.stop()
+
+        client = server.client()
+        for blob in blobs:
+            time_transfers(results, client, "auto", blob, repeat)
+        client.adaptive = True
+        for blob in blobs:
+            time_transfers(results, client, "adaptive", blob, repeat)
+        client.stop()
+
+    return results
+
+if __name__ == "__main__":
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.0
+    for name, result in run(latency=latency).items():
+        print("%-32s %8.1f %s" % (name, result["value"], result["unit"]))
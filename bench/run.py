@@ -0,0 +1,139 @@
+"""
+Run every benchmark and write the results to JSON, optionally comparing them against an earlier run.
+
+Run with: python bench/run.py [--output results.json] [--compare baseline.json] [--threshold 0.1] [--quick]
+
+Each result is {"value", "unit"}. With --compare, a result that got worse by more than the threshold is reported as a
+regression, and the exit status is 1. Rates (ops/s, MB/s) get worse by going down, and everything else by going up.
+Only compare runs from the same machine, and use full runs, since --quick runs are too short to be steady.
+"""
+# Handle imports
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_codec
+import bench_listing
+import bench_memory
+import bench_metadata
+import bench_transfer
+
+# Define global vars
+HIGHER_IS_BETTER = ("ops/s", "MB/s")
+
+# Define methods
+def git_commit():
+    """
+    Get the commit the benchmarks ran on, or None outside a git checkout.
+    """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def memory_results(count):
+    return {name: {"value": value, "unit": "bytes"} for name, value in bench_memory.run(count).items()}
+
+def run(quick=False, latency=0.0):
+    """
+    Run every benchmark.
+
+    :param quick: Use smaller files and directories, for a run that takes seconds instead of minutes.
+    :param latency: Seconds the stand-in server adds to every response.
+    :return: A dictionary of suite name to its results.
+    """
+    if quick:
+        suites = {
+            "codec": lambda: bench_codec.run(200),
+            "memory": lambda: memory_results(10000),
+            "metadata": lambda: bench_metadata.run(200, latency),
+            "transfer": lambda: bench_transfer.run((1048576, 8388608), (32768, 261120), latency),
+            "listing": lambda: bench_listing.run((1000, 10000))
+        }
+    else:
+        suites = {
+            "codec": bench_codec.run,
+            "memory": lambda: memory_results(100000),
+            "metadata": lambda: bench_metadata.run(latency=latency),
+            "transfer": lambda: bench_transfer.run(latency=latency),
+            "listing": bench_listing.run
+        }
+
+    results = {}
+    for name, suite in suites.items():
+        sys.stderr.write("Running " + name + "\n")
+        results[name] = suite()
+
+    return results
+
+def compare(results, baseline):
+    """
+    Compare results against a baseline.
+
+    :return: A list of (suite, name, baseline value, value, change) for every result in both, where change is how
+    much worse the result got, as a fraction. Improvements are negative.
+    """
+    rows = []
+    for suite, suite_results in results.items():
+        for name, result in suite_results.items():
+            old = baseline.get(suite, {}).get(name)
+            if old is None or old["unit"] != result["unit"] or not old["value"]:
+                continue
+
+            change = (result["value"] - old["value"]) / old["value"]
+            if result["unit"] in HIGHER_IS_BETTER:
+                change = -change
+            rows.append((suite, name, old["value"], result["value"], change))
+
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the SFTP3 benchmarks against a local stand-in server.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare against the results in this JSON file.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="How much worse counts as a regression.")
+    parser.add_argument("--quick", action="store_true", help="Use smaller files and directories.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds the server adds to every response.")
+    args = parser.parse_args()
+
+    report = {
+        "commit": git_commit(),
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": args.quick,
+        "latency": args.latency,
+        "results": run(args.quick, args.latency)
+    }
+
+    if args.output is None:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+    else:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.compare is None:
+        return 0
+
+    with open(args.compare, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = 0
+    for suite, name, old, new, change in compare(report["results"], baseline["results"]):
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        sys.stderr.write("%-10s %-36s %12.3f -> %12.3f %+7.1f%%%s\n" % (suite, name, old, new, change*100, flag))
+
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())